@@ -17,16 +17,30 @@
 
 #include <stdio.h>
 #include <stdbool.h>
+#include <stddef.h>
+#include <stdint.h>
 #include "lib_filter.h"
 
+// highest filter protocol version we support
+#define LF_PROTOCOL_VERSION 2
+
 extern struct lf_state {
   const char *filter_name;
   FILE *in;
   FILE *out;
+  int protocol_version;
+  // shared memory segment, or NULL.  the server writes to the first half
+  // and we write to the second.
+  uint8_t *shm;
+  size_t shm_size;
+  size_t shm_out_offset;
+  // attributes the server sends with each object, or NULL
+  char **prefetch_attrs;
 } lf_state;
 
 lf_obj_handle_t lf_obj_handle_new(void);
 void lf_obj_handle_free(lf_obj_handle_t obj);
+void lf_obj_handle_read_prefetched(lf_obj_handle_t obj);
 
 void lf_start_output(void);
 void lf_end_output(void);
@@ -19,8 +19,24 @@
 #include <stdio.h>
 #include <string.h>
 #include <stdint.h>
+#include <arpa/inet.h>
 
 #include "lf_protocol.h"
+#include "lf_priv.h"
+
+// In protocol version 1, each tag is a line of text, and each item is a
+// line containing its length in decimal followed by the data and a
+// newline.  A blank line represents a missing item or the end of an
+// array.  In protocol version 2, each tag and item is a 32-bit big-endian
+// signed length followed by the data, and a length of -1 represents a
+// missing item or the end of an array.  If a shared memory segment is in
+// use, a length of -2 is followed by a 64-bit big-endian offset and length
+// of the data within the segment.
+#define BINARY_PROTOCOL (lf_state.protocol_version >= 2)
+#define SHM_ITEM -2
+
+// send items at least this long through shared memory if possible
+#define SHM_THRESHOLD 65536
 
 static void error_stdio(FILE *f, const char *msg) {
   if (feof(f)) {
@@ -32,11 +48,85 @@ static void error_stdio(FILE *f, const char *msg) {
   }
 }
 
+static void send_length(FILE *out, int32_t len) {
+  uint32_t buf = htonl((uint32_t) len);
+  if (fwrite(&buf, sizeof(buf), 1, out) != 1) {
+    error_stdio(out, "Can't write length");
+  }
+}
+
+static void send_uint64(FILE *out, uint64_t val) {
+  uint32_t buf[2] = {htonl((uint32_t) (val >> 32)), htonl((uint32_t) val)};
+  if (fwrite(buf, sizeof(buf), 1, out) != 1) {
+    error_stdio(out, "Can't write shared memory reference");
+  }
+}
+
+static uint64_t get_uint64(FILE *in) {
+  uint32_t buf[2];
+  if (fread(buf, sizeof(buf), 1, in) != 1) {
+    error_stdio(in, "Can't read shared memory reference");
+  }
+  return ((uint64_t) ntohl(buf[0]) << 32) | ntohl(buf[1]);
+}
+
+static int get_binary_size(FILE *in) {
+  uint32_t buf;
+  if (fread(&buf, sizeof(buf), 1, in) != 1) {
+    error_stdio(in, "Can't read size");
+  }
+  int result = (int32_t) ntohl(buf);
+  if (result == SHM_ITEM) {
+    return result;
+  }
+  return result < 0 ? -1 : result;
+}
+
+// read a binary protocol item.  if shared_OUT is true on return, the
+// result points into the shared memory segment and is valid until the
+// next object; otherwise it must be freed with g_free().
+static void *get_item(FILE *in, int *len_OUT, bool *shared_OUT) {
+  int size = get_binary_size(in);
+  *shared_OUT = false;
+
+  if (size == SHM_ITEM) {
+    uint64_t offset = get_uint64(in);
+    uint64_t len = get_uint64(in);
+    if (lf_state.shm == NULL || len > G_MAXINT ||
+        offset + len > lf_state.shm_size / 2) {
+      g_warning("Bad shared memory reference");
+      exit(EXIT_FAILURE);
+    }
+    *len_OUT = len;
+    *shared_OUT = true;
+    return lf_state.shm + offset;
+  }
+
+  *len_OUT = size;
+  uint8_t *data = NULL;
+  if (size > 0) {
+    data = g_malloc(size);
+    if (fread(data, size, 1, in) != 1) {
+      error_stdio(in, "Can't read binary");
+    }
+  }
+  return data;
+}
+
 int lf_get_size(FILE *in) {
   char *line = NULL;
   size_t n;
   int result;
 
+  if (BINARY_PROTOCOL) {
+    result = get_binary_size(in);
+    if (result == SHM_ITEM) {
+      g_warning("Unexpected shared memory reference");
+      exit(EXIT_FAILURE);
+    }
+    return result;
+  }
+
   if (getline(&line, &n, in) == -1) {
     free(line);
     error_stdio(in, "Can't read size");
@@ -56,6 +146,24 @@ int lf_get_size(FILE *in) {
 }
 
 char *lf_get_string(FILE *in) {
+  if (BINARY_PROTOCOL) {
+    int len;
+    bool shared;
+    uint8_t *data = get_item(in, &len, &shared);
+    if (len == -1) {
+      return NULL;
+    }
+    char *result = g_malloc(len + 1);
+    if (len > 0) {
+      memcpy(result, data, len);
+    }
+    result[len] = '\0';
+    if (!shared) {
+      g_free(data);
+    }
+    return result;
+  }
+
   int size = lf_get_size(in);
 
   if (size == -1) {
@@ -72,7 +180,9 @@ char *lf_get_string(FILE *in) {
   }
 
   // read trailing '\n'
-  getc(in);
+  if (!BINARY_PROTOCOL) {
+    getc(in);
+  }
 
   return result;
 }
@@ -101,7 +211,24 @@ char **lf_get_strings(FILE *in) {
   return result;
 }
 
+void *lf_get_binary_ref(FILE *in, int *len_OUT, bool *shared_OUT) {
+  if (BINARY_PROTOCOL) {
+    return get_item(in, len_OUT, shared_OUT);
+  }
+  *shared_OUT = false;
+  return lf_get_binary(in, len_OUT);
+}
+
 void *lf_get_binary(FILE *in, int *len_OUT) {
+  if (BINARY_PROTOCOL) {
+    bool shared;
+    void *data = get_item(in, len_OUT, &shared);
+    if (shared) {
+      data = g_memdup(data, *len_OUT);
+    }
+    return data;
+  }
+
   int size = lf_get_size(in);
   *len_OUT = size;
 
@@ -115,7 +242,7 @@ void *lf_get_binary(FILE *in, int *len_OUT) {
     }
   }
 
-  if (size != -1) {
+  if (size != -1 && !BINARY_PROTOCOL) {
     // read trailing '\n'
     getc(in);
   }
@@ -124,13 +251,30 @@ void *lf_get_binary(FILE *in, int *len_OUT) {
 }
 
 void lf_send_binary(FILE *out, int len, const void *data) {
-  if (fprintf(out, "%d\n", len) == -1) {
+  size_t offset = lf_state.shm_out_offset;
+  if (BINARY_PROTOCOL && lf_state.shm != NULL && len >= SHM_THRESHOLD &&
+      offset + len <= lf_state.shm_size) {
+    // copy into our half of the shared memory segment
+    memcpy(lf_state.shm + offset, data, len);
+    lf_state.shm_out_offset += len;
+    send_length(out, SHM_ITEM);
+    send_uint64(out, offset);
+    send_uint64(out, len);
+    if (fflush(out) != 0) {
+      error_stdio(out, "Can't flush");
+    }
+    return;
+  }
+
+  if (BINARY_PROTOCOL) {
+    send_length(out, len);
+  } else if (fprintf(out, "%d\n", len) == -1) {
     error_stdio(out, "Can't write binary length");
   }
-  if (fwrite(data, len, 1, out) != 1) {
+  if (len > 0 && fwrite(data, len, 1, out) != 1) {
     error_stdio(out, "Can't write binary");
   }
-  if (fprintf(out, "\n") == -1) {
+  if (!BINARY_PROTOCOL && fprintf(out, "\n") == -1) {
     error_stdio(out, "Can't write end of binary");
   }
   if (fflush(out) != 0) {
@@ -140,6 +284,10 @@ void lf_send_binary(FILE *out, int len, const void *data) {
 
 
 void lf_send_tag(FILE *out, const char *tag) {
+  if (BINARY_PROTOCOL) {
+    lf_send_string(out, tag);
+    return;
+  }
   if (fprintf(out, "%s\n", tag) == -1) {
     error_stdio(out, "Can't write tag");
   }
@@ -156,6 +304,10 @@ void lf_send_int(FILE *out, int i) {
 
 void lf_send_string(FILE *out, const char *str) {
   int len = strlen(str);
+  if (BINARY_PROTOCOL) {
+    lf_send_binary(out, len, str);
+    return;
+  }
   if (fprintf(out, "%d\n%s\n", len, str) == -1) {
     error_stdio(out, "Can't write string");
   }
@@ -178,7 +330,9 @@ bool lf_get_boolean(FILE *in) {
 }
 
 void lf_send_blank(FILE *out) {
-  if (fprintf(out, "\n") == -1) {
+  if (BINARY_PROTOCOL) {
+    send_length(out, -1);
+  } else if (fprintf(out, "\n") == -1) {
     error_stdio(out, "Can't write blank");
   }
   if (fflush(out) != 0) {
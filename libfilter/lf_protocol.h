@@ -26,6 +26,8 @@ char **lf_get_strings(FILE *in);
 
 void *lf_get_binary(FILE *in, int *len_OUT);
 
+void *lf_get_binary_ref(FILE *in, int *len_OUT, bool *shared_OUT);
+
 bool lf_get_boolean(FILE *in);
 
 void lf_get_blank(FILE *in);
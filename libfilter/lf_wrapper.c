@@ -23,6 +23,7 @@
 #include <string.h>
 #include <errno.h>
 #include <signal.h>
+#include <sys/mman.h>
 
 #include "lib_filter.h"
 #include "lf_protocol.h"
@@ -166,6 +167,16 @@ static void lf_run_filter(char *filter_name, filter_init_proto init,
     // init ohandle
     lf_obj_handle_t obj = lf_obj_handle_new();
 
+    // tell the server we're done with the previous object's shared
+    // memory, and receive prefetched attributes
+    if (lf_state.shm != NULL || lf_state.prefetch_attrs != NULL) {
+      lf_start_output();
+      lf_send_tag(lf_state.out, "next-object");
+      lf_end_output();
+      lf_obj_handle_read_prefetched(obj);
+      lf_state.shm_out_offset = lf_state.shm_size / 2;
+    }
+
     // eval and return result
     double result;
     if (eval_double) {
@@ -182,9 +193,70 @@ static void lf_run_filter(char *filter_name, filter_init_proto init,
   }
 }
 
+static void negotiate_protocol(void) {
+  // find the highest version advertised by the server that we support
+  const char *advertised = getenv("DIAMOND_FILTER_PROTOCOLS");
+  int version = lf_state.protocol_version;
+  if (advertised == NULL) {
+    return;
+  }
+  char **versions = g_strsplit(advertised, ",", 0);
+  for (char **v = versions; *v != NULL; v++) {
+    int cur = atoi(*v);
+    if (cur > version && cur <= LF_PROTOCOL_VERSION) {
+      version = cur;
+    }
+  }
+  g_strfreev(versions);
+
+  if (version != lf_state.protocol_version) {
+    // announce in the old protocol, then switch
+    lf_start_output();
+    lf_send_tag(lf_state.out, "set-protocol-version");
+    lf_send_int(lf_state.out, version);
+    lf_state.protocol_version = version;
+    lf_end_output();
+  }
+}
+
+static void map_shared_memory(void) {
+  // map the shared memory segment offered by the server, if any
+  const char *spec = getenv("DIAMOND_FILTER_SHM");
+  if (spec == NULL || lf_state.protocol_version < 2) {
+    return;
+  }
+  const char *sep = strrchr(spec, ':');
+  if (sep == NULL) {
+    return;
+  }
+  char *path = g_strndup(spec, sep - spec);
+  size_t size = strtoull(sep + 1, NULL, 10);
+  int fd = open(path, O_RDWR);
+  g_free(path);
+  if (fd == -1 || size == 0) {
+    if (fd != -1) {
+      close(fd);
+    }
+    return;
+  }
+  void *shm = mmap(NULL, size, PROT_READ | PROT_WRITE, MAP_SHARED, fd, 0);
+  close(fd);
+  if (shm == MAP_FAILED) {
+    return;
+  }
+
+  lf_start_output();
+  lf_send_tag(lf_state.out, "use-shared-memory");
+  lf_state.shm = shm;
+  lf_state.shm_size = size;
+  lf_state.shm_out_offset = size / 2;
+  lf_end_output();
+}
+
 static void _lf_main(filter_init_proto init, filter_eval_proto eval,
                      filter_eval_double_proto eval_double) {
   // set up file descriptors
+  lf_state.protocol_version = 1;
   lf_init();
 
   // read protocol version
@@ -204,6 +276,10 @@ static void _lf_main(filter_init_proto init, filter_eval_proto eval,
   int bloblen;
   void *blob = lf_get_binary(lf_state.in, &bloblen);
 
+  // switch to a newer protocol if the server supports one
+  negotiate_protocol();
+  map_shared_memory();
+
   // run the filter loop
   lf_run_filter(filter_name, init, eval, eval_double, args, blob, bloblen);
 }
@@ -33,12 +33,16 @@ struct ohandle {
 struct attribute {
   size_t len;
   void *data;
+  bool shared;  // data points into the shared memory segment
+  bool missing;  // prefetched attribute is not present in the object
 };
 
 static void attribute_destroy(gpointer user_data) {
   struct attribute *attr = user_data;
 
-  g_free(attr->data);
+  if (!attr->shared) {
+    g_free(attr->data);
+  }
   g_slice_free(struct attribute, attr);
 }
 
@@ -58,12 +62,56 @@ void lf_obj_handle_free(lf_obj_handle_t obj) {
   g_slice_free(struct ohandle, ohandle);
 }
 
+static void insert_attribute(struct ohandle *ohandle, const char *name,
+                             void *data, int len, bool shared) {
+  struct attribute *attr = g_slice_new(struct attribute);
+  attr->data = data;
+  attr->len = len == -1 ? 0 : len;
+  attr->shared = shared;
+  attr->missing = (len == -1);
+
+  g_hash_table_replace(ohandle->attributes, g_strdup(name), attr);
+}
+
+void lf_obj_handle_read_prefetched(lf_obj_handle_t obj) {
+  struct ohandle *ohandle = obj;
+
+  // the server sends the names of the prefetched attributes present in
+  // the object, followed by their values
+  char **names = lf_get_strings(lf_state.in);
+
+  // remember which ones are missing so we don't ask for them
+  if (lf_state.prefetch_attrs != NULL) {
+    for (char **n = lf_state.prefetch_attrs; *n != NULL; n++) {
+      insert_attribute(ohandle, *n, NULL, -1, false);
+    }
+  }
+
+  for (char **n = names; *n != NULL; n++) {
+    int len;
+    bool shared;
+    void *data = lf_get_binary_ref(lf_state.in, &len, &shared);
+    if (len == -1) {
+      g_warning("Missing prefetched attribute value");
+      exit(EXIT_FAILURE);
+    }
+    insert_attribute(ohandle, *n, data, len, shared);
+  }
+  lf_get_blank(lf_state.in);
+
+  g_strfreev(names);
+}
+
 static struct attribute *get_attribute(struct ohandle *ohandle,
                                        const char *name) {
   // look up in hash table
   struct attribute *attr = g_hash_table_lookup(ohandle->attributes,
 					       name);
 
+  if (attr != NULL && attr->missing) {
+    return NULL;
+  }
+
   // retrieve?
   if (attr == NULL) {
     lf_start_output();
@@ -72,18 +120,16 @@ static struct attribute *get_attribute(struct ohandle *ohandle,
     lf_end_output();
 
     int len;
-    void *data = lf_get_binary(lf_state.in, &len);
+    bool shared;
+    void *data = lf_get_binary_ref(lf_state.in, &len, &shared);
 
     if (len == -1) {
       // no attribute
       return NULL;
     }
 
-    attr = g_slice_new(struct attribute);
-    attr->data = data;
-    attr->len = len;
-
-    g_hash_table_insert(ohandle->attributes, g_strdup(name), attr);
+    insert_attribute(ohandle, name, data, len, shared);
+    attr = g_hash_table_lookup(ohandle->attributes, name);
   }
 
   return attr;
@@ -170,6 +216,12 @@ int lf_write_attr(lf_obj_handle_t ohandle, const char *name, size_t len,
   lf_send_binary(lf_state.out, len, data);
   lf_end_output();
 
+  // update our copy, if any, so a later read sees the new value
+  struct ohandle *obj = ohandle;
+  if (g_hash_table_lookup(obj->attributes, name) != NULL) {
+    insert_attribute(obj, name, g_memdup(data, len), len, false);
+  }
+
   return 0;
 }
 
@@ -184,7 +236,48 @@ int lf_omit_attr(lf_obj_handle_t ohandle, const char *name) {
   lf_end_output();
 
   // server sends false if non-existent
-  return lf_get_boolean(lf_state.in) ? 0 : ENOENT;
+  if (!lf_get_boolean(lf_state.in)) {
+    return ENOENT;
+  }
+
+  // the attribute exists; forget any stale record that it is missing
+  struct ohandle *obj = ohandle;
+  struct attribute *attr = g_hash_table_lookup(obj->attributes, name);
+  if (attr != NULL && attr->missing) {
+    g_hash_table_remove(obj->attributes, name);
+  }
+
+  return 0;
+}
+
+int lf_prefetch_attrs(const char * const *names) {
+  if (names == NULL || lf_state.prefetch_attrs != NULL) {
+    return EINVAL;
+  }
+  for (const char * const *n = names; *n != NULL; n++) {
+    if (strlen(*n) + 1 > MAX_ATTR_NAME) {
+      return EINVAL;
+    }
+  }
+  if (*names == NULL) {
+    return 0;
+  }
+  if (lf_state.protocol_version < 2) {
+    // server doesn't support prefetching; attributes are fetched on demand
+    return 0;
+  }
+
+  lf_start_output();
+  lf_send_tag(lf_state.out, "prefetch-attributes");
+  for (const char * const *n = names; *n != NULL; n++) {
+    lf_send_string(lf_state.out, *n);
+  }
+  lf_send_blank(lf_state.out);
+  lf_end_output();
+
+  lf_state.prefetch_attrs = g_strdupv((char **) names);
+
+  return 0;
 }
 
 int lf_get_session_variables(lf_obj_handle_t ohandle,
@@ -249,7 +249,7 @@ int lf_read_attr(lf_obj_handle_t ohandle, const char *name, size_t *len,
 /*!
  * Get pointer to attribute data in an object.  The returned pointer should
  * be treated read-only, and is only valid in the current instance of the
- * filter.  
+ * filter and until the attribute is written with lf_write_attr().  
  * \param ohandle
  * 		the object handle.
  *
@@ -329,6 +329,27 @@ diamond_public
 int lf_omit_attr(lf_obj_handle_t ohandle, const char *name);
 
 
+/*!
+ * Declare the attributes that the filter reads for every object.  Diamond
+ * will send their values along with each object, avoiding a round trip
+ * for each attribute.  If the server does not support filter protocol
+ * version 2, this has no effect and the attributes are fetched on demand.
+ * This may only be called from the filter init function.
+ *
+ * \param names
+ *		A NULL-terminated array of attribute names.
+ *
+ * \return 0
+ *		The attributes were declared successfully.
+ *
+ * \return EINVAL
+ *		One or more of the arguments was invalid.
+ */
+
+diamond_public
+int lf_prefetch_attrs(const char * const *names);
+
+
 /*!
  * This function allows the programmer to log some data that
  * can be retrieved from the host system.
@@ -208,6 +208,8 @@ class ControlConnection(_RPCClientConnection):
 
 class BlastConnection(_RPCClientConnection):
     get_object = _stub(2, None, protocol.XDR_object)
+    get_objects = _stub(3, protocol.XDR_blast_request,
+            protocol.XDR_object_list)
 
     # We intentionally make the nonce mandatory
     # pylint: disable=signature-differs
@@ -17,10 +17,16 @@ import uuid
 
 from opendiamond.blaster.rpc import ControlConnection, BlastConnection
 from opendiamond.protocol import (XDR_setup, XDR_filter_config,
-        XDR_blob_data, XDR_start, XDR_reexecute, DiamondRPCFCacheMiss)
-from opendiamond.rpc import RPCError, ConnectionFailure
+        XDR_blob_data, XDR_start, XDR_reexecute, XDR_blast_request,
+        DiamondRPCFCacheMiss)
+from opendiamond.rpc import (RPCError, RPCProcedureUnavailable,
+        ConnectionFailure)
 from opendiamond.scope import get_cookie_map
 
+# Maximum objects and bytes to request per blast channel RPC
+BLAST_BATCH_OBJECTS = 64
+BLAST_BATCH_BYTES = 4 << 20
+
 _log = logging.getLogger(__name__)
 
 
@@ -75,6 +81,7 @@ class _DiamondConnection(object):
         self._close_callback = stack_context.wrap(close_callback)
         self._finished = False  # No more results
         self._closed = False    # Connection closed
+        self._batched = True    # Server supports get_objects
         self.address = address
         self.control = ControlConnection(self.close)
         self.blast = BlastConnection(self.close)
@@ -133,18 +140,34 @@ class _DiamondConnection(object):
             callback()
 
     @gen.engine
-    def get_result(self, callback=None):
+    def get_results(self, callback=None):
+        '''Return a list of search results.  If the search has finished,
+        the list ends with None.'''
         if callback is not None and self._finished:
-            callback(None)
+            callback([None])
             return
-        reply = yield gen.Task(self.blast.get_object)
-        object = dict((attr.name, attr.value) for attr in reply.attrs)
-        if not object:
-            # End of search
-            self._finished = True
-            object = None
+        if self._batched:
+            try:
+                request = XDR_blast_request(max_objects=BLAST_BATCH_OBJECTS,
+                        max_bytes=BLAST_BATCH_BYTES)
+                reply = yield gen.Task(self.blast.get_objects, request)
+                replies = reply.objects
+            except RPCProcedureUnavailable:
+                # Older server; fall back to one object per request
+                self._batched = False
+        if not self._batched:
+            replies = [(yield gen.Task(self.blast.get_object))]
+        objects = []
+        for reply in replies:
+            object = dict((attr.name, attr.value) for attr in reply.attrs)
+            if not object:
+                # End of search
+                self._finished = True
+                objects.append(None)
+                break
+            objects.append(object)
         if callback is not None:
-            callback(object)
+            callback(objects)
 
     @gen.engine
     def evaluate(self, cookies, filters, blob, attrs=None, callback=None):
@@ -214,7 +237,7 @@ class _DiamondBlastSet(object):
         searching.'''
         while not self._paused:
             try:
-                obj = yield gen.Task(conn.get_result)
+                objs = yield gen.Task(conn.get_results)
             except ConnectionFailure:
                 return
             except RPCError:
@@ -222,18 +245,19 @@ class _DiamondBlastSet(object):
                 conn.close()
                 return
 
-            if obj is None:
-                # Connection has finished searching
-                self._connections.discard(conn)
-                self._blocking.discard(conn)
-                if (self._finished_callback is not None
-                        and not self._connections):
-                    # All connections have finished searching
-                    self._finished_callback()
-                return
-
-            if self._object_callback is not None:
-                self._object_callback(obj)
+            for obj in objs:
+                if obj is None:
+                    # Connection has finished searching
+                    self._connections.discard(conn)
+                    self._blocking.discard(conn)
+                    if (self._finished_callback is not None
+                            and not self._connections):
+                        # All connections have finished searching
+                        self._finished_callback()
+                    return
+
+                if self._object_callback is not None:
+                    self._object_callback(obj)
         self._blocking.add(conn)
 
 
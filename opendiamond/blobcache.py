@@ -99,15 +99,25 @@ class BlobCache(object):
 
     def add(self, data):
         '''Add the specified data to the cache.'''
-        hash = sha256(data)
-        sig = hash.hexdigest()
+        return self.add_stream([data])
+
+    def add_stream(self, chunks):
+        '''Add the data formed by concatenating the strings or buffers in
+        the iterable to the cache, without holding all of it in memory.
+        Each chunk is written before the next one is requested.'''
+        hash = sha256()
         # NamedTemporaryFile always deletes the file on close on Python 2.5,
         # so we can't use it
         fd, name = mkstemp(dir=self.basedir)
         try:
             temp = os.fdopen(fd, 'r+')
-            temp.write(data)
-            temp.close()
+            try:
+                for chunk in chunks:
+                    hash.update(chunk)
+                    temp.write(chunk)
+            finally:
+                temp.close()
+            sig = hash.hexdigest()
             os.chmod(name, 0400)
             try:
                 os.link(name, self._path(sig))
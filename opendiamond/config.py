@@ -98,10 +98,23 @@ class DiamondConfig(object):
         # Define configuration parameters
         params = _ConfigParams(
             ## diamondd
+            # Maximum bytes of accepted objects waiting to be sent to the
+            # client
+            _Param('blast_queue_bytes', 'BLASTQUEUEBYTES', 64 << 20),
+            # Maximum accepted objects waiting to be sent to the client
+            _Param('blast_queue_depth', 'BLASTQUEUE', 256),
             # Cache directory expiration
             _Param('blob_cache_days', 'BLOBDAYS', 30),
+            # Objects per worker batch for coalesced cache lookups and
+            # batched filter evaluation
+            _Param('cache_batch_size', 'CACHEBATCH', 1),
             # Redis database
             _Param('cache_database', 'CACHEDB', 0),
+            # Format of new result cache entries: "json" or "binary"
+            _Param('cache_encoding', 'CACHEENCODING', 'json'),
+            # Bytes of cache entries to keep in memory in each search
+            # process; 0 to disable
+            _Param('cache_lru_bytes', 'CACHELRUBYTES', 32 << 20),
             # Redis password
             _Param('cache_password', 'CACHEPASSWD', None),
             # Redis host and port
@@ -121,6 +134,23 @@ class DiamondConfig(object):
             _Param('debug_command', None, 'valgrind'),
             # Names or signatures of filters to run under a debugger
             _Param('debug_filters', None, []),
+            # Memory limit for idle pooled filter processes
+            _Param('filter_pool_bytes', 'FILTERPOOLBYTES', 1 << 30),
+            # Seconds before an idle pooled filter process is killed
+            _Param('filter_pool_idle', 'FILTERPOOLIDLE', 600),
+            # Maximum idle filter processes to keep for reuse by later
+            # searches; 0 to disable
+            _Param('filter_pool_size', 'FILTERPOOLSIZE', 0),
+            # Objects each worker thread processes between reorderings of
+            # the filter stack by observed filter cost and selectivity; 0
+            # to always run filters in dependency order
+            _Param('filter_reorder_interval', 'FILTERREORDER', 0),
+            # Size of the shared memory segment for passing attribute
+            # values to and from each filter process; 0 to disable
+            _Param('filter_shm_bytes', 'FILTERSHM', 0),
+            # Concurrent HTTP requests per dataretriever host, shared by all
+            # worker threads; 0 for one connection per thread
+            _Param('http_host_connections', 'HTTP_CONNECTIONS', 0),
             # Number of days of logfiles to keep
             _Param('logdays', 'LOGDAYS', 14),
             # Directory for logfiles
@@ -129,6 +159,17 @@ class DiamondConfig(object):
             _Param('oneshot', None, False),
             # HTTP proxy
             _Param('http_proxy', 'HTTP_PROXY', None),
+            # Maximum bytes of object data to load ahead of worker threads
+            _Param('prefetch_bytes', 'PREFETCH_BYTES', 64 << 20),
+            # Maximum objects to load ahead of worker threads; 0 to disable
+            _Param('prefetch_depth', 'PREFETCH_DEPTH', 0),
+            # Objects per chunk claimed by each server from scope lists
+            # shared by work stealing
+            _Param('scope_claim_size', 'SCOPECLAIM', 64),
+            # Maximum scope lists to fetch concurrently
+            _Param('scope_fetches', 'SCOPEFETCHES', 8),
+            # Maximum objects to read ahead from each scope list
+            _Param('scope_queue_depth', 'SCOPEQUEUE', 4096),
             # Canonical server names
             _Param('serverids', 'SERVERID', []),
             # Worker threads per child process
@@ -148,6 +189,9 @@ class DiamondConfig(object):
             _Param('dataroot', 'DATAROOT'),
             # Diamond store: root index directory
             _Param('indexdir', 'INDEXDIR'),
+            # Diamond store: order of objects in scope lists: "index" for
+            # index file order, or "inode" to sort by inode number
+            _Param('dataorder', 'DATAORDER', 'index'),
             # Flickr store: API key
             _Param('flickr_api_key', 'FLICKR_KEY'),
             # Mirage store: repository path
@@ -235,6 +279,11 @@ class DiamondConfig(object):
             except ValueError:
                 raise DiamondConfigError('Invalid port number: ' + port)
             self.cache_server = (host, port)
+        if self.cache_encoding not in ('json', 'binary'):
+            raise DiamondConfigError('Invalid cache encoding: ' +
+                                    self.cache_encoding)
+        if self.dataorder not in ('index', 'inode'):
+            raise DiamondConfigError('Invalid data order: ' + self.dataorder)
 
         # Canonicalize debug options
         self.debug_filters = set(self.debug_filters)
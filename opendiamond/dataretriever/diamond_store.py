@@ -25,18 +25,41 @@ from opendiamond.dataretriever.util import guess_mime_type
 from opendiamond.config import DiamondConfig
 from wsgiref.util import shift_path_info
 from urllib import quote
+from urlparse import parse_qs
+from itertools import islice
+from tempfile import mkstemp
+from threading import Lock
 import rfc822
 import os
 import re
+import struct
+import zlib
 
 __all__ = ['scope_app', 'object_app']
 baseurl = 'collection'
 
+# The byte offset of each entry in an index file is cached in a sidecar
+# file alongside it, so that a scope list can report its object count
+# without first reading the whole index, and can be served in ranges.  The
+# sidecar begins with a header recording the mtime and size of the index
+# file it describes, followed by a 64-bit offset for each entry.
+OFFSETS_MAGIC = 'GIDIDXO1'
+offsets_header = struct.Struct('>8sdQQ')	# magic, mtime, size, count
+offset_entry = struct.Struct('>Q')
+
+# Inode-ordered copies of index files are built by one request at a time,
+# and requests waiting for a copy use the one just built.  Indexes whose
+# copies could not be written are remembered along with their mtimes, so
+# that requests do not retry the build until the index changes.
+inode_index_lock = Lock()
+inode_index_failed = {}
+
 
 def init(config):
-    global INDEXDIR, DATAROOT
+    global INDEXDIR, DATAROOT, DATAORDER
     INDEXDIR = config.indexdir
     DATAROOT = config.dataroot
+    DATAORDER = config.dataorder
 
 def diamond_textattr(path):
     try: # read attributes from '.text_attr' file
@@ -47,20 +70,221 @@ def diamond_textattr(path):
     except IOError:
 	pass
 
-def GIDIDXParser(index):
-    f = open(index, 'r')
-    nentries = 0
-    for line in f:
-	nentries = nentries + 1
-    f.close();
+# Return the path to a copy of the index file with its entries sorted by
+# inode number, so that the objects are read from disk mostly sequentially.
+# The copy is kept alongside the index and rebuilt when the index changes.
+# Fall back to the index itself if the copy cannot be written.
+def inode_ordered_index(index):
+    sorted_index = index + '.inode'
+    def current():
+	# Return the path to serve if no build is needed, else None
+	try:
+	    mtime = os.stat(index).st_mtime
+	except OSError:
+	    # Let the caller report the missing index
+	    return index
+	try:
+	    if os.stat(sorted_index).st_mtime >= mtime:
+		return sorted_index
+	except OSError:
+	    pass
+	if inode_index_failed.get(index) == mtime:
+	    return index
+	return None
+
+    path = current()
+    if path is not None:
+	return path
+    with inode_index_lock:
+	path = current()
+	if path is not None:
+	    return path
+	return build_inode_ordered_index(index, sorted_index)
+
+# Write the inode-ordered copy of the index file.  inode_index_lock must be
+# held.
+def build_inode_ordered_index(index, sorted_index):
+    mtime = os.stat(index).st_mtime
+    entries = []
+    for line in open(index):
+	try:
+	    ino = os.stat(os.path.join(DATAROOT, line.strip())).st_ino
+	except OSError:
+	    ino = 0
+	if not line.endswith('\n'):
+	    line += '\n'
+	entries.append((ino, line))
+    entries.sort()
+
+    try:
+	fd, tmp = mkstemp(dir=os.path.dirname(sorted_index),
+			  prefix=os.path.basename(index) + '.')
+	f = os.fdopen(fd, 'w')
+	try:
+	    for ino, line in entries:
+		f.write(line)
+	finally:
+	    f.close()
+	os.rename(tmp, sorted_index)
+    except (IOError, OSError):
+	inode_index_failed[index] = mtime
+	return index
+    inode_index_failed.pop(index, None)
+    return sorted_index
+
+# Return (file, count) for the offsets sidecar of the index file if it is
+# current, else None.
+def open_offsets(index):
+    try:
+	st = os.stat(index)
+	f = open(index + '.offsets', 'rb')
+    except (IOError, OSError):
+	return None
+    header = f.read(offsets_header.size)
+    if len(header) == offsets_header.size:
+	magic, mtime, size, count = offsets_header.unpack(header)
+	if magic == OFFSETS_MAGIC and mtime == st.st_mtime and \
+		size == st.st_size:
+	    return f, count
+    f.close()
+    return None
+
+# Return the byte offset of entry i in the index file
+def entry_offset(offsets, i):
+    f = offsets[0]
+    f.seek(offsets_header.size + i * offset_entry.size)
+    return offset_entry.unpack(f.read(offset_entry.size))[0]
+
+# Pass through the lines of the index file, writing its offsets sidecar as
+# we go.  The sidecar is only installed if all of the lines are consumed.
+def write_offsets(index, lines):
+    st = os.stat(index)
+    path = index + '.offsets'
+    try:
+	fd, tmp = mkstemp(dir=os.path.dirname(path),
+			  prefix=os.path.basename(path) + '.')
+	out = os.fdopen(fd, 'wb')
+    except (IOError, OSError):
+	# Index directory is not writable
+	for line in lines:
+	    yield line
+	return
+
+    installed = False
+    try:
+	out.write(offsets_header.pack('', 0, 0, 0))
+	offset = count = 0
+	for line in lines:
+	    out.write(offset_entry.pack(offset))
+	    offset += len(line)
+	    count += 1
+	    yield line
+	if offset == st.st_size:
+	    out.seek(0)
+	    out.write(offsets_header.pack(OFFSETS_MAGIC, st.st_mtime,
+					  st.st_size, count))
+	    out.close()
+	    os.rename(tmp, path)
+	    installed = True
+    finally:
+	if not installed:
+	    out.close()
+	    try:
+		os.unlink(tmp)
+	    except OSError:
+		pass
+
+# Build any missing or stale sidecars for the index files in INDEXDIR,
+# including inode-ordered copies if configured, and raise IOError if one
+# cannot be written.  Run by "dataretriever --prepare" after indexes are
+# updated, so that scope requests need not build them.
+def prepare():
+    for name in sorted(os.listdir(INDEXDIR)):
+	if not name.startswith('GIDIDX') or '.' in name:
+	    continue
+	index = os.path.join(INDEXDIR, name)
+	if DATAORDER == 'inode':
+	    index = inode_ordered_index(index)
+	offsets = open_offsets(index)
+	if offsets is None:
+	    for line in write_offsets(index, open(index, 'r')):
+		pass
+	    offsets = open_offsets(index)
+	    if offsets is None:
+		raise IOError("Couldn't write offsets for " + index)
+	offsets[0].close()
+
+# Generate the scope list for entries [start, start + limit) of the index
+# file, or for shard (part, nparts, partition) of it.  partition is 'range'
+# to serve a contiguous slice of the index, or 'hash' to serve the objects
+# whose paths hash to the shard.  If the offsets sidecar is missing or
+# stale, a full scope list is streamed immediately and the sidecar is
+# rebuilt along the way, but the count is not known until the end of the
+# list, so clients cannot report progress until then; a range first
+# rebuilds the sidecar.  A hash shard's count is likewise only sent at the
+# end.  Early counts for full scope lists therefore require a current
+# sidecar, which prepare() builds ahead of time.
+def GIDIDXParser(index, start=0, limit=None, shard=None):
+    hashed = shard is not None and shard[2] == 'hash'
+    ranged = not hashed and (start > 0 or limit is not None or
+					shard is not None)
+    offsets = open_offsets(index)
+    if offsets is None and ranged:
+	for line in write_offsets(index, open(index, 'r')):
+	    pass
+	offsets = open_offsets(index)
 
     f = open(index, 'r')
+    if offsets is not None:
+	total = offsets[1]
+    elif ranged:
+	# Couldn't write the sidecar
+	total = 0
+	for line in f:
+	    total += 1
+	f.seek(0)
+    if not ranged:
+	if offsets is not None:
+	    lines = f
+	    nentries = total
+	else:
+	    lines = write_offsets(index, f)
+	    nentries = None
+    else:
+	if shard is not None:
+	    part, nparts = shard[:2]
+	    start = total * part // nparts
+	    limit = total * (part + 1) // nparts - start
+	elif limit is None:
+	    limit = total
+	nentries = max(min(total - start, limit), 0)
+	if offsets is not None:
+	    if nentries > 0:
+		f.seek(entry_offset(offsets, start))
+	    lines = islice(f, nentries)
+	else:
+	    lines = islice(f, start, start + nentries)
+    if offsets is not None:
+	offsets[0].close()
+    if hashed:
+	part, nparts = shard[:2]
+	lines = (path for path in lines
+		if (zlib.crc32(path.strip()) & 0xffffffff) % nparts == part)
+	nentries = None
+
     yield '<?xml version="1.0" encoding="UTF-8" ?>\n'
     if STYLE:
 	yield '<?xml-stylesheet type="text/xsl" href="/scopelist.xsl" ?>\n'
-    yield '<objectlist count="%d">\n' % nentries
-    for path in f:
+    if nentries is not None:
+	yield '<objectlist count="%d">\n' % nentries
+    else:
+	yield '<objectlist>\n'
+    count = 0
+    for path in lines:
+	count += 1
 	yield '<object src="%s/%s" />\n' % (OBJECT_URI, quote(path.strip()))
+    if nentries is None:
+	yield '<count adjust="%d" />\n' % count
     yield '</objectlist>'
     f.close()
 
@@ -72,9 +296,33 @@ def scope_app(environ, start_response):
 
     index = 'GIDIDX' + root.upper()
     index = os.path.join(INDEXDIR, index)
+    if DATAORDER == 'inode':
+	index = inode_ordered_index(index)
+
+    # Optional range of entries, or shard of the index, to serve.  Shards
+    # are specified as "shard=<i>of<n>", counting from 1.
+    query = parse_qs(environ.get('QUERY_STRING', ''))
+    try:
+	start = int(query.get('start', ['0'])[0])
+	limit = query.get('limit')
+	if limit is not None:
+	    limit = int(limit[0])
+	if start < 0 or (limit is not None and limit < 0):
+	    raise ValueError()
+	shard = query.get('shard')
+	if shard is not None:
+	    part, nparts = map(int, shard[0].split('of'))
+	    partition = query.get('partition', ['range'])[0]
+	    if (not 0 < part <= nparts or partition not in ('range', 'hash') or
+			'start' in query or 'limit' in query):
+		raise ValueError()
+	    shard = (part - 1, nparts, partition)
+    except ValueError:
+	start_response("400 Bad Request", [('Content-Type', "text/plain")])
+	return ["Invalid range\n"]
 
     start_response("200 OK", [('Content-Type', "text/xml")])
-    return GIDIDXParser(index)
+    return GIDIDXParser(index, start, limit, shard)
 
 
 # Get file handle and attributes for a Diamond object
@@ -12,8 +12,10 @@
 
 from __future__ import with_statement
 from cStringIO import StringIO
+import mmap
 import os
 import PIL.Image
+import struct
 import sys
 from tempfile import mkstemp
 import threading
@@ -24,6 +26,10 @@ from opendiamond.attributes import (StringAttributeCodec,
         PatchesAttributeCodec, HeatMapAttributeCodec)
 
 EXAMPLE_DIR = 'examples'
+# Highest filter protocol version we support
+PROTOCOL_VERSION = 2
+# If shared memory is in use, send values at least this long through it
+SHM_THRESHOLD = 65536
 
 class Session(object):
     '''Represents the Diamond search session.'''
@@ -78,6 +84,16 @@ class Filter(object):
     # Set to True to decode example images from the blob argument and set
     # self.examples to a list of PIL.Image.
     load_examples = False
+    # Names of object attributes read for every object.  Diamond will send
+    # them along with each object, avoiding a round trip per attribute, if
+    # the server supports protocol version 2.
+    # Can be overridden by the constructor, e.g. based on filter arguments.
+    prefetch_attrs = ()
+    # Maximum number of objects to pass to evaluate_batch() at once.  If
+    # greater than 1, evaluate_batch() is called instead of __call__(), and
+    # Diamond sends objects in batches if the server supports protocol
+    # version 2.  Otherwise each batch contains one object.
+    batch_size = 1
 
     def __init__(self, args, blob, session=Session('filter')):
         '''Called to initialize the filter.  After a subclass calls the
@@ -109,6 +125,14 @@ class Filter(object):
         search score.'''
         raise NotImplementedError()
 
+    def evaluate_batch(self, objects):
+        '''Called with a list of up to batch_size objects to be evaluated if
+        batch_size is greater than 1.  Returns a sequence of Diamond search
+        scores, one per object.  The default implementation calls
+        __call__() on each object; override this to evaluate the objects
+        together, e.g. with vectorized NumPy operations.'''
+        return [self(obj) for obj in objects]
+
     def load_egg(self, module=None, globals=None, data=None):
         '''Treat data as the contents of an egg and add it to the Python
         path.  If data is not specified, self.blob will be used.  As a
@@ -170,6 +194,7 @@ class Filter(object):
             name = conn.get_item()
             args = conn.get_array()
             blob = conn.get_item()
+            conn.negotiate()
             session = Session(name, conn)
             if classes is not None:
                 # Use the class named by the first filter argument
@@ -184,22 +209,45 @@ class Filter(object):
             else:
                 filter_class = cls
             filter = filter_class(args, blob, session)
+            conn.prefetch(filter.prefetch_attrs)
+            batching = filter.batch_size > 1 and conn.version >= 2
+            if batching:
+                conn.send_message('set-batch-size', filter.batch_size)
             conn.send_message('init-success')
 
             # Main loop
-            while True:
-                obj = _DiamondObject(conn)
-                result = filter(obj)
-                if result is True:
-                    result = 1
-                elif result is False or result is None:
-                    result = 0
-                conn.send_message('result', result)
-                obj.invalidate()
+            if batching:
+                while True:
+                    objs = [_DiamondObject(conn, attrs, i) for i, attrs in
+                                        enumerate(conn.next_batch())]
+                    results = filter.evaluate_batch(objs)
+                    conn.send_message('batch-result',
+                                        [_score(r) for r in results])
+                    for obj in objs:
+                        obj.invalidate()
+            else:
+                while True:
+                    attrs = conn.next_object()
+                    obj = _DiamondObject(conn, attrs)
+                    if filter.batch_size > 1:
+                        result, = filter.evaluate_batch([obj])
+                    else:
+                        result = filter(obj)
+                    conn.send_message('result', _score(result))
+                    obj.invalidate()
         except IOError:
             pass
 
 
+def _score(result):
+    '''Convert the return value of a filter to a score.'''
+    if result is True:
+        return 1
+    elif result is False or result is None:
+        return 0
+    return result
+
+
 class LingeringObjectError(Exception):
     '''Raised when an Object is accessed after it is no longer in play.'''
     pass
@@ -354,19 +402,21 @@ class Object(object):
 class _DiamondObject(Object):
     '''A Diamond object to be evaluated.'''
 
-    def __init__(self, conn):
-        Object.__init__(self)
+    def __init__(self, conn, attrs=(), index=None):
+        Object.__init__(self, attrs)
         self._conn = conn
+        self._index = index	# Position in the current batch, if any
 
     def _get_attribute(self, key):
-        self._conn.send_message('get-attribute', key)
+        self._conn.send_object_message(self._index, 'get-attribute', key)
         return self._conn.get_item()
 
     def _set_attribute(self, key, value):
-        self._conn.send_message('set-attribute', key, value)
+        self._conn.send_object_message(self._index, 'set-attribute', key,
+                                        value)
 
     def _omit_attribute(self, key):
-        self._conn.send_message('omit-attribute', key)
+        self._conn.send_object_message(self._index, 'omit-attribute', key)
         if not self._conn.get_boolean():
             raise KeyError()
 
@@ -374,13 +424,103 @@ class _DiamondObject(Object):
 class _DiamondConnection(object):
     '''Proxy object for the stdin/stdout protocol connection with the
     Diamond server.'''
+
+    _length = struct.Struct('>i')
+    _shm_ref = struct.Struct('>QQ')
+    SHM_ITEM = -2
+
     def __init__(self, fin, fout):
         self._fin = fin
         self._fout = fout
         self._output_lock = threading.Lock()
+        self._version = 1
+        self._shm = None	# Shared memory segment, if in use
+        self._shm_base = 0	# Start of our half of the segment
+        self._shm_offset = 0	# Next free byte in our half
+        self._prefetch = ()	# Attribute names sent with each object
+        self._selected = 0	# Index of the selected object in the batch
+
+    @property
+    def version(self):
+        '''The negotiated protocol version.'''
+        return self._version
+
+    def negotiate(self):
+        '''Switch to the highest protocol version supported by both us and
+        the server.'''
+        versions = os.environ.get('DIAMOND_FILTER_PROTOCOLS', '1').split(',')
+        versions = [int(v) for v in versions if v.isdigit()]
+        versions = [v for v in versions if v <= PROTOCOL_VERSION]
+        if versions and max(versions) > self._version:
+            with self._output_lock:
+                # Send in the old protocol, then switch
+                self._send_message('set-protocol-version', max(versions))
+                self._version = max(versions)
+        if self._version >= 2:
+            self._map_shared_memory()
+
+    def _map_shared_memory(self):
+        '''Map the shared memory segment offered by the server, if any, and
+        tell the server that we're using it.'''
+        try:
+            path, size = os.environ['DIAMOND_FILTER_SHM'].rsplit(':', 1)
+            size = int(size)
+            fd = os.open(path, os.O_RDWR)
+            try:
+                shm = mmap.mmap(fd, size)
+            finally:
+                os.close(fd)
+        except (KeyError, ValueError, EnvironmentError):
+            return
+        with self._output_lock:
+            self._send_message('use-shared-memory')
+            self._shm = shm
+            self._shm_base = self._shm_offset = size // 2
+
+    def prefetch(self, names):
+        '''Ask the server to send the specified attributes with each
+        object.  Protocol version 1 doesn't support this, so the attributes
+        are then fetched on demand.'''
+        names = list(names)
+        if names and self._version >= 2:
+            self.send_message('prefetch-attributes', names)
+            self._prefetch = names
+
+    def next_object(self):
+        '''Tell the server that we're starting a new object, if the
+        protocol requires it.  Return a dict of the prefetched attributes,
+        with None for those not present in the object.'''
+        if self._shm is None and not self._prefetch:
+            return {}
+        self.send_message('next-object')
+        attrs = dict.fromkeys(self._prefetch)
+        names = self.get_array()
+        attrs.update(zip(names, self.get_array()))
+        # The server has read everything we sent for the previous object
+        with self._output_lock:
+            self._shm_offset = self._shm_base
+        return attrs
+
+    def next_batch(self):
+        '''Ask the server for the next batch of objects.  Return a list
+        containing a dict of the prefetched attributes of each object.'''
+        self.send_message('next-batch')
+        batch = []
+        for _i in xrange(int(self.get_item())):
+            attrs = dict.fromkeys(self._prefetch)
+            names = self.get_array()
+            attrs.update(zip(names, self.get_array()))
+            batch.append(attrs)
+        # The server has read everything we sent for the previous batch
+        with self._output_lock:
+            self._shm_offset = self._shm_base
+            self._selected = 0
+        return batch
 
     def get_item(self):
         '''Read and return a string or blob.'''
+        if self._version != 1:
+            return self._get_item_binary()
         sizebuf = self._fin.readline()
         if len(sizebuf) == 0:
             # End of file
@@ -396,6 +536,27 @@ class _DiamondConnection(object):
         self._fin.read(1)
         return item
 
+    def _get_item_binary(self):
+        sizebuf = self._fin.read(self._length.size)
+        if len(sizebuf) != self._length.size:
+            raise IOError('End of input stream')
+        size, = self._length.unpack(sizebuf)
+        if size == self.SHM_ITEM:
+            buf = self._fin.read(self._shm_ref.size)
+            if len(buf) != self._shm_ref.size:
+                raise IOError('Short read from stream')
+            offset, length = self._shm_ref.unpack(buf)
+            if self._shm is None or offset + length > self._shm_base:
+                raise IOError('Bad shared memory reference')
+            return self._shm[offset:offset + length]
+        elif size < 0:
+            # No data
+            return None
+        item = self._fin.read(size)
+        if len(item) != size:
+            raise IOError('Short read from stream')
+        return item
+
     def get_array(self):
         '''Read and return an array of strings or blobs.'''
         arr = []
@@ -412,19 +573,49 @@ class _DiamondConnection(object):
         '''Atomically sends a message, consisting of a tag followed by one
         or more values.  An argument can be a list or tuple, in which case
         it is serialized as an array of values terminated by a blank line.'''
-        def send_value(value):
-            value = str(value)
-            self._fout.write('%d\n%s\n' % (len(value), value))
         with self._output_lock:
+            self._send_message(tag, *values)
+
+    def send_object_message(self, index, tag, *values):
+        '''Atomically send a message concerning the object at the specified
+        index in the current batch, or the current object if index is
+        None.'''
+        with self._output_lock:
+            if index is not None and index != self._selected:
+                self._send_message('select-object', index)
+                self._selected = index
+            self._send_message(tag, *values)
+
+    def _send_message(self, tag, *values):
+        if self._version == 1:
+            def send_value(value):
+                value = str(value)
+                self._fout.write('%d\n%s\n' % (len(value), value))
+            blank = '\n'
             self._fout.write('%s\n' % tag)
-            for value in values:
-                if isinstance(value, list) or isinstance(value, tuple):
-                    for el in value:
-                        send_value(el)
-                    self._fout.write('\n')
+        else:
+            def send_value(value):
+                value = str(value)
+                offset = self._shm_offset
+                if (self._shm is not None and len(value) >= SHM_THRESHOLD
+                        and offset + len(value) <= len(self._shm)):
+                    self._shm[offset:offset + len(value)] = value
+                    self._shm_offset += len(value)
+                    self._fout.write(self._length.pack(self.SHM_ITEM))
+                    self._fout.write(self._shm_ref.pack(offset, len(value)))
                 else:
-                    send_value(value)
-            self._fout.flush()
+                    self._fout.write(self._length.pack(len(value)))
+                    self._fout.write(value)
+            blank = self._length.pack(-1)
+            send_value(tag)
+        for value in values:
+            if isinstance(value, list) or isinstance(value, tuple):
+                for el in value:
+                    send_value(el)
+                self._fout.write(blank)
+            else:
+                send_value(value)
+        self._fout.flush()
 
 
 class _StdoutThread(threading.Thread):
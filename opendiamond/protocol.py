@@ -53,6 +53,21 @@ class XDR_object(XDRStruct):
     )
 
 
+class XDR_blast_request(XDRStruct):
+    '''Batched blast channel request'''
+    members = (
+        'max_objects', XDR.uint(),
+        'max_bytes', XDR.uint(),
+    )
+
+
+class XDR_object_list(XDRStruct):
+    '''Batched blast channel object data'''
+    members = (
+        'objects', XDR.array(XDR.struct(XDR_object)),
+    )
+
+
 class XDR_blob_list(XDRStruct):
     '''A list of blob URIs'''
     members = (
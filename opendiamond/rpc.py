@@ -15,6 +15,7 @@
 from __future__ import with_statement
 import logging
 import socket
+import struct
 import threading
 
 from opendiamond.xdr import XDR, XDRStruct, XDREncodingError
@@ -23,6 +24,10 @@ _log = logging.getLogger(__name__)
 
 RPC_PENDING = -1
 
+# Messages up to this size are received into a per-connection buffer which
+# is reused for each message
+RECV_BUFFER_SIZE = 65536
+
 class ConnectionFailure(Exception):
     '''RPC connection died.'''
 
@@ -67,16 +72,64 @@ class RPCHeader(XDRStruct):
 
 
 class _RPCRequest(object):
-    '''The header and data from an RPC request.'''
+    '''The header from an RPC request.'''
 
-    def __init__(self, hdr, data):
+    def __init__(self, hdr):
         self.hdr = hdr
-        self.data = data
 
-    def make_reply_header(self, status, data):
+    def make_reply_header(self, status, datalen):
         '''Return the header for an RPC reply.'''
         return RPCHeader(sequence=self.hdr.sequence, status=status,
-                            cmd=self.hdr.cmd, datalen=len(data))
+                            cmd=self.hdr.cmd, datalen=datalen)
+
+
+class RPCStream(object):
+    '''The body of an RPC request, read incrementally from the connection.
+    Passed to handlers declared with stream=True.  Reading past the end of
+    the body raises EOFError.'''
+
+    _uint = struct.Struct('>I')
+
+    def __init__(self, conn, length):
+        self._conn = conn
+        self.remaining = length
+
+    # The connection lock is held while the handler runs
+    # pylint: disable=protected-access
+    def read_buffer(self, count):
+        '''Return the next count bytes of the body as a buffer object,
+        which is only valid until the next read.'''
+        if count > self.remaining:
+            raise EOFError()
+        self.remaining -= count
+        return self._conn._read_bytes(count)
+    # pylint: enable=protected-access
+
+    def read(self, count):
+        '''Return the next count bytes of the body as a string.'''
+        return str(self.read_buffer(count))
+
+    def read_uint(self):
+        '''Read an XDR unsigned integer.'''
+        return self._uint.unpack(self.read_buffer(4))[0]
+
+    def read_chunks(self, count):
+        '''Yield the next count bytes of the body as a series of buffer
+        objects, each of which is only valid until the next one is
+        read.'''
+        while count > 0:
+            chunk = min(count, RECV_BUFFER_SIZE)
+            yield self.read_buffer(chunk)
+            count -= chunk
+
+    def skip(self, count):
+        '''Discard the next count bytes of the body.'''
+        for _chunk in self.read_chunks(count):
+            pass
+
+    def discard(self):
+        '''Discard the rest of the body.'''
+        self.skip(self.remaining)
 
 
 class RPCConnection(object):
@@ -85,37 +138,72 @@ class RPCConnection(object):
     def __init__(self, sock):
         self._sock = sock
         self._lock = threading.Lock()
+        self._buf = bytearray(RECV_BUFFER_SIZE)
+        # Cleared if the socket turns out not to support TCP_CORK, e.g.
+        # because it isn't a TCP socket
+        self._cork = hasattr(socket, 'TCP_CORK')
+
+    def _cork_socket(self, enable):
+        '''Set TCP_CORK on the socket.  Return False if the socket doesn't
+        support it.'''
+        try:
+            self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK,
+                                    int(enable))
+            return True
+        except socket.error:
+            self._cork = False
+            return False
+
+    def _read_bytes(self, count):
+        '''self._lock must be held.  Read directly into the receive buffer,
+        or into a new buffer of the right size if count is too large, and
+        return a read-only view of the data.  Slicing the view produces
+        strings, so XDR decoders can use it in place of a string.'''
+        if count <= len(self._buf):
+            buf = self._buf
+        else:
+            buf = bytearray(count)
+        view = memoryview(buf)
+        offset = 0
+        try:
+            while offset < count:
+                new = self._sock.recv_into(view[offset:count])
+                if new == 0:
+                    self._sock.close()
+                    raise ConnectionFailure('Short read')
+                offset += new
+        except socket.error, e:
+            self._sock.close()
+            raise ConnectionFailure(str(e))
+        return buffer(buf, 0, count)
 
     def _receive(self):
-        '''self._lock must be held.'''
-        def read_bytes(count):
-            bufs = []
-            try:
-                while count > 0:
-                    new = self._sock.recv(count)
-                    if len(new) == 0:
-                        self._sock.close()
-                        raise ConnectionFailure('Short read')
-                    count -= len(new)
-                    bufs.append(new)
-            except socket.error, e:
-                self._sock.close()
-                raise ConnectionFailure(str(e))
-            return ''.join(bufs)
-
+        '''self._lock must be held.  Return the header of the next request;
+        the caller must then consume its body.'''
         while True:
-            hdr = RPCHeader.decode(read_bytes(RPCHeader.ENCODED_LENGTH))
-            data = read_bytes(hdr.datalen)
-            # We only handle request traffic; ignore reply messages
+            hdr = RPCHeader.decode(self._read_bytes(RPCHeader.ENCODED_LENGTH))
             if hdr.status == RPC_PENDING:
-                return _RPCRequest(hdr, data)
+                return _RPCRequest(hdr)
+            # We only handle request traffic; ignore reply messages
+            RPCStream(self, hdr.datalen).discard()
 
-    def _reply(self, request, status=0, body=''):
-        '''self._lock must be held.'''
+    def _reply(self, request, status=0, body=()):
+        '''self._lock must be held.  body is a list of strings.'''
         assert status == 0 or len(body) == 0
-        hdr = request.make_reply_header(status, body).encode()
+        datalen = sum([len(buf) for buf in body])
+        hdr = request.make_reply_header(status, datalen).encode()
         try:
-            self._sock.sendall(hdr + body)
+            if len(body) > 1 and self._cork and self._cork_socket(True):
+                # Send the pieces of the message without joining them,
+                # and without transmitting partial segments in between
+                try:
+                    self._sock.sendall(hdr)
+                    for buf in body:
+                        self._sock.sendall(buf)
+                finally:
+                    self._cork_socket(False)
+            else:
+                self._sock.sendall(hdr + ''.join(body))
         except socket.error, e:
             self._sock.close()
             raise ConnectionFailure(str(e))
@@ -125,6 +213,7 @@ class RPCConnection(object):
         and transmit the reply.'''
         with self._lock:
             req = self._receive()
+            body = RPCStream(self, req.hdr.datalen)
             try:
                 # Look up handler and decode request
                 handler_name = 'Command %d' % req.hdr.cmd
@@ -133,31 +222,39 @@ class RPCConnection(object):
                     handler_name = (handler.im_class.__name__ + '.' +
                                     handler.__name__)
                     if handler.rpc_request_class is not None:
-                        req_obj = handler.rpc_request_class.decode(req.data)
+                        req_obj = handler.rpc_request_class.decode(
+                                body.read_buffer(body.remaining))
                 except KeyError:
                     raise RPCProcedureUnavailable()
                 except (EOFError, XDREncodingError):
                     raise RPCEncodingError()
 
                 # Call handler
-                if handler.rpc_request_class is not None:
+                if handler.rpc_stream:
+                    try:
+                        ret_obj = handler(body)
+                    except EOFError:
+                        raise RPCEncodingError()
+                elif handler.rpc_request_class is not None:
                     ret_obj = handler(req_obj)
                 else:
                     ret_obj = handler()
+                body.discard()
 
                 # Encode reply
                 if ret_obj is None:
                     assert handler.rpc_reply_class is None
-                    ret = ''
+                    ret = []
                 else:
                     assert isinstance(ret_obj, handler.rpc_reply_class)
-                    ret = ret_obj.encode()
+                    ret = ret_obj.encode_iov()
 
                 # Send reply
                 self._reply(req, body=ret)
                 if handlers.log_rpcs:
                     _log.debug('%s => success', handler_name)
             except RPCError, e:
+                body.discard()
                 self._reply(req, status=e.code)
                 if handlers.log_rpcs:
                     _log.debug('%s => %s', handler_name, e.__class__.__name__)
@@ -188,13 +285,17 @@ class RPCHandlers(object):
     log_rpcs = False
 
     @staticmethod
-    def handler(cmd, request_class=None, reply_class=None):
+    def handler(cmd, request_class=None, reply_class=None, stream=False):
         '''Decorator declaring the function to be an RPC handler with the
-        given command number and request class.'''
+        given command number and request class.  If stream is True, the
+        handler is passed an RPCStream for reading the undecoded request
+        body.'''
+        assert not stream or request_class is None
         def decorator(func):
             func.rpc_procedure = cmd
             func.rpc_request_class = request_class
             func.rpc_reply_class = reply_class
+            func.rpc_stream = stream
             return func
         return decorator
 
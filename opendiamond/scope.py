@@ -25,6 +25,8 @@
 #	Serial: <uuid>\n
 #	Expires: <ISO-8601 timestamp>\n
 #	Servers: <server1>;<server2>;<server3>
+#	[Blaster: <url>]
+#	[Partition: consistent-hash | work-stealing]
 #	\n
 #	<scope URLs, one per line>
 
@@ -52,7 +54,7 @@ class ScopeCookieExpired(ScopeError):
 
 class ScopeCookie(object):
     def __init__(self, serial, expires, blaster, servers, scopeurls, data,
-            signature):
+            signature, partition=None):
         '''Do not call this directly; use generate() or parse() instead.'''
         # Ensure the expiration time is tz-aware
         if expires.tzinfo is None or expires.tzinfo.utcoffset(expires) is None:
@@ -60,6 +62,7 @@ class ScopeCookie(object):
         self.serial = serial		# A UUID object
         self.expires = expires		# A datetime object
         self.blaster = blaster		# The URL of the JSON blaster or None
+        self.partition = partition	# Object partitioning scheme or None
         self.servers = servers		# A list
         self.scopeurls = scopeurls	# The list of scope URLs
         self.data = data		# All of the above, as a string
@@ -124,11 +127,14 @@ class ScopeCookie(object):
         raise ScopeError(failure)
 
     @classmethod
-    def generate(cls, servers, scopeurls, expires, keydata, blaster=None):
+    def generate(cls, servers, scopeurls, expires, keydata, blaster=None,
+            partition=None):
         '''Generate and return a new ScopeCookie.  servers and scopeurls
         are lists of strings, already Punycoded/URL-encoded as appropriate.
         expires is a timezone-aware datetime.  keydata is a PEM-encoded
-        private key.  blaster is an optional string, already URL-encoded.'''
+        private key.  blaster is an optional string, already URL-encoded.
+        partition is an optional scheme for dividing the objects among the
+        servers, such as "consistent-hash" or "work-stealing".'''
         # Unicode strings can cause signature validation errors
         servers = [str(s) for s in servers]
         scopeurls = [str(u) for u in scopeurls]
@@ -142,6 +148,9 @@ class ScopeCookie(object):
                    ('Servers', ';'.join(servers))]
         if blaster is not None:
             headers.append(('Blaster', blaster))
+        if partition is not None:
+            partition = str(partition)
+            headers.append(('Partition', partition))
         hdrbuf = ''.join('%s: %s\n' % (k, v) for k, v in headers)
         data = hdrbuf + '\n' + '\n'.join(scopeurls) + '\n'
         # Load the signing key
@@ -151,7 +160,8 @@ class ScopeCookie(object):
         key.sign_update(data)
         sig = key.sign_final()
         # Return the scope cookie
-        return cls(serial, expires, blaster, servers, scopeurls, data, sig)
+        return cls(serial, expires, blaster, servers, scopeurls, data, sig,
+                partition)
 
     @classmethod
     def parse(cls, data):
@@ -180,6 +190,7 @@ class ScopeCookie(object):
             raise ScopeError('Malformed signature')
         # Parse headers
         blaster = None
+        partition = None
         for line in header.splitlines():
             k, v = line.split(':', 1)
             v = v.strip()
@@ -208,13 +219,15 @@ class ScopeCookie(object):
                             if s.strip() != '']
             elif k == 'Blaster':
                 blaster = v
+            elif k == 'Partition':
+                partition = v
         # Parse body
         scopeurls = [s for s in [u.strip() for u in body.split('\n')]
                     if s != '']
         # Build scope cookie object
         try:
             return cls(serial, expires, blaster, servers, scopeurls, data,
-                    signature)
+                    signature, partition)
         except NameError:
             raise ScopeError('Missing cookie header')
 
@@ -225,38 +238,74 @@ class ScopeCookie(object):
 
 
 def generate_cookie(scopeurls, servers, proxies=None, keyfile=None,
-                    expires=None, blaster=None):
+                    expires=None, blaster=None, partition=None):
     '''High-level helper function: generate a scope cookie for the given
     scope URLs and servers and return its encoded form as a string.  keyfile
     defaults to ~/.diamond/key.pem and expiration defaults to one hour.  If
     proxies is provided, divide up the scope list among the specified list
     of proxy servers, produce one scope cookie for each proxy, and return
-    the concatenation of the cookies.'''
-
+    the concatenation of the cookies.
+
+    By default, each proxy fetches the complete scope list through its own
+    dataretriever and keeps its share of the objects.  If the scope URLs
+    refer to the diamond store, partition can instead be "range" or "hash"
+    to have each proxy fetch only its shard directly from the servers: a
+    contiguous slice of the index, or the objects whose paths hash to that
+    proxy.
+
+    If partition is "consistent-hash", produce a single cookie for all of
+    the servers (or proxies, fetching from the servers) and let each
+    diamondd take its share of the objects by consistent hashing, so
+    servers can be added or removed without generating new cookies.  If it
+    is "work-stealing", the servers instead claim chunks of objects from a
+    counter in their shared Redis cache server as they become idle.
+
+    Raise ValueError if partition is not one of these schemes, or if it is
+    "range" or "hash" and no proxies are specified.'''
+
+    if partition not in (None, 'range', 'hash', 'consistent-hash',
+                        'work-stealing'):
+        raise ValueError('Unknown partition scheme: %s' % partition)
+    if partition in ('range', 'hash') and proxies is None:
+        raise ValueError('Partition scheme %s requires proxies' % partition)
     if keyfile is None:
         keyfile = os.path.expanduser(os.path.join('~', '.diamond', 'key.pem'))
     if expires is None:
         expires = timedelta(hours=1)
-    def generate(scopeurls, servers):
+    def generate(scopeurls, servers, partition=None):
         return ScopeCookie.generate(servers, scopeurls,
                                     datetime.now(tzutc()) + expires,
                                     open(keyfile).read(),
-                                    blaster=blaster).encode()
-    if proxies is None:
+                                    blaster=blaster,
+                                    partition=partition).encode()
+    if partition in ('consistent-hash', 'work-stealing'):
+        if proxies is None:
+            return generate(scopeurls, servers, partition)
+        scope = ['http://%s:5873%s' % (server, url)
+                    for url in scopeurls for server in servers]
+        return generate(scope, proxies, partition)
+    elif proxies is None:
         return generate(scopeurls, servers)
     else:
         cookies = []
         n = len(proxies)
         for i in range(n):
-            scope = ['/proxy/%dof%d/%s:5873%s' % (i + 1, n, server, url)
-                        for url in scopeurls for server in servers]
+            if partition is None:
+                scope = ['/proxy/%dof%d/%s:5873%s' % (i + 1, n, server, url)
+                            for url in scopeurls for server in servers]
+            else:
+                scope = ['http://%s:5873%s%sshard=%dof%d&partition=%s' %
+                            (server, url, '&' if '?' in url else '?',
+                            i + 1, n, partition)
+                            for url in scopeurls for server in servers]
             cookies.append(generate(scope, (proxies[i],)))
         return ''.join(cookies)
 
 
 # Don't complain if Django isn't installed on the build system
 # pylint: disable=import-error
-def generate_cookie_django(scopeurls, servers, proxies=None, blaster=None):
+def generate_cookie_django(scopeurls, servers, proxies=None, blaster=None,
+                            partition=None):
     '''A variant of generate_cookie() which pulls the more obscure fixed
     arguments from Django settings.
 
@@ -271,7 +320,8 @@ def generate_cookie_django(scopeurls, servers, proxies=None, blaster=None):
     if expires is not None:
         expires = timedelta(seconds=expires)
     return generate_cookie(scopeurls, servers, proxies=proxies,
-                            keyfile=keyfile, expires=expires, blaster=blaster)
+                            keyfile=keyfile, expires=expires, blaster=blaster,
+                            partition=partition)
 # pylint: enable=import-error
 
 
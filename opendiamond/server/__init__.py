@@ -29,6 +29,9 @@ connection pair.
 temporary directories and killing all of their children (filters and helper
 processes).
 
+4.  If the filter pool is enabled, keeping idle filter processes returned by
+exited search processes and handing them to new ones.
+
 The child is responsible for handling the search.  Initially it has only one
 thread, which is responsible for handling the control connection back to the
 client.  All client RPCs, including search reexecution, are handled in this
@@ -39,12 +42,23 @@ machine) to process objects for the search.
 Several pieces of mutable state are shared between threads.  The control
 thread configures a ScopeListLoader which iterates over the in-scope Diamond
 objects, returning a new object to each worker thread that asks for one.
-The blast channel is also shared.  There are also shared objects for logging
-and for tracking of statistics and session variables.  All of these objects
-have locking to ensure consistency.
-
-Each worker thread maintains a private TCP connection to the Redis server,
-which is used for result and attribute caching.  Each worker thread also
+The ScopeListLoader fetches and parses several scope lists concurrently in
+separate threads, staying a bounded number of objects ahead of the worker
+threads for each scope list and interleaving objects from all of them.
+If prefetching is configured, the ScopeListLoader is wrapped in an
+ObjectPrefetcher, whose threads load object data from the dataretriever a
+bounded number of objects ahead of the worker threads, skipping objects
+that the result cache shows will be dropped.  Accepted objects
+are passed through a bounded queue to a sender thread, which owns the blast
+channel and answers the client's requests for objects.  There are also
+shared objects for logging and for tracking of statistics and session
+variables.  All of these objects have locking to ensure consistency.
+
+Each worker thread, and each prefetch thread, maintains a private TCP
+connection to the Redis server, which is used for result and attribute
+caching.  Cache entries are also
+kept in a bounded in-process LRU cache shared by all worker threads, which
+is consulted before Redis.  Each worker thread also
 maintains one child process for each filter in the filter stack.  These
 children are the actual filter code, and communicate with the worker thread
 via a pair of pipes.  Because each worker thread has its own set of filter
@@ -57,7 +71,9 @@ Each worker thread executes a loop:
 2.  Retrieve result cache entries from Redis.
 
 3.  Walk the result cache entries to determine if a drop decision can be
-made.  If so, drop the object.
+made.  If so, drop the object.  Otherwise, if there is a cached drop
+decision that could not be proven from the cache alone, run only the
+filters it depends on, and drop the object if its inputs are unchanged.
 
 4.  For each filter in the filter chain, determine whether we received a
 valid result cache entry for the filter.  If so, attempt to obtain attribute
@@ -68,8 +84,19 @@ decision, break.
 5.  Transmit new result cache entries, as well as attribute cache entries
 for filters producing less than 2 MB/s of attribute values, to Redis.
 
-6.  If accepting the object, transmit it to the client via the blast
-channel.
+6.  If accepting the object, add it to the blast channel queue, waiting
+only if the queue is full.
+
+If a cache batch size is configured, the worker thread instead obtains
+several objects at once from the ScopeListLoader and coalesces the Redis
+traffic of steps 2, 4, and 5 for the whole batch into one request each.
+Step 4 is then performed one filter at a time across the surviving objects
+of the batch, so that filters declaring batch support can evaluate several
+objects in a single exchange.
+
+If adaptive filter ordering is configured, each worker thread periodically
+reorders the filters in its filter chain, subject to their declared
+dependencies, so that cheap filters which drop many objects run first.
 
 If a filter crashes while processing an object, the object is dropped and
 the filter is restarted.  If a worker thread or the control thread crashes,
@@ -90,11 +117,14 @@ from opendiamond.helpers import daemonize, signalname
 from opendiamond.rpc import RPCConnection, ConnectionFailure
 from opendiamond.server.child import ChildManager
 from opendiamond.server.listen import ConnListener
+from opendiamond.server.pool import FilterPool
 from opendiamond.server.search import Search
 
 SEARCH_LOG_DATE_FORMAT = '%Y-%m-%d-%H:%M:%S'
 SEARCH_LOG_FORMAT = 'search-%s-%d.log'		# Args: date, pid
 SEARCH_LOG_REGEX = r'search-(.+)-[0-9]+\.log$'	# Match group: timestamp
+# Seconds between housekeeping passes while no connections arrive
+IDLE_INTERVAL = 30
 
 _log = logging.getLogger(__name__)
 
@@ -132,8 +162,14 @@ class DiamondServer(object):
             daemonize()
 
         self.config = config
-        self._children = ChildManager(config.cgroupdir, not config.oneshot)
-        self._listener = ConnListener()
+        # Idle filter processes can only be shared between forked children
+        if config.filter_pool_size > 0 and not config.oneshot:
+            self._pool = FilterPool(config)
+        else:
+            self._pool = None
+        self._children = ChildManager(config.cgroupdir, not config.oneshot,
+                                    self._pool)
+        self._listener = ConnListener(self._children.wakeup)
         self._last_log_prune = datetime.fromtimestamp(0)
         self._last_cache_prune = datetime.fromtimestamp(0)
         self._ignore_signals = False
@@ -157,8 +193,7 @@ class DiamondServer(object):
         baselog.addHandler(self._logfile_handler)
 
     # We intentionally catch all exceptions
-    # pylint doesn't understand the conditional return in ConnListener.accept()
-    # pylint: disable=broad-except,unpacking-non-sequence
+    # pylint: disable=broad-except
     def run(self):
         try:
             # Log startup of parent
@@ -168,12 +203,21 @@ class DiamondServer(object):
             if self.config.cache_server:
                 _log.info('Cache: %s:%d', *self.config.cache_server)
             while True:
+                # Clean up after search processes which have exited
+                self._children.reap()
+                # Expire idle filter processes
+                if self._pool is not None:
+                    self._pool.evict()
                 # Check for search logs that need to be pruned
                 self._prune_child_logs()
                 # Check for blob cache objects that need to be pruned
                 self._prune_blob_cache()
-                # Accept a new connection pair
-                control, data = self._listener.accept()
+                # Accept a new connection pair, or None if a search process
+                # has exited or we've been idle for a while
+                conn = self._listener.accept(IDLE_INTERVAL)
+                if conn is None:
+                    continue
+                control, data = conn
                 # Fork a child for this connection pair.  In the child, this
                 # does not return.
                 self._children.start(self._child, control, data)
@@ -196,7 +240,7 @@ class DiamondServer(object):
             # Don't attempt to shut down cleanly; just flush logging buffers
             logging.shutdown()
             sys.exit(1)
-    # pylint: enable=broad-except,unpacking-non-sequence
+    # pylint: enable=broad-except
 
     # We intentionally catch all exceptions
     # pylint: disable=broad-except
@@ -227,7 +271,8 @@ class DiamondServer(object):
                 _log.info('Worker threads: %d', self.config.threads)
                 # Set up connection wrappers and search object
                 control = RPCConnection(control)
-                search = Search(self.config, RPCConnection(data))
+                search = Search(self.config, RPCConnection(data),
+                                    self._pool)
                 # Dispatch RPCs on the control connection until we die
                 while True:
                     control.dispatch(search)
@@ -0,0 +1,63 @@
+#
+#  The OpenDiamond Platform for Interactive Search
+#
+#  Copyright (c) 2011 Carnegie Mellon University
+#  All rights reserved.
+#
+#  This software is distributed under the terms of the Eclipse Public
+#  License, Version 1.0 which can be found in the file named LICENSE.
+#  ANY USE, REPRODUCTION OR DISTRIBUTION OF THIS SOFTWARE CONSTITUTES
+#  RECIPIENT'S ACCEPTANCE OF THIS AGREEMENT
+#
+
+'''In-process tier of the result and attribute caches.'''
+
+from __future__ import with_statement
+from collections import OrderedDict
+import threading
+
+class MemoryCache(object):
+    '''A thread-safe least-recently-used key/value cache holding at most
+    max_bytes bytes of keys and values.  Shared by all worker threads in a
+    search process, in front of the Redis cache.'''
+
+    def __init__(self, max_bytes):
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()	# key -> value, oldest first
+        self._bytes = 0
+
+    def get_multi(self, keys):
+        '''Return a list of the values for the specified keys, with None
+        for keys that are not cached.'''
+        values = []
+        with self._lock:
+            for key in keys:
+                try:
+                    value = self._entries.pop(key)
+                except KeyError:
+                    values.append(None)
+                else:
+                    # Mark as most recently used
+                    self._entries[key] = value
+                    values.append(value)
+        return values
+
+    def set_multi(self, mapping):
+        '''Store the specified key -> value map, evicting least recently
+        used entries as necessary.'''
+        with self._lock:
+            for key, value in mapping.iteritems():
+                size = len(key) + len(value)
+                if size > self._max_bytes:
+                    continue
+                try:
+                    old = self._entries.pop(key)
+                    self._bytes -= len(key) + len(old)
+                except KeyError:
+                    pass
+                self._entries[key] = value
+                self._bytes += size
+            while self._bytes > self._max_bytes:
+                key, value = self._entries.popitem(last=False)
+                self._bytes -= len(key) + len(value)
@@ -12,10 +12,12 @@
 
 '''Forking and monitoring of search processes by supervisor.'''
 
+import errno
 import logging
 import os
 import shutil
 import signal
+import socket
 import sys
 from tempfile import mkdtemp
 import time
@@ -42,6 +44,11 @@ class _SearchChild(object):
             self._cgroupdir = None
             self._taskfile = None
 
+    @property
+    def taskfile(self):
+        '''The tasks file of the child's cgroup, or None.'''
+        return self._taskfile
+
     def start(self):
         '''Fork off the child and return pid in the parent, 0 in the child.'''
         assert not self._started
@@ -115,26 +122,42 @@ class _SearchChild(object):
 
 
 class ChildManager(object):
-    '''The set of forked search processes.'''
+    '''The set of forked search processes.  The SIGCHLD handler only
+    records which children have exited; the supervisor's main loop cleans
+    up after them by calling reap(), which may block.  The wakeup socket
+    becomes readable when there are exited children to reap.'''
 
-    def __init__(self, cgroupdir=None, fork=True):
+    def __init__(self, cgroupdir=None, fork=True, pool=None):
         self._children = dict()
         self._cgroupdir = cgroupdir
         self._fork = fork
+        self._pool = pool	# FilterPool shared with children, or None
+        self._exited = []	# pids reaped by the signal handler
+        self.wakeup, self._wakeup_writer = socket.socketpair(
+                                socket.AF_UNIX, socket.SOCK_STREAM)
+        self.wakeup.setblocking(0)
+        self._wakeup_writer.setblocking(0)
         signal.signal(signal.SIGCHLD, self._child_exited)
 
     def start(self, child_function, *args, **kwargs):
         '''Launch a new search process.'''
         child = _SearchChild(self._cgroupdir, self._fork)
+        if self._pool is not None:
+            pool_entries = self._pool.prepare_fork()
         pid = child.start()
         if pid != 0:
             # Parent
             self._children[pid] = child
+            if self._pool is not None:
+                self._pool.forked_parent(pid, pool_entries)
         else:
             # Child
             try:
                 # Reset SIGCHLD handler
                 signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                # Take over the idle filter processes
+                if self._pool is not None:
+                    self._pool.forked_child(pool_entries, child.taskfile)
                 # Run the child function
                 child_function(*args, **kwargs)
             finally:
@@ -145,12 +168,29 @@ class ChildManager(object):
         '''Clean up the specified search process.'''
         try:
             child = self._children.pop(pid)
+            # Collect returned filter processes before killing the child's
+            # cgroup
+            if self._pool is not None:
+                self._pool.collect(pid)
             child.cleanup()
         except KeyError:
             pass
 
+    def reap(self):
+        '''Clean up search processes which have exited.  Called from the
+        supervisor's main loop.'''
+        try:
+            while self.wakeup.recv(4096):
+                pass
+        except socket.error, e:
+            if e.args[0] != errno.EAGAIN:
+                raise
+        while self._exited:
+            self._cleanup_child(self._exited.pop(0))
+
     def _child_exited(self, _sig, _frame):
-        '''Signal handler for SIGCHLD.'''
+        '''Signal handler for SIGCHLD.  Record the exited children and wake
+        the main loop; cleaning up after a child can block.'''
         while True:
             try:
                 pid, status = os.waitpid(-1, os.WNOHANG)
@@ -166,10 +206,19 @@ class ChildManager(object):
             else:
                 _log.info('PID %d exited with status %d', pid,
                                 os.WEXITSTATUS(status))
-            self._cleanup_child(pid)
+            self._exited.append(pid)
+            try:
+                self._wakeup_writer.send('\0')
+            except socket.error:
+                # Socket buffer full; the main loop is already awake
+                pass
 
     def kill_all(self):
         '''Clean up all forked search processes.'''
+        # Kill pooled filter processes, and don't wait for running children
+        # to return theirs
+        if self._pool is not None:
+            self._pool.close()
         for pid in self._children.keys():
             _log.debug('Killing PID %d', pid)
             self._cleanup_child(pid)
@@ -65,17 +65,22 @@ cache values resulting from filter executions that produce attribute data at
 less than 2 MB/s.
 '''
 
+from __future__ import with_statement
+import binascii
+from itertools import islice
 import logging
+import mmap
 import os
 from redis import Redis
 from redis.exceptions import ResponseError
 import signal
 import simplejson as json
+import struct
 import subprocess
+from tempfile import mkstemp
 import threading
 
 from opendiamond.helpers import murmur, signalname, split_scheme
-from opendiamond.rpc import ConnectionFailure
 from opendiamond.server.object_ import ObjectLoader, ObjectLoadError
 from opendiamond.server.statistics import FilterStatistics, Timer
 
@@ -84,6 +89,15 @@ ATTR_FILTER_SCORE = '_filter.%s_score'	# arg: filter name
 # (total attribute value size / execution time), we will cache the attribute
 # values as well as the filter results.
 ATTRIBUTE_CACHE_THRESHOLD = 2 << 20	# bytes/sec
+# Filter protocol versions we support, advertised to filters in the
+# environment
+FILTER_PROTOCOLS = (1, 2)
+# In protocol version 2, strings at least this long are written with a
+# separate system call rather than being copied into the message buffer
+LARGE_WRITE = 65536
+# If the filter has mapped its shared memory segment, items at least this
+# long are passed through the segment rather than the pipe
+SHM_THRESHOLD = 65536
 DEBUG = False
 
 _log = logging.getLogger(__name__)
@@ -104,13 +118,85 @@ class _DropObject(Exception):
 
 
 class _FilterProcess(object):
-    '''A connection to a running filter process.'''
-    def __init__(self, code_argv, name, args, blob):
+    '''A connection to a running filter process.
+
+    The filter process always begins with protocol version 1, in which each
+    tag is a line of text and each item is a line containing its length in
+    decimal followed by the item data and a newline.  An empty line
+    represents a missing item or the end of an array.  If the filter
+    supports a protocol version that we advertise, it can send a
+    set-protocol-version message at any point; subsequent messages in both
+    directions use the new version.  In protocol version 2, each tag and
+    item is a 32-bit big-endian signed length followed by the data, and a
+    length of -1 represents a missing item or the end of an array.
+
+    If shm_size is nonzero, we also create a shared memory segment and
+    pass its path and size to the filter in the DIAMOND_FILTER_SHM
+    environment variable.  The segment is a file in the search's temporary
+    directory.  A filter using protocol version 2 can map the segment and
+    send use-shared-memory before init-success; otherwise we discard it.
+    The first half of the segment is then written by us and the second
+    half by the filter.  An item can be replaced with a length of -2
+    followed by a 64-bit big-endian offset and length of the item data
+    within the segment.
+
+    During initialization, a filter using protocol version 2 can send
+    prefetch-attributes followed by an array of attribute names which it
+    reads for every object.
+
+    If the filter is using shared memory or has sent prefetch-attributes,
+    it sends next-object before starting each object and waits for our
+    reply: an array of the names of the prefetched attributes present in
+    the object, followed by an array of their values.  Each side then
+    reuses its half of the segment from the beginning.
+
+    A filter using protocol version 2 can also send set-batch-size during
+    initialization to evaluate several objects at once.  It then sends next-batch, rather
+    than next-object, before each batch.  We reply with the number of
+    objects in the batch, followed by the prefetched attribute arrays for
+    each object.  Before sending an object-specific command, the filter
+    sends select-object with the index of the object in the batch; the
+    first object is initially selected.  It finishes the batch with
+    batch-result and an array of scores.'''
+
+    _length = struct.Struct('>i')
+    _shm_ref = struct.Struct('>QQ')
+    SHM_ITEM = -2
+
+    def __init__(self, code_argv, name, args, blob, tmpdir=None,
+                shm_size=0):
+        self._shm = None	# mmap, once the filter has mapped it too
+        self._shm_fd = None
+        self._shm_path = None	# Until the filter has mapped it
+        self._shm_size = shm_size
+        self._shm_offset = 0	# Next free byte in our half
+        # Attributes to send with each object
+        self.prefetch_attrs = ()
+        # Maximum objects per next-batch
+        self.batch_size = 1
         try:
             self._name = name
+            self._detached = False
+            self.protocol_version = 1
+            env = dict(os.environ)
+            env['DIAMOND_FILTER_PROTOCOLS'] = ','.join(
+                                    [str(v) for v in FILTER_PROTOCOLS])
+            if tmpdir is not None:
+                env['TMPDIR'] = tmpdir
+            else:
+                tmpdir = os.getenv('TMPDIR')
+            if shm_size > 0:
+                # Create the segment in the temporary directory, so it is
+                # cleaned up with the search even if we are killed
+                self._shm_fd, self._shm_path = mkstemp(prefix='diamond-shm-',
+                                    dir=tmpdir)
+                os.ftruncate(self._shm_fd, shm_size)
+                env['DIAMOND_FILTER_SHM'] = '%s:%d' % (self._shm_path,
+                                    shm_size)
             self._proc = subprocess.Popen(code_argv + ['--filter'],
                                 stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-                                close_fds=True, cwd=os.getenv('TMPDIR'))
+                                close_fds=True, cwd=tmpdir, env=env)
+            self.pid = self._proc.pid
             self._fin = self._proc.stdout
             self._fout = self._proc.stdin
 
@@ -123,7 +209,77 @@ class _FilterProcess(object):
         except (OSError, IOError):
             raise FilterExecutionError('Unable to launch filter %s' % self)
 
+    @classmethod
+    def adopt(cls, name, pid, fds, state):
+        '''Return a _FilterProcess for an initialized filter process which
+        is not our child, using the file descriptors and state returned by
+        detach().'''
+        self = cls.__new__(cls)
+        self._name = name
+        self._detached = False
+        self.protocol_version = state['protocol_version']
+        self.prefetch_attrs = [key.encode('utf-8')
+                                for key in state['prefetch_attrs']]
+        self.batch_size = state['batch_size']
+        self._proc = None
+        self.pid = pid
+        self._fin = os.fdopen(fds[0], 'rb', 0)
+        self._fout = os.fdopen(fds[1], 'wb', 0)
+        self._shm_path = None
+        self._shm_size = state['shm_size']
+        self._shm_offset = 0
+        if self._shm_size:
+            self._shm_fd = fds[2]
+            self._shm = mmap.mmap(self._shm_fd, self._shm_size)
+        else:
+            self._shm_fd = None
+            self._shm = None
+        return self
+
+    def detach(self):
+        '''Stop managing the process.  Return duplicates of the file
+        descriptors used to communicate with it, and a JSON-serializable
+        description of its protocol state.'''
+        fds = [os.dup(self._fin.fileno()), os.dup(self._fout.fileno())]
+        if self._shm is not None:
+            fds.append(os.dup(self._shm_fd))
+        state = {
+            'protocol_version': self.protocol_version,
+            'shm_size': self._shm is not None and self._shm_size or 0,
+            'prefetch_attrs': list(self.prefetch_attrs),
+            'batch_size': self.batch_size,
+        }
+        self._detached = True
+        self._fin.close()
+        self._fout.close()
+        self._close_shared_memory()
+        return fds, state
+
+    def _close_shared_memory(self):
+        if self._shm is not None:
+            self._shm.close()
+            self._shm = None
+        if self._shm_fd is not None:
+            os.close(self._shm_fd)
+            self._shm_fd = None
+        if self._shm_path is not None:
+            try:
+                os.unlink(self._shm_path)
+            except OSError:
+                pass
+            self._shm_path = None
+
     def __del__(self):
+        if self._detached:
+            return
+        self._close_shared_memory()
+        if self._proc is None:
+            # Adopted process; we can't reap it
+            try:
+                os.kill(self.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            return
         ret = self._proc.poll()
         if ret is None:
             os.kill(self._proc.pid, signal.SIGKILL)
@@ -136,12 +292,49 @@ class _FilterProcess(object):
     def __str__(self):
         return self._name
 
+    def set_protocol_version(self, version):
+        '''Switch to the specified protocol version.'''
+        if version not in FILTER_PROTOCOLS:
+            raise FilterExecutionError('%s: unsupported protocol version %d'
+                                    % (self, version))
+        self.protocol_version = version
+
+    def enable_shared_memory(self):
+        '''The filter has mapped the shared memory segment.'''
+        if (self._shm_fd is None or self._shm is not None or
+                    self.protocol_version < 2):
+            raise FilterExecutionError('%s: unexpected use-shared-memory'
+                                    % self)
+        self._shm = mmap.mmap(self._shm_fd, self._shm_size)
+        # Both sides have it mapped; it no longer needs a name
+        os.unlink(self._shm_path)
+        self._shm_path = None
+
+    def initialized(self):
+        '''The filter has initialized.  Filters map the shared memory
+        segment before initializing, so if it is still unused, discard
+        it.'''
+        if self._shm is None:
+            self._close_shared_memory()
+
+    def next_object(self):
+        '''The filter is starting a new object, and is no longer using
+        any data from the previous one.'''
+        self._shm_offset = 0
+
     def get_tag(self):
-        '''Read and return a tag.'''
-        return self._fin.readline().strip()
+        '''Read and return a tag, or the empty string at end of file.'''
+        if self.protocol_version == 1:
+            return self._fin.readline().strip()
+        try:
+            return self.get_item() or ''
+        except IOError:
+            return ''
 
     def get_item(self):
         '''Read and return a string or blob.'''
+        if self.protocol_version != 1:
+            return self._get_item_binary()
         sizebuf = self._fin.readline()
         if len(sizebuf) == 0:
             # End of file
@@ -157,6 +350,31 @@ class _FilterProcess(object):
         self._fin.read(1)
         return item
 
+    def _get_item_binary(self):
+        sizebuf = self._fin.read(self._length.size)
+        if len(sizebuf) != self._length.size:
+            raise IOError('End of input stream')
+        size, = self._length.unpack(sizebuf)
+        if size == self.SHM_ITEM:
+            return self._get_item_shared()
+        elif size < 0:
+            # No data
+            return None
+        item = self._fin.read(size)
+        if len(item) != size:
+            raise IOError('Short read from stream')
+        return item
+
+    def _get_item_shared(self):
+        buf = self._fin.read(self._shm_ref.size)
+        if len(buf) != self._shm_ref.size:
+            raise IOError('Short read from stream')
+        offset, length = self._shm_ref.unpack(buf)
+        if (self._shm is None or offset < self._shm_size // 2 or
+                    offset + length > self._shm_size):
+            raise IOError('Bad shared memory reference')
+        return self._shm[offset:offset + length]
+
     def get_array(self):
         '''Read and return an array of strings or blobs.'''
         arr = []
@@ -173,6 +391,9 @@ class _FilterProcess(object):
            scalar => serialized as str(value)
            tuple or list => serialized as an array terminated by a blank line
         '''
+        if self.protocol_version != 1:
+            self._send_binary(values)
+            return
         def send_value(value):
             value = str(value)
             self._fout.write('%d\n%s\n' % (len(value), value))
@@ -191,11 +412,78 @@ class _FilterProcess(object):
                 send_value(value)
         self._fout.flush()
 
+    def _send_binary(self, values):
+        parts = []
+        blank = self._length.pack(-1)
+        limit = self._shm_size // 2
+        def add_value(value):
+            value = str(value)
+            offset = self._shm_offset
+            if (self._shm is not None and len(value) >= SHM_THRESHOLD and
+                        offset + len(value) <= limit):
+                self._shm[offset:offset + len(value)] = value
+                self._shm_offset += len(value)
+                parts.append(self._length.pack(self.SHM_ITEM) +
+                                    self._shm_ref.pack(offset, len(value)))
+            else:
+                parts.append(self._length.pack(len(value)))
+                parts.append(value)
+        for value in values:
+            if isinstance(value, list) or isinstance(value, tuple):
+                for element in value:
+                    add_value(element)
+                parts.append(blank)
+            elif value is True:
+                add_value('true')
+            elif value is False:
+                add_value('false')
+            elif value is None:
+                parts.append(blank)
+            else:
+                add_value(value)
+        # Coalesce small writes, but don't copy large attribute values
+        buf = []
+        for part in parts:
+            if len(part) >= LARGE_WRITE:
+                if buf:
+                    self._fout.write(''.join(buf))
+                    buf = []
+                self._fout.write(part)
+            else:
+                buf.append(part)
+        if buf:
+            self._fout.write(''.join(buf))
+        self._fout.flush()
+
 
 class _FilterResult(object):
     '''A summary of the result of running a filter on an object: the score,
     hashes of the output attributes, and list of omit attributes, together
-    with hashes of the input attributes used to produce them.'''
+    with hashes of the input attributes used to produce them.
+
+    Results can be encoded as JSON or in a compact binary format.  The
+    binary format begins with a NUL byte, which cannot start a JSON
+    document, followed by a version byte; decode() accepts either format,
+    so cache entries written by older servers remain usable.  The rest of
+    a version 1 binary entry is:
+
+        score (double), name count, input count, output count, omit count
+        names: (length, bytes) for each distinct attribute name
+        inputs: (name index, present flag, 16-byte digest if present)
+        outputs: (name index, 16-byte digest)
+        omits: name index
+
+    with all integers encoded as big-endian 16-bit values except the
+    present flag, which is a single byte.  Results which don't fit these
+    limits are encoded as JSON instead.'''
+
+    BINARY_MAGIC = '\0'
+    BINARY_VERSION = 1
+    _header = struct.Struct('>cBdHHHH')
+    _short = struct.Struct('>H')
+    _input = struct.Struct('>HB')
+    _short_max = 0xffff
+    _digest_len = 16
 
     def __init__(self, input_attrs=None, output_attrs=None, omit_attrs=None,
             score=0.0):
@@ -207,7 +495,14 @@ class _FilterResult(object):
         # Whether to cache output attributes in the attribute cache
         self.cache_output = False
 
-    def encode(self):
+    def encode(self, encoding='json'):
+        '''Encode the result in the specified format, either 'json' or
+        'binary'.  Fall back to JSON if the result can't be represented in
+        the binary format.'''
+        if encoding == 'binary':
+            data = self._encode_binary()
+            if data is not None:
+                return data
         props = {
             'input_attrs': self.input_attrs,
             'output_attrs': self.output_attrs,
@@ -217,12 +512,63 @@ class _FilterResult(object):
             props['omit_attrs'] = list(self.omit_attrs)
         return json.dumps(props)
 
+    def _encode_binary(self):
+        '''Return the binary encoding, or None if the result exceeds the
+        limits of the format.'''
+        all_names = set(self.input_attrs)
+        all_names.update(self.output_attrs)
+        all_names.update(self.omit_attrs)
+        if len(all_names) > self._short_max:
+            return None
+        for name in all_names:
+            if len(name) > self._short_max:
+                return None
+        digests = [valsig for valsig in self.input_attrs.itervalues()
+                                if valsig is not None]
+        digests.extend(self.output_attrs.itervalues())
+        for valsig in digests:
+            if len(valsig) != 2 * self._digest_len:
+                return None
+        names = []
+        indexes = {}	# name -> index into names
+        def index(name):
+            try:
+                return indexes[name]
+            except KeyError:
+                indexes[name] = len(names)
+                names.append(name)
+                return indexes[name]
+        inputs = []
+        for name, valsig in self.input_attrs.iteritems():
+            if valsig is None:
+                inputs.append(self._input.pack(index(name), 0))
+            else:
+                inputs.append(self._input.pack(index(name), 1) +
+                                binascii.unhexlify(valsig))
+        outputs = [self._short.pack(index(name)) +
+                                binascii.unhexlify(valsig)
+                                for name, valsig in
+                                self.output_attrs.iteritems()]
+        omits = [self._short.pack(index(name)) for name in self.omit_attrs]
+        parts = [self._header.pack(self.BINARY_MAGIC, self.BINARY_VERSION,
+                                self.score, len(names), len(inputs),
+                                len(outputs), len(omits))]
+        for name in names:
+            parts.append(self._short.pack(len(name)))
+            parts.append(name)
+        return ''.join(parts + inputs + outputs + omits)
+
     # pylint thinks json.loads() returns bool?
     # pylint: disable=maybe-no-member
     @classmethod
     def decode(cls, data):
         if data is None:
             return None
+        if data.startswith(cls.BINARY_MAGIC):
+            try:
+                return cls._decode_binary(data)
+            except (struct.error, IndexError, TypeError):
+                return None
         dct = json.loads(data)
         try:
             return cls(dct['input_attrs'], dct['output_attrs'],
@@ -231,6 +577,53 @@ class _FilterResult(object):
             return None
     # pylint: enable=maybe-no-member
 
+    @classmethod
+    def _decode_binary(cls, data):
+        '''Decode a binary result.  Raise struct.error, IndexError, or
+        TypeError on malformed data; return None for unknown versions.'''
+        _magic, version, score, name_count, input_count, output_count, \
+                omit_count = cls._header.unpack_from(data)
+        if version != cls.BINARY_VERSION:
+            return None
+        offset = cls._header.size
+        digest_len = cls._digest_len
+        def digest(offset):
+            value = data[offset:offset + digest_len]
+            if len(value) != digest_len:
+                raise struct.error('Short digest')
+            return binascii.hexlify(value)
+        names = []
+        for _i in xrange(name_count):
+            length, = cls._short.unpack_from(data, offset)
+            offset += cls._short.size
+            name = data[offset:offset + length]
+            if len(name) != length:
+                raise struct.error('Short attribute name')
+            # Attribute names recur across objects; share one copy
+            names.append(intern(name))
+            offset += length
+        input_attrs = {}
+        for _i in xrange(input_count):
+            idx, present = cls._input.unpack_from(data, offset)
+            offset += cls._input.size
+            if present:
+                input_attrs[names[idx]] = digest(offset)
+                offset += digest_len
+            else:
+                input_attrs[names[idx]] = None
+        output_attrs = {}
+        for _i in xrange(output_count):
+            idx, = cls._short.unpack_from(data, offset)
+            offset += cls._short.size
+            output_attrs[names[idx]] = digest(offset)
+            offset += digest_len
+        omit_attrs = []
+        for _i in xrange(omit_count):
+            idx, = cls._short.unpack_from(data, offset)
+            offset += cls._short.size
+            omit_attrs.append(names[idx])
+        return cls(input_attrs, output_attrs, omit_attrs, score)
+
 
 class _ObjectProcessor(object):
     '''A context for processing objects.'''
@@ -238,6 +631,8 @@ class _ObjectProcessor(object):
     # Whether to report the filter score back to the client (True for
     # filters requested by the client, False for other filters)
     send_score = False
+    # Names of the filters whose output we depend on
+    dependencies = ()
 
     def __str__(self):
         '''Return a human-readable name for the underlying filter.'''
@@ -258,10 +653,27 @@ class _ObjectProcessor(object):
         producing the given result.'''
         pass
 
+    def release(self):
+        '''Notification that no more objects may be processed.  Return
+        reusable resources, if idle, to their pool.'''
+        pass
+
     def evaluate(self, obj):
         '''Execute the filter on this object, returning a _FilterResult.'''
         raise NotImplementedError()
 
+    def evaluate_batch(self, objs):
+        '''Execute the filter on these objects, returning a list of
+        _FilterResults, with None for objects which should be dropped
+        without caching the result.'''
+        results = []
+        for obj in objs:
+            try:
+                results.append(self.evaluate(obj))
+            except _DropObject:
+                results.append(None)
+        return results
+
     def threshold(self, result):
         '''Apply the drop threshold to the _FilterResult and return True
         to accept the object or False to drop it.'''
@@ -274,7 +686,8 @@ class _ObjectFetcher(_ObjectProcessor):
     def __init__(self, state):
         _ObjectProcessor.__init__(self)
         self._state = state
-        self._loader = ObjectLoader(state.config, state.blob_cache)
+        self._loader = ObjectLoader(state.config, state.blob_cache,
+                                    state.http)
 
     def __str__(self):
         return 'fetcher'
@@ -309,10 +722,16 @@ class _FilterRunner(_ObjectProcessor):
         self._state = state
         self._proc = None
         self._proc_initialized = False
+        # Held while evaluating, so release() can skip a busy process
+        self._lock = threading.Lock()
 
     def __str__(self):
         return self._filter.name
 
+    @property
+    def dependencies(self):
+        return self._filter.dependencies
+
     def _get_cache_digest(self):
         return self._filter.cache_digest
 
@@ -323,28 +742,134 @@ class _FilterRunner(_ObjectProcessor):
                                 objs_cache_dropped=int(not accept),
                                 objs_cache_passed=int(accept))
 
+    def _debugging(self):
+        debug = self._state.config.debug_filters
+        return self._filter.name in debug or self._filter.signature in debug
+
+    def _start_process(self):
+        '''Start the filter process, or take over an idle one from the
+        filter pool.'''
+        pool = self._state.pool
+        argv = [self._filter.code_path]
+        tmpdir = None
+        if self._debugging():
+            argv = self._state.config.debug_command + argv
+        elif pool is not None:
+            entry = pool.checkout(self._filter.cache_digest)
+            if entry is not None:
+                self._proc = _FilterProcess.adopt(entry.name, entry.pid,
+                                    entry.fds, entry.state)
+                self._proc_initialized = True
+                return
+            # The process may outlive this search, so don't run it in our
+            # temporary directory
+            tmpdir = pool.directory
+        self._proc = _FilterProcess(argv, self._filter.name,
+                                self._filter.arguments, self._filter.blob,
+                                tmpdir, self._state.config.filter_shm_bytes)
+        self._proc_initialized = False
+
+    def release(self):
+        pool = self._state.pool
+        if pool is None or self._debugging():
+            return
+        if not self._lock.acquire(False):
+            # Filter is busy
+            return
+        try:
+            if self._proc is not None and self._proc_initialized:
+                fds, state = self._proc.detach()
+                pool.checkin(self._filter.cache_digest, self._filter.name,
+                                    self._proc.pid, fds, state)
+            self._proc = None
+        finally:
+            self._lock.release()
+
     def evaluate(self, obj):
-        if self._proc is None:
-            debug = self._state.config.debug_filters
-            if self._filter.name in debug or self._filter.signature in debug:
-                argv = (self._state.config.debug_command +
-                            [self._filter.code_path])
+        result = self.evaluate_batch([obj])[0]
+        if result is None:
+            raise _DropObject()
+        return result
+
+    def evaluate_batch(self, objs):
+        results = []
+        with self._lock:
+            while len(results) < len(objs):
+                results.extend(self._evaluate(objs[len(results):]))
+        return results
+
+    def _send_prefetched(self, obj, result):
+        '''Send the prefetched attributes of obj to the filter and record
+        them as inputs of result.'''
+        keys = []
+        for key in self._proc.prefetch_attrs:
+            if key in obj:
+                keys.append(key)
+                result.input_attrs[key] = obj.get_signature(key)
             else:
-                argv = [self._filter.code_path]
-            self._proc = _FilterProcess(argv, self._filter.name,
-                                    self._filter.arguments, self._filter.blob)
-            self._proc_initialized = False
+                result.input_attrs[key] = None
+        self._proc.send(keys, [obj[key] for key in keys])
+
+    def _evaluate(self, objs):
+        '''Run the filter until it produces a result for the first object
+        in objs, or for a batch of objects at the start of objs if the
+        filter requests one.  Return the list of _FilterResults, with None
+        for objects which should be dropped without caching the result.'''
+        if self._proc is None:
+            self._start_process()
         timer = Timer()
-        result = _FilterResult()
+        # Until the filter requests a batch, it is evaluating objs[0]
+        batch = objs[:1]
+        results = [_FilterResult()]
+        cur = 0
         proc = self._proc
         try:
             while True:
+                obj = batch[cur]
+                result = results[cur]
                 cmd = proc.get_tag()
                 if cmd == 'init-success':
                     # The filter initialized successfully.  This may not
                     # be the first command produced by the filter, since
                     # its init function may e.g. produce log messages.
                     self._proc_initialized = True
+                    proc.initialized()
+                elif cmd == 'set-protocol-version':
+                    try:
+                        version = int(proc.get_item())
+                    except ValueError:
+                        raise FilterExecutionError(
+                                    '%s: bad protocol version' % self)
+                    proc.set_protocol_version(version)
+                elif cmd == 'set-batch-size':
+                    try:
+                        proc.batch_size = max(int(proc.get_item()), 1)
+                    except ValueError:
+                        raise FilterExecutionError(
+                                    '%s: bad batch size' % self)
+                elif cmd == 'use-shared-memory':
+                    proc.enable_shared_memory()
+                elif cmd == 'prefetch-attributes':
+                    proc.prefetch_attrs = proc.get_array()
+                elif cmd == 'next-object':
+                    proc.next_object()
+                    self._send_prefetched(obj, result)
+                elif cmd == 'next-batch':
+                    batch = objs[:proc.batch_size]
+                    results = [_FilterResult() for _obj in batch]
+                    cur = 0
+                    proc.next_object()
+                    proc.send(len(batch))
+                    for obj, result in zip(batch, results):
+                        self._send_prefetched(obj, result)
+                elif cmd == 'select-object':
+                    try:
+                        cur = int(proc.get_item())
+                    except ValueError:
+                        cur = -1
+                    if cur < 0 or cur >= len(batch):
+                        raise FilterExecutionError(
+                                    '%s: bad object index' % self)
                 elif cmd == 'get-attribute':
                     key = proc.get_item()
                     if key in obj:
@@ -412,8 +937,19 @@ class _FilterRunner(_ObjectProcessor):
                 elif cmd == 'stdout':
                     print proc.get_item(),
                 elif cmd == 'result':
+                    if len(batch) > 1:
+                        raise FilterExecutionError(
+                                    '%s: result for a batch' % self)
                     result.score = float(proc.get_item())
                     break
+                elif cmd == 'batch-result':
+                    scores = proc.get_array()
+                    if len(scores) != len(batch):
+                        raise FilterExecutionError(
+                                    '%s: bad array lengths' % self)
+                    for result, score in zip(results, scores):
+                        result.score = float(score)
+                    break
                 elif cmd == '':
                     # Encountered EOF on pipe
                     raise IOError()
@@ -421,27 +957,31 @@ class _FilterRunner(_ObjectProcessor):
                     raise FilterExecutionError('%s: unknown command' % self)
         except IOError:
             if self._proc_initialized:
-                # Filter died on an object.  Drop the object without caching
-                # the result.
-                _log.error('Filter %s (signature %s) died on object %s',
+                # Filter died on an object.  Drop the objects without
+                # caching the results.
+                for obj in batch:
+                    _log.error('Filter %s (signature %s) died on object %s',
                                 self, self._filter.signature, obj)
-                self._filter.stats.update('objs_terminate')
+                self._filter.stats.update(objs_terminate=len(batch))
                 self._proc = None
-                raise _DropObject()
+                return [None for _obj in batch]
             else:
                 # Filter died during initialization.  Treat this as fatal.
                 raise FilterExecutionError("Filter %s failed to initialize"
                                 % self)
         finally:
-            accept = self.threshold(result)
-            self._filter.stats.update('objs_processed', 'objs_computed',
+            elapsed = timer.elapsed
+            for obj, result in zip(batch, results):
+                accept = self.threshold(result)
+                self._filter.stats.update('objs_processed', 'objs_computed',
                                     objs_dropped=int(not accept),
-                                    execution_us=timer.elapsed)
-            lengths = [len(obj[k]) for k in result.output_attrs]
-            throughput = int(sum(lengths) / timer.elapsed_seconds)
-            if throughput < ATTRIBUTE_CACHE_THRESHOLD:
-                result.cache_output = True
-        return result
+                                    execution_us=elapsed / len(batch))
+                lengths = [len(obj[k]) for k in result.output_attrs]
+                throughput = int(sum(lengths) * len(batch) /
+                                    timer.elapsed_seconds)
+                if throughput < ATTRIBUTE_CACHE_THRESHOLD:
+                    result.cache_output = True
+        return results
 
     def threshold(self, result):
         return (result.score >= self._filter.min_score and
@@ -536,7 +1076,7 @@ class FilterStackRunner(threading.Thread):
     '''A context for processing objects with a FilterStack.  Handles querying
     and updating the result and attribute caches.'''
 
-    def __init__(self, state, filter_runners, name, cleanup):
+    def __init__(self, state, filter_runners, name, cleanup, stack=None):
         threading.Thread.__init__(self, name=name)
         self.setDaemon(True)
         self._state = state
@@ -544,6 +1084,26 @@ class FilterStackRunner(threading.Thread):
         self._redis = None	# May be None if caching is not enabled
         self._cleanup = cleanup	# cleanup.__del__ fires when all workers exit
         self._warned_cache_update = False
+        # For adaptive filter ordering.  The first runner is always the
+        # object fetcher; the rest correspond to the filters in the stack.
+        self._stack = stack
+        if stack is not None:
+            self._filter_runners = dict(zip(stack, filter_runners[1:]))
+        self._reorder_countdown = state.config.filter_reorder_interval
+        # runner -> set of runners whose output it transitively depends on,
+        # including the object fetcher
+        self._prerequisites = dict()
+        by_name = dict([(str(r), r) for r in filter_runners[1:]])
+        def prerequisites(runner):
+            if runner not in self._prerequisites:
+                deps = set(filter_runners[:1])
+                for name in runner.dependencies:
+                    deps.add(by_name[name])
+                    deps.update(prerequisites(by_name[name]))
+                self._prerequisites[runner] = deps
+            return self._prerequisites[runner]
+        for runner in filter_runners[1:]:
+            prerequisites(runner)
 
     def _ensure_cache(self):
         '''Connect to Redis cache if not already connected.  Called from
@@ -562,9 +1122,36 @@ class FilterStackRunner(threading.Thread):
         '''Return an attribute cache lookup key for the specified signature.'''
         return 'attribute:' + value_sig
 
-    def _result_cache_can_drop(self, obj, cache_results):
+    def _cache_get(self, keys, remember=True):
+        '''Return a list of the cached values for the specified keys, with
+        None for keys that are not cached.  Values are looked up in the
+        in-process cache before Redis.  If remember is False, values found
+        in Redis are not added to the in-process cache.'''
+        if self._redis is None or len(keys) == 0:
+            return [None for k in keys]
+        memcache = self._state.cache
+        if memcache is None:
+            return self._redis.mget(keys)
+        values = memcache.get_multi(keys)
+        missing = [i for i, value in enumerate(values) if value is None]
+        self._state.stats.update(cache_lru_hits=len(keys) - len(missing),
+                                cache_lru_misses=len(missing))
+        if missing:
+            found = dict()
+            for i, value in zip(missing,
+                                self._redis.mget([keys[i] for i in missing])):
+                values[i] = value
+                if value is not None:
+                    found[keys[i]] = value
+            if remember:
+                memcache.set_multi(found)
+        return values
+
+    def _result_cache_can_drop(self, obj, cache_results, notify=True):
         '''Return True if the object can be dropped.  cache_results is a
-        runner -> _FilterResult map retrieved from the result cache.'''
+        runner -> _FilterResult map retrieved from the result cache.  If
+        notify is False, don't update the statistics of the runners that
+        contributed to the drop.'''
 
         # Build output_key -> [runners] mapping.
         output_attrs = dict()
@@ -655,16 +1242,28 @@ class FilterStackRunner(threading.Thread):
                     # Success!  Notify runners that participated in the
                     # cached result and drop the object.
                     _debug('Drop via %s', runner)
-                    for cur in deps:
-                        cur.cache_hit(cache_results[cur])
+                    if notify:
+                        for cur in deps:
+                            cur.cache_hit(cache_results[cur])
                     return True
 
         return False
 
-    def _attribute_cache_try_load(self, runner, obj, result):
-        '''Try to update object attributes from the cached result from
-        this runner, thereby avoiding the need to reexecute the filter.
-        Return True if successful.'''
+    def result_cache_drops(self, obj):
+        '''Return True if the result cache alone shows that the object will
+        be dropped, without loading or evaluating it.  Used to avoid
+        loading objects ahead of the worker threads only to drop them.
+        The worker that evaluates the object repeats the lookup, which is
+        answered by the in-process cache if it is enabled.'''
+        self._ensure_cache()
+        if self._redis is None:
+            return False
+        _cache_keys, cache_results = self._result_cache_lookup([obj])[0]
+        return self._result_cache_can_drop(obj, cache_results, notify=False)
+
+    def _attribute_cache_inputs_match(self, runner, obj, result):
+        '''Return True if the input attributes recorded in the cached result
+        from this runner match the current attributes of the object.'''
         for key, valsig in result.input_attrs.iteritems():
             if valsig is None and key in obj:
                 # The previous execution tried to read the attribute
@@ -682,13 +1281,37 @@ class FilterStackRunner(threading.Thread):
                 # (improperly) produced a different output this time.
                 _debug('Missing dependent value for %s: %s', runner, key)
                 return False
+        return True
+
+    def _attribute_cache_fetch(self, sigs, cached_values):
+        '''Add the attribute cache values for the specified value signatures
+        to the cached_values map, with None for values that are not cached,
+        fetching any that are not already present in a single round trip.
+        The values are not added to the in-process cache, since they may
+        not be used.'''
+        sigs = list(set([sig for sig in sigs if sig not in cached_values]))
+        if sigs:
+            values = self._cache_get([self._get_attribute_key(sig)
+                                    for sig in sigs], remember=False)
+            cached_values.update(zip(sigs, values))
+
+    def _attribute_cache_try_load(self, runner, obj, result,
+                                cached_values=None):
+        '''Try to update object attributes from the cached result from
+        this runner, thereby avoiding the need to reexecute the filter.
+        Return True if successful.  If cached_values is not None, it is a
+        value signature -> attribute value map of values previously fetched
+        from the attribute cache, which is consulted and extended instead
+        of querying the cache for each value.  Values that are loaded into
+        the object are added to the in-process cache.'''
+        if not self._attribute_cache_inputs_match(runner, obj, result):
+            return False
+        if cached_values is None:
+            cached_values = dict()
         keys = result.output_attrs.keys()
-        cache_keys = [self._get_attribute_key(result.output_attrs[k])
-                        for k in keys]
-        if self._redis is not None and len(cache_keys) > 0:
-            values = self._redis.mget(cache_keys)
-        else:
-            values = [None for k in cache_keys]
+        sigs = [result.output_attrs[k] for k in keys]
+        self._attribute_cache_fetch(sigs, cached_values)
+        values = [cached_values[sig] for sig in sigs]
         if None in values:
             # One or more attribute values was not cached.  We need
             # to rerun the filter.
@@ -696,6 +1319,10 @@ class FilterStackRunner(threading.Thread):
             return False
         else:
             _debug('Cached output values for %s', runner)
+            if self._state.cache is not None:
+                self._state.cache.set_multi(dict([
+                                (self._get_attribute_key(sig), value)
+                                for sig, value in zip(sigs, values)]))
             # Load the attribute values and omit set into the object.
             for key, value in zip(keys, values):
                 obj[key] = value
@@ -708,23 +1335,113 @@ class FilterStackRunner(threading.Thread):
             runner.cache_hit(result)
             return True
 
-    def _evaluate(self, obj):
-        _debug('Evaluating %s', obj)
-
-        # Calculate runner -> result cache key mapping.
-        cache_keys = dict([(r, r.get_cache_key(obj)) for r in self._runners])
+    def _plan_cached_drop(self, cache_results):
+        '''Choose a cached drop result which could be confirmed by running
+        the fewest filters without cached results.  Return its runner, or
+        None if there are no candidates.'''
+        best = None
+        best_cost = None
+        for runner, result in cache_results.iteritems():
+            if (runner.threshold(result) or runner not in self._prerequisites
+                        or None in result.input_attrs.itervalues()):
+                # Not a drop, or a result we can't confirm (see
+                # _result_cache_can_drop())
+                continue
+            cost = len([r for r in self._prerequisites[runner]
+                        if r not in cache_results])
+            if best is None or cost < best_cost:
+                best = runner
+                best_cost = cost
+        return best
+
+    def _load_or_evaluate(self, runner, obj, cache_results, cached_values,
+                    new_results):
+        '''Load the runner's prior result into the object if possible, or
+        otherwise execute it and add its result to new_results.  Return the
+        _FilterResult.'''
+        if (runner in cache_results and
+                    self._attribute_cache_try_load(runner, obj,
+                    cache_results[runner], cached_values)):
+            return cache_results[runner]
+        result = runner.evaluate(obj)
+        new_results[runner] = result
+        return result
 
-        # Look up all filter results in the cache and build runner -> result
-        # mapping for results that exist.
-        if self._redis is not None:
-            keys = [cache_keys[r] for r in self._runners]
+    def _try_cached_drop(self, obj, cache_results, cached_values,
+                    new_results):
+        '''Try to confirm a cached drop result which could not be proven
+        from the result cache alone, by first running only the filters it
+        depends on and then checking its inputs against the object.  Return
+        a tuple: True if the object should be dropped, and a runner ->
+        _FilterResult map of filters that were run and accepted the
+        object.'''
+        done = dict()
+        target = self._plan_cached_drop(cache_results)
+        if target is None:
+            return False, done
+        _debug('Confirming cached drop via %s', target)
+        for runner in self._runners:
+            if runner not in self._prerequisites[target]:
+                continue
+            result = self._load_or_evaluate(runner, obj, cache_results,
+                                    cached_values, new_results)
+            if not runner.threshold(result):
+                return True, done
+            elif runner.send_score:
+                obj[ATTR_FILTER_SCORE % runner] = str(result.score) + '\0'
+            done[runner] = result
+        result = cache_results[target]
+        for key, valsig in result.input_attrs.iteritems():
+            if key not in obj or obj.get_signature(key) != valsig:
+                _debug('Inputs of %s changed; not dropping', target)
+                return False, done
+        target.cache_hit(result)
+        return True, done
+
+    def _result_cache_lookup(self, objs):
+        '''Look up all filter results for the specified objects in the
+        result cache with a single round trip.  Return a list containing,
+        for each object, a runner -> result cache key mapping and a
+        runner -> _FilterResult mapping for results that exist.'''
+        lookups = []
+        keys = []
+        for obj in objs:
+            cache_keys = dict([(r, r.get_cache_key(obj))
+                                for r in self._runners])
+            lookups.append(cache_keys)
+            keys.extend([cache_keys[r] for r in self._runners])
+        values = self._cache_get(keys)
+        ret = []
+        count = len(self._runners)
+        for i, cache_keys in enumerate(lookups):
             results = [(runner, _FilterResult.decode(data))
                                 for runner, data in
-                                zip(self._runners, self._redis.mget(keys))]
+                                zip(self._runners,
+                                    values[i * count:(i + 1) * count])]
             # runner -> _FilterResult
-            cache_results = dict([(k, v) for k, v in results if v is not None])
-        else:
-            cache_results = dict()
+            cache_results = dict([(k, v) for k, v in results
+                                    if v is not None])
+            ret.append((cache_keys, cache_results))
+        return ret
+
+    def _cache_update(self, resultmap):
+        '''Store the specified key -> value map in the cache.'''
+        if self._redis is not None and resultmap:
+            if self._state.cache is not None:
+                self._state.cache.set_multi(resultmap)
+            try:
+                self._redis.mset(resultmap)
+            except ResponseError, e:
+                # mset failed, possibly due to maxmemory quota
+                if not self._warned_cache_update:
+                    self._warned_cache_update = True
+                    _log.warning('Failed to update cache: %s', e)
+
+    def _evaluate(self, obj, cache_keys, cache_results, resultmap,
+                    cached_values=None):
+        '''Evaluate the object given the result cache lookups from
+        _result_cache_lookup(), adding new cache entries to resultmap.'''
+        _debug('Evaluating %s', obj)
 
         # Evaluate the object in the result cache.
         if self._result_cache_can_drop(obj, cache_results):
@@ -732,15 +1449,18 @@ class FilterStackRunner(threading.Thread):
 
         new_results = dict()		# runner -> result
         try:
-            # Run each filter or load its prior result into the object.
+            # Try to confirm a cached drop by running only its dependencies.
+            drop, done = self._try_cached_drop(obj, cache_results,
+                                    cached_values, new_results)
+            if drop:
+                return False
+            # Run each remaining filter or load its prior result into the
+            # object.
             for runner in self._runners:
-                if (runner in cache_results and
-                            self._attribute_cache_try_load(runner, obj,
-                            cache_results[runner])):
-                    result = cache_results[runner]
-                else:
-                    result = runner.evaluate(obj)
-                    new_results[runner] = result
+                if runner in done:
+                    continue
+                result = self._load_or_evaluate(runner, obj, cache_results,
+                                    cached_values, new_results)
                 if not runner.threshold(result):
                     # Drop decision.
                     return False
@@ -754,29 +1474,101 @@ class FilterStackRunner(threading.Thread):
         except _DropObject:
             return False
         finally:
-            # Update the cache with new values
-            resultmap = dict()
-            for runner, result in new_results.iteritems():
-                # Result cache entry
-                resultmap[cache_keys[runner]] = result.encode()
-                # Attribute cache entries, if the filter was expensive enough
-                if result.cache_output:
-                    for key, valsig in result.output_attrs.iteritems():
-                        # If this attribute was subsequently overwritten by a
-                        # different filter, make sure we're not caching the
-                        # newer value against this key.
-                        if valsig == obj.get_signature(key):
-                            attribute_key = self._get_attribute_key(valsig)
-                            resultmap[attribute_key] = obj[key]
-            # Do it
-            if self._redis is not None and resultmap:
+            self._record_results(obj, cache_keys, new_results, resultmap)
+
+    def _evaluate_batch(self, objs, lookups, resultmap):
+        '''Evaluate the objects given their result cache lookups from
+        _result_cache_lookup(), or None for objects already dropped via
+        the result cache, adding new cache entries to resultmap.  Each
+        filter is run on all of the surviving objects before the next
+        filter, so filters can evaluate them as a batch.  Return a list of
+        booleans: True to accept the corresponding object or False to drop
+        it.'''
+        cached_values = dict()	# value signature -> value or None
+        live = []
+        new_results = [dict() for _obj in objs]	# runner -> result
+        done = [dict() for _obj in objs]	# runner -> result
+        try:
+            # Try to confirm cached drops by running only their
+            # dependencies.
+            for i, lookup in enumerate(lookups):
+                if lookup is None:
+                    continue
                 try:
-                    self._redis.mset(resultmap)
-                except ResponseError, e:
-                    # mset failed, possibly due to maxmemory quota
-                    if not self._warned_cache_update:
-                        self._warned_cache_update = True
-                        _log.warning('Failed to update cache: %s', e)
+                    drop, done[i] = self._try_cached_drop(objs[i], lookup[1],
+                                    cached_values, new_results[i])
+                except _DropObject:
+                    drop = True
+                if not drop:
+                    live.append(i)
+            for runner in self._runners:
+                results = dict()	# object index -> result
+                pending = []
+                # Fetch, in a single round trip, the cached output values of
+                # this runner for the surviving objects whose inputs match
+                sigs = []
+                for i in live:
+                    result = lookups[i][1].get(runner)
+                    if (runner not in done[i] and result is not None and
+                                self._attribute_cache_inputs_match(runner,
+                                objs[i], result)):
+                        sigs.extend(result.output_attrs.itervalues())
+                self._attribute_cache_fetch(sigs, cached_values)
+                # Load prior results into the objects where possible
+                for i in live:
+                    cache_results = lookups[i][1]
+                    if runner in done[i]:
+                        results[i] = done[i][runner]
+                    elif (runner in cache_results and
+                                self._attribute_cache_try_load(runner,
+                                objs[i], cache_results[runner],
+                                cached_values)):
+                        results[i] = cache_results[runner]
+                    else:
+                        pending.append(i)
+                if pending:
+                    for i, result in zip(pending, runner.evaluate_batch(
+                                    [objs[i] for i in pending])):
+                        results[i] = result
+                        if result is not None:
+                            new_results[i][runner] = result
+                survivors = []
+                for i in live:
+                    result = results[i]
+                    if result is None or not runner.threshold(result):
+                        # Drop decision.
+                        continue
+                    elif runner.send_score:
+                        # Store the filter score in the object.  This
+                        # attribute is not cached because that would be
+                        # redundant.
+                        attrname = ATTR_FILTER_SCORE % runner
+                        objs[i][attrname] = str(result.score) + '\0'
+                    survivors.append(i)
+                live = survivors
+        finally:
+            for obj, lookup, results in zip(objs, lookups, new_results):
+                if lookup is not None:
+                    self._record_results(obj, lookup[0], results, resultmap)
+        live = set(live)
+        return [i in live for i in xrange(len(objs))]
+
+    def _record_results(self, obj, cache_keys, new_results, resultmap):
+        '''Add cache entries for the specified runner -> _FilterResult map
+        of new results for obj to resultmap.'''
+        for runner, result in new_results.iteritems():
+            # Result cache entry
+            resultmap[cache_keys[runner]] = result.encode(
+                                self._state.config.cache_encoding)
+            # Attribute cache entries, if the filter was expensive enough
+            if result.cache_output:
+                for key, valsig in result.output_attrs.iteritems():
+                    # If this attribute was subsequently overwritten by a
+                    # different filter, make sure we're not caching the
+                    # newer value against this key.
+                    if valsig == obj.get_signature(key):
+                        attribute_key = self._get_attribute_key(valsig)
+                        resultmap[attribute_key] = obj[key]
 
     def evaluate(self, obj):
         '''Evaluate the object and return True to accept or False to drop.'''
@@ -784,29 +1576,92 @@ class FilterStackRunner(threading.Thread):
         self._ensure_cache()
         timer = Timer()
         accept = False
+        resultmap = dict()
         try:
-            accept = self._evaluate(obj)
+            cache_keys, cache_results = self._result_cache_lookup([obj])[0]
+            accept = self._evaluate(obj, cache_keys, cache_results,
+                                    resultmap)
         finally:
+            self._cache_update(resultmap)
             self._state.stats.update('objs_processed',
                                     execution_us=timer.elapsed,
                                     objs_passed=int(accept),
                                     objs_dropped=int(not accept))
         return accept
 
+    def release(self):
+        '''Return idle filter processes to the filter pool.'''
+        for runner in self._runners:
+            runner.release()
+
+    def _update_order(self, count):
+        '''Note that count more objects have been processed, and reorder
+        the filters if adaptive ordering is enabled and it is time to do
+        so.'''
+        interval = self._state.config.filter_reorder_interval
+        if self._stack is None or interval <= 0:
+            return
+        self._reorder_countdown -= count
+        if self._reorder_countdown > 0:
+            return
+        self._reorder_countdown = interval
+        self._runners = self._runners[:1] + [self._filter_runners[f]
+                                    for f in self._stack.optimized_order()]
+
+    def evaluate_batch(self, objs):
+        '''Evaluate the objects and return a list of booleans: True to
+        accept the corresponding object or False to drop it.  Cache lookups
+        and updates for the entire batch are coalesced into a few round
+        trips, and filters supporting batch evaluation receive the batch at
+        once.'''
+        self._ensure_cache()
+        timer = Timer()
+        accepts = []
+        resultmap = dict()
+        try:
+            lookups = self._result_cache_lookup(objs)
+            # Resolve cached drops for the whole batch before fetching
+            # any attribute values
+            pending = []
+            for obj, (cache_keys, cache_results) in zip(objs, lookups):
+                if self._result_cache_can_drop(obj, cache_results):
+                    pending.append(None)
+                else:
+                    pending.append((cache_keys, cache_results))
+            accepts = self._evaluate_batch(objs, pending, resultmap)
+        finally:
+            self._cache_update(resultmap)
+            elapsed = timer.elapsed
+            for accept in accepts:
+                self._state.stats.update('objs_processed',
+                                    execution_us=elapsed / len(objs),
+                                    objs_passed=int(accept),
+                                    objs_dropped=int(not accept))
+        return accepts
+
     # We want to catch all exceptions
     # pylint: disable=broad-except
     def run(self):
         '''Thread function.'''
         try:
+            batch_size = self._state.config.cache_batch_size
             # ScopeListLoader properly handles interleaved access by
             # multiple threads
-            for obj in self._state.scope:
-                if self.evaluate(obj):
-                    self._state.blast.send(obj)
-        except ConnectionFailure:
-            # Client closed blast connection.  Rather than just calling
-            # sys.exit(), signal the main thread to shut us down.
-            os.kill(os.getpid(), signal.SIGUSR1)
+            if batch_size > 1:
+                while True:
+                    objs = list(islice(self._state.scope, batch_size))
+                    if not objs:
+                        break
+                    for obj, accept in zip(objs, self.evaluate_batch(objs)):
+                        if accept:
+                            self._state.blast.send(obj)
+                    self._update_order(len(objs))
+            else:
+                for obj in self._state.scope:
+                    if self.evaluate(obj):
+                        self._state.blast.send(obj)
+                    self._update_order(1)
+            self.release()
         except Exception:
             _log.exception('Worker thread exception')
             os.kill(os.getpid(), signal.SIGUSR1)
@@ -834,6 +1689,9 @@ class FilterStack(object):
         self._filters = dict([(f.name, f) for f in filters])
         # Ordered list of filters to execute
         self._order = list()
+        # Most recent result of optimized_order()
+        self._lock = threading.Lock()
+        self._optimized = self._order
 
         # Resolve declared dependencies
         # Filters we have already resolved
@@ -864,15 +1722,57 @@ class FilterStack(object):
     def __iter__(self):
         return iter(self._order)
 
+    def optimized_order(self):
+        '''Return the filters in an order which is expected to minimize
+        the cost of evaluating an object, given the statistics collected so
+        far.  We repeatedly choose, from the filters whose dependencies have
+        already been chosen, the one with the lowest ratio of execution time
+        to drop probability.  Filters without statistics are run as early
+        as possible so that statistics can be gathered.'''
+        ranks = dict()
+        for filter in self._order:
+            cost = filter.stats.get_cost()
+            if cost is None:
+                ranks[filter] = 0
+            else:
+                execution_us, drop_rate = cost
+                if drop_rate > 0:
+                    ranks[filter] = execution_us / drop_rate
+                else:
+                    ranks[filter] = float('inf')
+        order = []
+        chosen = set()
+        remaining = list(self._order)
+        while remaining:
+            ready = [f for f in remaining
+                        if not [d for d in f.dependencies if d not in chosen]]
+            # min() returns the earliest of equally-ranked filters, so ties
+            # preserve the dependency order
+            filter = min(ready, key=lambda f: ranks[f])
+            order.append(filter)
+            chosen.add(filter.name)
+            remaining.remove(filter)
+        with self._lock:
+            if order != self._optimized:
+                self._optimized = order
+                _log.info('Reordered filters: %s',
+                                ', '.join([f.name for f in order]))
+        return order
+
     def bind(self, state, name='Filter', cleanup=None):
         '''Return a FilterStackRunner that can be used to process objects
         with this filter stack.'''
         fetcher = _ObjectFetcher(state)
         runners = [fetcher] + [f.bind(state) for f in self._order]
-        return FilterStackRunner(state, runners, name, cleanup)
+        return FilterStackRunner(state, runners, name, cleanup, self)
 
     def start_threads(self, state, count):
-        '''Start count threads to process objects with this filter stack.'''
+        '''Start count threads to process objects with this filter stack.
+        Return the FilterStackRunners.'''
         cleanup = Reference(state.blast.close)
+        threads = []
         for i in xrange(count):
-            self.bind(state, 'Filter-%d' % i, cleanup).start()
+            thread = self.bind(state, 'Filter-%d' % i, cleanup)
+            thread.start()
+            threads.append(thread)
+        return threads
@@ -103,6 +103,14 @@ class _ListeningSocket(object):
         return self.sock.accept()
 
 
+class _WakeupSocket(object):
+    '''A wrapper class for a socket which interrupts ConnListener.accept()
+    when it becomes readable.'''
+
+    def __init__(self, sock):
+        self.sock = sock
+
+
 class _PendingConnPollSet(object):
     '''Convenience wrapper around a select.poll object which works not with
     file descriptors, but with any object with a "sock" attribute containing
@@ -125,12 +133,13 @@ class _PendingConnPollSet(object):
         self._pollset.unregister(fd)
         del self._fd_to_pconn[fd]
 
-    def poll(self):
+    def poll(self, timeout=None):
         '''Poll for events and return a list of (pconn, eventmask) pairs.
-        pconn will be None for events on the listening socket.'''
+        pconn will be None for events on the listening socket.  timeout is
+        in milliseconds; the list is empty if it expires.'''
         while True:
             try:
-                items = self._pollset.poll()
+                items = self._pollset.poll(timeout)
             except select.error, e:
                 # If poll() was interrupted by a signal, retry.  If the
                 # signal was supposed to be fatal, the signal handler would
@@ -155,9 +164,10 @@ class _PendingConnPollSet(object):
 
 class ConnListener(object):
     '''Manager for listening socket and connections still in the matchmaking
-    process.'''
+    process.  If wakeup is specified, accept() returns None whenever that
+    socket is readable; the caller is responsible for draining it.'''
 
-    def __init__(self):
+    def __init__(self, wakeup=None):
         # Get a list of potential bind addresses
         addrs = socket.getaddrinfo(None, PORT, 0, socket.SOCK_STREAM, 0,
                                     socket.AI_PASSIVE)
@@ -185,6 +195,8 @@ class ConnListener(object):
         self._poll = _PendingConnPollSet()
         for sock in socks:
             self._poll.register(_ListeningSocket(sock), select.POLLIN)
+        if wakeup is not None:
+            self._poll.register(_WakeupSocket(wakeup), select.POLLIN)
         self._nonce_to_pending = WeakValueDictionary()
 
     def _accept(self, lsock):
@@ -243,11 +255,20 @@ class ConnListener(object):
             self._poll.unregister(pconn)
         return None
 
-    def accept(self):
-        '''Returns a new (control, data) connection pair.'''
+    def accept(self, timeout=None):
+        '''Returns a new (control, data) connection pair, or None if the
+        wakeup socket is readable or timeout seconds pass without a
+        connection event.'''
+        if timeout is not None:
+            timeout = int(timeout * 1000)
         while True:
-            for pconn, _flags in self._poll.poll():
-                if hasattr(pconn, 'accept'):
+            items = self._poll.poll(timeout)
+            if not items:
+                return None
+            for pconn, _flags in items:
+                if isinstance(pconn, _WakeupSocket):
+                    return None
+                elif hasattr(pconn, 'accept'):
                     # Listening socket
                     self._accept(pconn)
                 else:
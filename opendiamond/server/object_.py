@@ -12,9 +12,17 @@
 
 '''Representations of a Diamond object.'''
 
+from __future__ import with_statement
+from collections import deque
 from cStringIO import StringIO
+import errno
+import logging
+import os
 import pycurl as curl
-from urlparse import urljoin
+import select
+import signal
+import threading
+from urlparse import urljoin, urlparse
 import simplejson as json
 
 from opendiamond.helpers import murmur, split_scheme
@@ -31,6 +39,8 @@ ATTR_DEVICE_NAME = 'Device-Name'
 # Initialize curl before multiple threads have been started
 curl.global_init(curl.GLOBAL_DEFAULT)
 
+_log = logging.getLogger(__name__)
+
 
 class ObjectLoadError(Exception):
     '''Object failed to load.'''
@@ -74,8 +84,9 @@ class EmptyObject(object):
         else:
             raise KeyError()
 
-    def xdr_attributes(self, output_set=None, for_drop=False):
-        '''Return a list of XDR_attribute.'''
+    def _send_attributes(self, output_set, for_drop):
+        '''Return the set of attribute names to encode, and the subset of
+        them whose values should be encoded.'''
         if for_drop:
             # Reexecution dropped the object.  Only encode the object ID.
             send_keys = set([ATTR_OBJ_ID])
@@ -91,6 +102,11 @@ class EmptyObject(object):
             send_values = send_keys.intersection(output_set)
         else:
             send_values = send_keys
+        return send_keys, send_values
+
+    def xdr_attributes(self, output_set=None, for_drop=False):
+        '''Return a list of XDR_attribute.'''
+        send_keys, send_values = self._send_attributes(output_set, for_drop)
         # Serialize
         attrs = []
         for name in send_keys:
@@ -105,6 +121,17 @@ class EmptyObject(object):
         '''Return an XDR_object.'''
         return XDR_object(self.xdr_attributes(output_set))
 
+    def xdr_size(self, output_set=None):
+        '''Return the total size of the attribute names and values that
+        xdr() would encode, without encoding them.'''
+        send_keys, send_values = self._send_attributes(output_set, False)
+        return (sum(len(name) for name in send_keys) +
+                sum(len(self._attrs[name]) for name in send_values))
+
+    def get_size(self):
+        '''Return the total size of the attribute values in bytes.'''
+        return sum(len(v) for v in self._attrs.itervalues())
+
 
 class Object(EmptyObject):
     '''A mutable Diamond object.'''
@@ -112,6 +139,11 @@ class Object(EmptyObject):
     def __init__(self, server_id, url):
         EmptyObject.__init__(self)
         self._id = url
+        # Whether the object data has been loaded, and the ObjectLoadError
+        # (if any) produced by the load.  Allows an object to be loaded
+        # ahead of time by an ObjectPrefetcher.
+        self.loaded = False
+        self.load_error = None
 
         # Set default attributes
         self[ATTR_DEVICE_NAME] = server_id + '\0'
@@ -174,13 +206,186 @@ class _HttpLoader(object):
         self._body.write(data)
 
 
+class _HttpRequest(object):
+    '''A single fetch performed by an HttpMultiLoader.'''
+
+    def __init__(self, url, callback):
+        self.url = url
+        self.host = urlparse(url).netloc
+        self.callback = callback
+        self.headers = {}
+        self.body = StringIO()
+        self.error = None
+
+    def handle_header(self, hdr):
+        hdr = hdr.rstrip('\r\n')
+        if hdr.startswith('HTTP/'):
+            # New HTTP status line, discard existing headers
+            self.headers = {}
+        elif hdr != '':
+            # This is simplistic.
+            key, value = hdr.split(': ', 1)
+            self.headers[key] = value
+
+    def handle_body(self, data):
+        self.body.write(data)
+
+
+class HttpMultiLoader(object):
+    '''A context for loading Object data via HTTP which can be shared by
+    multiple threads.  A dedicated thread drives a CurlMulti handle, keeping
+    many requests in flight at once over reusable HTTP connections.  At most
+    http_host_connections requests are outstanding to any one host; further
+    requests are queued.'''
+
+    def __init__(self, config):
+        self._config = config
+        self._max_per_host = config.http_host_connections
+        self._multi = curl.CurlMulti()
+        self._lock = threading.Lock()
+        self._waiting = dict()	# host -> deque(_HttpRequest)
+        self._active = dict()	# host -> requests in flight
+        self._idle = []		# Curl handles not currently in use
+        # Pipe used to wake the HTTP thread when requests are queued
+        self._wake_read, self._wake_write = os.pipe()
+        thread = threading.Thread(target=self._run, name='HTTP')
+        thread.setDaemon(True)
+        thread.start()
+
+    def get_async(self, url, callback):
+        '''Start fetching the specified URL.  When the fetch completes,
+        callback(headers, body, error) is called from the HTTP thread.  On
+        success, error is None; on failure, headers and body are None and
+        error is an ObjectLoadError.'''
+        req = _HttpRequest(url, callback)
+        with self._lock:
+            self._waiting.setdefault(req.host, deque()).append(req)
+        os.write(self._wake_write, 'x')
+
+    def get(self, url):
+        '''Fetch the specified URL and return (header_dict, body).'''
+        done = threading.Event()
+        result = []
+        def callback(headers, body, error):
+            result.extend((headers, body, error))
+            done.set()
+        self.get_async(url, callback)
+        done.wait()
+        headers, body, error = result
+        if error is not None:
+            raise error
+        return (headers, body)
+
+    def _get_handle(self):
+        '''Return an idle Curl handle, creating one if necessary.'''
+        if self._idle:
+            return self._idle.pop()
+        c = curl.Curl()
+        c.setopt(curl.NOSIGNAL, 1)
+        c.setopt(curl.FAILONERROR, 1)
+        c.setopt(curl.USERAGENT, self._config.user_agent)
+        if self._config.http_proxy is not None:
+            c.setopt(curl.PROXY, self._config.http_proxy)
+        return c
+
+    def _start_requests(self):
+        '''Add waiting requests to the CurlMulti handle, subject to the
+        per-host limit.'''
+        with self._lock:
+            for host, waiting in self._waiting.items():
+                active = self._active.get(host, 0)
+                while waiting and active < self._max_per_host:
+                    req = waiting.popleft()
+                    c = self._get_handle()
+                    c.request = req
+                    c.setopt(curl.URL, req.url)
+                    c.setopt(curl.HEADERFUNCTION, req.handle_header)
+                    c.setopt(curl.WRITEFUNCTION, req.handle_body)
+                    self._multi.add_handle(c)
+                    active += 1
+                self._active[host] = active
+                if not waiting:
+                    del self._waiting[host]
+
+    def _finish(self, c, error):
+        '''Complete the request on the Curl handle and run its
+        callback.'''
+        req = c.request
+        c.request = None
+        self._multi.remove_handle(c)
+        with self._lock:
+            self._idle.append(c)
+            self._active[req.host] -= 1
+        # pylint: disable=broad-except
+        try:
+            if error is not None:
+                req.callback(None, None, ObjectLoadError(error))
+            else:
+                req.callback(req.headers, req.body.getvalue(), None)
+        except Exception:
+            _log.exception('HTTP callback exception')
+        # pylint: enable=broad-except
+
+    def _wait(self):
+        '''Wait for network activity, a curl timeout, or new requests.'''
+        read, write, exc = self._multi.fdset()
+        timeout = self._multi.timeout()
+        if timeout < 0:
+            if read or write or exc:
+                timeout = 1000
+            else:
+                # Nothing in flight; wait for new requests
+                timeout = None
+        if timeout is not None:
+            timeout = timeout / 1000.0
+        try:
+            ready = select.select(read + [self._wake_read], write, exc,
+                                    timeout)[0]
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+        if self._wake_read in ready:
+            os.read(self._wake_read, 4096)
+
+    # We want to catch all exceptions
+    # pylint: disable=broad-except
+    def _run(self):
+        '''Thread function.'''
+        try:
+            while True:
+                self._start_requests()
+                while True:
+                    ret, _count = self._multi.perform()
+                    if ret != curl.E_CALL_MULTI_PERFORM:
+                        break
+                while True:
+                    queued, succeeded, failed = self._multi.info_read()
+                    for c in succeeded:
+                        self._finish(c, None)
+                    for c, _errno, message in failed:
+                        self._finish(c, message)
+                    if queued == 0:
+                        break
+                self._wait()
+        except Exception:
+            _log.exception('HTTP thread exception')
+            os.kill(os.getpid(), signal.SIGUSR1)
+    # pylint: enable=broad-except
+
+
 class ObjectLoader(object):
     '''A context for populating an Object from the dataretriever.  Allows
     network connections to be reused to fetch multiple objects.  Must not
-    be used by more than one thread.'''
+    be used by more than one thread.
 
-    def __init__(self, config, blob_cache):
-        self._http = _HttpLoader(config)
+    If http is an HttpMultiLoader, it is used instead of a private HTTP
+    connection, and load_async() is available.'''
+
+    def __init__(self, config, blob_cache, http=None):
+        if http is None:
+            http = _HttpLoader(config)
+        self._http = http
         self._blob_cache = blob_cache
 
     def source_available(self, obj):
@@ -197,16 +402,82 @@ class ObjectLoader(object):
 
     def load(self, obj):
         '''Retrieve the Object and update it with the information we
-        receive.'''
+        receive.  If the Object has already been loaded, do nothing, or
+        re-raise the error produced by the earlier load.'''
+        if obj.load_error is not None:
+            raise obj.load_error
+        if obj.loaded:
+            return
+        try:
+            uri = str(obj)
+            scheme, path = split_scheme(uri)
+            if scheme == 'sha256':
+                self._load_blobcache(obj, path)
+            else:
+                headers, body = self._http.get(uri)
+                attr_url = self._load_data(obj, headers, body)
+                if attr_url is not None:
+                    _headers, body = self._http.get(attr_url)
+                    self._load_attributes(obj, body)
+        except ObjectLoadError, e:
+            obj.load_error = e
+            raise
+        self._load_done(obj)
+
+    def load_async(self, obj, callback):
+        '''Start loading the Object, calling callback(obj) when finished.
+        Any ObjectLoadError is recorded in the Object rather than raised.
+        The callback may be called from another thread.  Requires an
+        HttpMultiLoader.'''
+        def failed(error):
+            obj.load_error = error
+            callback(obj)
+        def attributes_fetched(_headers, body, error):
+            try:
+                if error is not None:
+                    raise error
+                self._load_attributes(obj, body)
+            except ObjectLoadError, e:
+                failed(e)
+            else:
+                self._load_done(obj)
+                callback(obj)
+        def data_fetched(headers, body, error):
+            try:
+                if error is not None:
+                    raise error
+                attr_url = self._load_data(obj, headers, body)
+            except ObjectLoadError, e:
+                failed(e)
+            else:
+                if attr_url is not None:
+                    self._http.get_async(attr_url, attributes_fetched)
+                else:
+                    self._load_done(obj)
+                    callback(obj)
+
+        if obj.loaded or obj.load_error is not None:
+            callback(obj)
+            return
         uri = str(obj)
         scheme, path = split_scheme(uri)
         if scheme == 'sha256':
-            self._load_blobcache(obj, path)
+            try:
+                self._load_blobcache(obj, path)
+            except ObjectLoadError, e:
+                failed(e)
+            else:
+                self._load_done(obj)
+                callback(obj)
         else:
-            self._load_dataretriever(obj, uri)
+            self._http.get_async(uri, data_fetched)
+
+    def _load_done(self, obj):
+        '''Finish loading the object.'''
         # Set display name if not already in initial attributes
         if ATTR_DISPLAY_NAME not in obj:
-            obj[ATTR_DISPLAY_NAME] = uri + '\0'
+            obj[ATTR_DISPLAY_NAME] = str(obj) + '\0'
+        obj.loaded = True
 
     def _load_blobcache(self, obj, signature):
         # Load the object data
@@ -215,8 +486,10 @@ class ObjectLoader(object):
         except KeyError:
             raise ObjectLoadError('Object not in cache')
 
-    def _load_dataretriever(self, obj, url):
-        headers, body = self._http.get(url)
+    def _load_data(self, obj, headers, body):
+        '''Load the object data and header attributes fetched from the
+        dataretriever.  Return the URL of the additional initial attributes,
+        or None if there are none.'''
         # Load the object data
         obj[ATTR_DATA] = body
         # Process loose initial attributes
@@ -226,14 +499,14 @@ class ObjectLoader(object):
                 obj[key] = value + '\0'
         # Fetch additional initial attributes if specified
         if ATTR_HEADER_URL in headers:
-            attr_url = urljoin(url, headers[ATTR_HEADER_URL])
-            self._load_attributes(obj, attr_url)
+            return urljoin(str(obj), headers[ATTR_HEADER_URL])
+        return None
 
     # The return type of json.loads() confuses pylint
     # pylint: disable=maybe-no-member
-    def _load_attributes(self, obj, url):
-        '''Load JSON-encoded attribute data from the specified URL.'''
-        _headers, body = self._http.get(url)
+    def _load_attributes(self, obj, body):
+        '''Load JSON-encoded attribute data fetched from the
+        dataretriever.'''
         try:
             attrs = json.loads(body)
             if not isinstance(attrs, dict):
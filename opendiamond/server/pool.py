@@ -0,0 +1,356 @@
+#
+#  The OpenDiamond Platform for Interactive Search
+#
+#  Copyright (c) 2011 Carnegie Mellon University
+#  All rights reserved.
+#
+#  This software is distributed under the terms of the Eclipse Public
+#  License, Version 1.0 which can be found in the file named LICENSE.
+#  ANY USE, REPRODUCTION OR DISTRIBUTION OF THIS SOFTWARE CONSTITUTES
+#  RECIPIENT'S ACCEPTANCE OF THIS AGREEMENT
+#
+
+'''Pool of initialized filter processes shared across searches.
+
+Starting a filter process can be expensive: the filter may need to import
+large libraries or load models from its blob argument.  When the filter
+pool is enabled, the supervisor keeps idle filter processes alive after
+their search exits and hands them to later searches running the same
+filter with the same arguments.
+
+A pooled process is represented by its pid, the file descriptors used to
+communicate with it, and a dictionary of protocol state.  Whenever the supervisor forks a
+search process, it hands part of its pool to the new child, which inherits
+the file descriptors, and then closes its own copies.  The supervisor does
+not know which filters the search will run, so it hands over the most
+recently idle processes for every filter, but no more processes per filter
+than the search has worker threads; the rest remain available to searches
+started concurrently.  The search process
+checks processes out of the pool as it needs them, and checks idle
+processes back in when its worker threads finish.  When the search process
+exits, it moves the pooled processes out of its cgroup and returns them to
+the supervisor over a socketpair, passing the file descriptors with
+SCM_RIGHTS.  The supervisor's main loop collects them after the search
+process has been reaped.  By then the returned processes are already
+buffered in the socketpair, so collection does not block.
+
+Pooled processes are evicted when they have been idle for too long or when
+the pool exceeds its size or memory limits.  The supervisor checks these
+limits periodically, even when no searches are running.  Closing the file
+descriptors causes the filter to exit on EOF; evicted processes are also
+killed, in case they are not reading their input.
+'''
+
+from __future__ import with_statement
+from multiprocessing.reduction import send_handle, recv_handle
+import errno
+import logging
+import os
+import shutil
+import signal
+import simplejson as json
+import socket
+import struct
+from tempfile import mkdtemp
+import threading
+import time
+
+# Seconds to wait for the supervisor to accept returned processes
+RETURN_TIMEOUT = 5
+
+_log = logging.getLogger(__name__)
+
+class _PoolEntry(object):
+    '''An idle filter process.'''
+
+    def __init__(self, key, name, pid, fds, state, idle_since=None):
+        self.key = key		# Filter cache digest
+        self.name = name
+        self.pid = pid
+        self.fds = fds		# fds for communicating with the filter
+        self.state = state	# JSON-serializable protocol state
+        if idle_since is None:
+            idle_since = time.time()
+        self.idle_since = idle_since
+
+    def __str__(self):
+        return '%s (pid %d)' % (self.name, self.pid)
+
+    def is_alive(self):
+        try:
+            os.kill(self.pid, 0)
+            return True
+        except OSError:
+            return False
+
+    def get_rss(self):
+        '''Return the resident set size of the process in bytes, or None if
+        the process no longer exists.'''
+        try:
+            with open('/proc/%d/statm' % self.pid) as fh:
+                pages = int(fh.read().split()[1])
+            return pages * os.sysconf('SC_PAGE_SIZE')
+        except (IOError, IndexError, ValueError):
+            return None
+
+    def move_to_cgroup(self, taskfile):
+        '''Move the process into the cgroup with the specified tasks file.
+        Return False if this could not be done.'''
+        try:
+            with open(taskfile, 'w') as fh:
+                fh.write('%d\n' % self.pid)
+            return True
+        except IOError:
+            return False
+
+    def close(self, kill=True):
+        '''Close our file descriptors for the process.  If kill is True,
+        also kill the process.'''
+        for fd in self.fds:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        if kill:
+            try:
+                os.kill(self.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+
+class FilterPool(object):
+    '''Idle filter processes, keyed by filter cache digest.  Created in the
+    supervisor, and inherited by each search process.'''
+
+    _length = struct.Struct('>I')
+
+    def __init__(self, config):
+        self._max_processes = config.filter_pool_size
+        self._max_idle = config.filter_pool_idle
+        self._max_bytes = config.filter_pool_bytes
+        # Each worker thread of a search uses one process per filter
+        self._max_per_search = config.threads
+        if config.cgroupdir is not None:
+            self._root_taskfile = os.path.join(config.cgroupdir, 'tasks')
+        else:
+            self._root_taskfile = None
+        # Working directory for pooled filters, which must outlive the
+        # search that started them
+        self.directory = mkdtemp(prefix='diamond-pool-')
+        self._lock = threading.Lock()
+        self._entries = []	# _PoolEntry, least recently idle first
+        # Supervisor: pid -> socket for processes returned by that child
+        self._children = dict()
+        # Supervisor: socketpair for the child currently being forked
+        self._pending = None
+        # Search process: socket for returning processes to the supervisor
+        self._sock = None
+
+    ## Supervisor
+
+    def prepare_fork(self):
+        '''Called by the supervisor before forking a search process.  Return
+        the entries to be handed to the child.'''
+        self.evict()
+        self._pending = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Hand over the most recently idle entries for each filter, keeping
+        # the rest for other searches
+        entries = []
+        keep = []
+        counts = dict()
+        for entry in reversed(self._entries):
+            count = counts.get(entry.key, 0)
+            if count < self._max_per_search:
+                entries.append(entry)
+                counts[entry.key] = count + 1
+            else:
+                keep.append(entry)
+        entries.reverse()
+        keep.reverse()
+        self._entries = keep
+        return entries
+
+    def forked_parent(self, pid, entries):
+        '''Called by the supervisor after forking search process pid, which
+        now owns entries.'''
+        sock, child_sock = self._pending
+        self._pending = None
+        child_sock.close()
+        self._children[pid] = sock
+        for entry in entries:
+            entry.close(kill=False)
+
+    def collect(self, pid):
+        '''Called by the supervisor after search process pid exits.  Add
+        the processes it returned to the pool.'''
+        try:
+            sock = self._children.pop(pid)
+        except KeyError:
+            return
+        count = 0
+        try:
+            # The child has exited, so everything it returned is already
+            # buffered.  Don't hang if a descendant of the child still holds
+            # the other end of the socket.
+            sock.setblocking(0)
+            while True:
+                buf = self._recv(sock, self._length.size)
+                if buf is None:
+                    break
+                length, = self._length.unpack(buf)
+                buf = self._recv(sock, length)
+                if buf is None:
+                    break
+                meta = json.loads(buf)
+                fds = []
+                for _i in range(meta['fds']):
+                    # recv_handle() does not detect EOF
+                    if self._recv(sock, 1, socket.MSG_PEEK) is None:
+                        break
+                    fds.append(recv_handle(sock))
+                if len(fds) < meta['fds']:
+                    for fd in fds:
+                        os.close(fd)
+                    break
+                self._entries.append(_PoolEntry(meta['key'], meta['name'],
+                                meta['pid'], fds, meta['state'],
+                                meta['idle_since']))
+                count += 1
+        except (socket.error, OSError, ValueError, KeyError), e:
+            _log.warning('Failed to collect filter processes from PID %d: %s',
+                                pid, e)
+        finally:
+            sock.close()
+        if count:
+            _log.info('PID %d returned %d filter processes', pid, count)
+        self.evict()
+
+    def evict(self):
+        '''Called by the supervisor, including periodically while idle.
+        Discard dead processes and processes beyond the configured
+        limits, preferring to keep the most recently used ones.'''
+        now = time.time()
+        keep = []
+        total = 0
+        for entry in reversed(self._entries):
+            rss = entry.get_rss()
+            if (rss is None or now - entry.idle_since > self._max_idle or
+                        total + rss > self._max_bytes or
+                        len(keep) >= self._max_processes):
+                entry.close()
+            else:
+                keep.append(entry)
+                total += rss
+        keep.reverse()
+        self._entries = keep
+
+    def close(self):
+        '''Called by the supervisor at shutdown.  Kill all pooled
+        processes.'''
+        for entry in self._entries:
+            entry.close()
+        self._entries = []
+        for sock in self._children.itervalues():
+            sock.close()
+        self._children.clear()
+        shutil.rmtree(self.directory, True)
+
+    def _recv(self, sock, count, flags=0):
+        '''Read exactly count bytes from non-blocking sock, or return None
+        on EOF or when no more data is buffered.'''
+        buf = ''
+        while len(buf) < count:
+            try:
+                data = sock.recv(count - len(buf), flags)
+            except socket.error, e:
+                if e.args[0] == errno.EAGAIN:
+                    return None
+                raise
+            if not data:
+                return None
+            buf += data
+        return buf
+
+    ## Search process
+
+    def forked_child(self, entries, taskfile=None):
+        '''Called in a newly-forked search process to take ownership of
+        entries.  If taskfile is specified, move the processes into the
+        cgroup with that tasks file, so they are killed if the search
+        process dies.'''
+        sock, child_sock = self._pending
+        self._pending = None
+        sock.close()
+        for sock in self._children.itervalues():
+            sock.close()
+        self._children.clear()
+        # Entries kept by the supervisor for other searches
+        for entry in self._entries:
+            entry.close(kill=False)
+        self._entries = []
+        self._sock = child_sock
+        for entry in entries:
+            if taskfile is None or entry.move_to_cgroup(taskfile):
+                self._entries.append(entry)
+            else:
+                entry.close()
+
+    def checkout(self, key):
+        '''Remove and return a live _PoolEntry for the specified key, or
+        None if there are none.'''
+        with self._lock:
+            while True:
+                for i in xrange(len(self._entries) - 1, -1, -1):
+                    if self._entries[i].key == key:
+                        entry = self._entries.pop(i)
+                        break
+                else:
+                    return None
+                if entry.is_alive():
+                    _log.debug('Reusing filter process %s', entry)
+                    return entry
+                entry.close()
+
+    def checkin(self, key, name, pid, fds, state):
+        '''Add an idle filter process to the pool.  The pool takes ownership
+        of the file descriptors.  state is a JSON-serializable object
+        describing the process.'''
+        with self._lock:
+            self._entries.append(_PoolEntry(key, name, pid, fds, state))
+            while len(self._entries) > self._max_processes:
+                self._entries.pop(0).close()
+
+    def return_to_supervisor(self):
+        '''Called when the search process is shutting down.  Send the pooled
+        processes to the supervisor.'''
+        with self._lock:
+            entries, self._entries = self._entries, []
+            sock, self._sock = self._sock, None
+        if sock is None:
+            return
+        sock.settimeout(RETURN_TIMEOUT)
+        try:
+            while entries:
+                entry = entries[0]
+                if (self._root_taskfile is not None and
+                            not entry.move_to_cgroup(self._root_taskfile)):
+                    entries.pop(0).close()
+                    continue
+                meta = json.dumps({
+                    'key': entry.key,
+                    'name': entry.name,
+                    'pid': entry.pid,
+                    'fds': len(entry.fds),
+                    'state': entry.state,
+                    'idle_since': entry.idle_since,
+                })
+                sock.sendall(self._length.pack(len(meta)) + meta)
+                for fd in entry.fds:
+                    send_handle(sock, fd, None)
+                entries.pop(0).close(kill=False)
+        except (socket.error, OSError), e:
+            _log.warning("Couldn't return filter processes: %s", e)
+            for entry in entries:
+                entry.close()
+        finally:
+            sock.close()
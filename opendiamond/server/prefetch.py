@@ -0,0 +1,184 @@
+#
+#  The OpenDiamond Platform for Interactive Search
+#
+#  Copyright (c) 2011 Carnegie Mellon University
+#  All rights reserved.
+#
+#  This software is distributed under the terms of the Eclipse Public
+#  License, Version 1.0 which can be found in the file named LICENSE.
+#  ANY USE, REPRODUCTION OR DISTRIBUTION OF THIS SOFTWARE CONSTITUTES
+#  RECIPIENT'S ACCEPTANCE OF THIS AGREEMENT
+#
+
+'''Loading of object data ahead of the worker threads.'''
+
+from __future__ import with_statement
+from collections import deque
+import logging
+import os
+import signal
+import threading
+
+from opendiamond.server.object_ import ObjectLoader, ObjectLoadError
+
+_log = logging.getLogger(__name__)
+
+class ObjectPrefetcher(object):
+    '''Iterator over the objects produced by a ScopeListLoader, returning
+    objects whose data has already been loaded from the dataretriever.
+
+    A set of fetcher threads pulls objects from the scope list and loads
+    them into a queue, staying at most prefetch_depth objects and
+    prefetch_bytes bytes of object data ahead of the worker threads.  An
+    object that fails to load is queued anyway; the error is re-raised when
+    a worker thread tries to load it.
+
+    If http is an HttpMultiLoader, a single fetcher thread starts
+    asynchronous loads and the HttpMultiLoader keeps them in flight.
+
+    If bind is specified, it is called to create a FilterStackRunner for
+    each fetcher thread.  Objects which its result cache lookups show will
+    be dropped are queued without being loaded, so that searches answered
+    from the result cache do not fetch objects they never examine.'''
+
+    def __init__(self, config, blob_cache, scope, http=None, bind=None):
+        self._scope = scope
+        self._max_objects = config.prefetch_depth
+        self._max_bytes = config.prefetch_bytes
+        self._cond = threading.Condition()
+        self._queue = deque()	# loaded objects
+        self._bytes = 0		# size of loaded objects in the queue
+        self._reserved = 0	# queued objects plus objects being loaded
+        self._running = 0	# fetcher threads and loads in progress
+        if http is not None:
+            target = self._async_fetch_thread
+            count = 1
+        else:
+            target = self._fetch_thread
+            # Hide fetch latency for as many objects as we have workers
+            count = max(1, min(config.threads, self._max_objects))
+        for i in xrange(count):
+            loader = ObjectLoader(config, blob_cache, http)
+            if bind is not None:
+                runner = bind()
+            else:
+                runner = None
+            thread = threading.Thread(target=target,
+                                    name='Prefetch-%d' % i,
+                                    args=(loader, runner))
+            thread.setDaemon(True)
+            self._running += 1
+            thread.start()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        '''Return the next loaded Object.'''
+        with self._cond:
+            while len(self._queue) == 0:
+                if self._running == 0:
+                    raise StopIteration()
+                self._cond.wait()
+            obj, size = self._queue.popleft()
+            self._bytes -= size
+            self._reserved -= 1
+            self._cond.notify_all()
+            return obj
+
+    def get_count(self):
+        '''Return our current understanding of the number of objects in
+        scope.'''
+        return self._scope.get_count()
+
+    def _reserve(self):
+        '''Wait until there is room in the queue for another object, then
+        reserve it.'''
+        with self._cond:
+            # Always allow at least one object, even if it exceeds the
+            # byte budget by itself
+            while self._reserved > 0 and (
+                            self._reserved >= self._max_objects or
+                            self._bytes >= self._max_bytes):
+                self._cond.wait()
+            self._reserved += 1
+
+    def _unreserve(self):
+        with self._cond:
+            self._reserved -= 1
+            self._cond.notify_all()
+
+    def _enqueue(self, obj):
+        '''Add a loaded object to the queue.'''
+        size = obj.get_size()
+        with self._cond:
+            self._queue.append((obj, size))
+            self._bytes += size
+            self._cond.notify_all()
+
+    def _loaded(self, obj):
+        '''Callback from an asynchronous load.'''
+        self._enqueue(obj)
+        with self._cond:
+            self._running -= 1
+            self._cond.notify_all()
+
+    # We want to catch all exceptions
+    # pylint: disable=broad-except
+    def _fetch_thread(self, loader, runner):
+        '''Thread function.'''
+        try:
+            try:
+                while True:
+                    self._reserve()
+                    try:
+                        # ScopeListLoader properly handles interleaved
+                        # access by multiple threads
+                        obj = self._scope.next()
+                    except StopIteration:
+                        self._unreserve()
+                        break
+                    if runner is not None and runner.result_cache_drops(obj):
+                        # The worker thread will drop it without loading it
+                        self._enqueue(obj)
+                        continue
+                    try:
+                        loader.load(obj)
+                    except ObjectLoadError:
+                        # Recorded in the object; the worker thread will
+                        # report it
+                        pass
+                    self._enqueue(obj)
+            finally:
+                with self._cond:
+                    self._running -= 1
+                    self._cond.notify_all()
+        except Exception:
+            _log.exception('Prefetch thread exception')
+            os.kill(os.getpid(), signal.SIGUSR1)
+
+    def _async_fetch_thread(self, loader, runner):
+        '''Thread function when using an HttpMultiLoader.'''
+        try:
+            try:
+                while True:
+                    self._reserve()
+                    try:
+                        obj = self._scope.next()
+                    except StopIteration:
+                        self._unreserve()
+                        break
+                    if runner is not None and runner.result_cache_drops(obj):
+                        self._enqueue(obj)
+                        continue
+                    with self._cond:
+                        self._running += 1
+                    loader.load_async(obj, self._loaded)
+            finally:
+                with self._cond:
+                    self._running -= 1
+                    self._cond.notify_all()
+        except Exception:
+            _log.exception('Prefetch thread exception')
+            os.kill(os.getpid(), signal.SIGUSR1)
+    # pylint: enable=broad-except
@@ -13,16 +13,26 @@
 '''Scope list retrieval, parsing, and iteration.'''
 
 from __future__ import with_statement
+from collections import deque
 import logging
+import os
+from redis import Redis
+import signal
 import urllib2
 from urlparse import urljoin
 import threading
 from xml.sax import make_parser, SAXParseException
 from xml.sax.handler import ContentHandler
 
+from opendiamond.helpers import murmur
+from opendiamond.scope import ScopeError
 from opendiamond.server.object_ import Object
 
 BASE_URL = 'http://localhost:5873/'
+# Bytes to read from a scope list at a time
+READ_SIZE = 65536
+# Seconds to keep work-stealing claim counters in Redis
+CLAIM_EXPIRATION = 86400
 
 _log = logging.getLogger(__name__)
 
@@ -32,7 +42,7 @@ class _ScopeListHandler(ContentHandler):
     def __init__(self):
         ContentHandler.__init__(self)
         self.count = 0
-        self.pending_objects = []
+        self.pending_objects = deque()
 
     # We're overriding a method; we can't control its name
     # pylint: disable=invalid-name
@@ -49,28 +59,220 @@ class _ScopeListHandler(ContentHandler):
     # pylint: enable=invalid-name
 
 
+class _ScopeSource(object):
+    '''A scope list URL and the objects read from it but not yet consumed.
+    If partition is specified, the objects are divided among servers:
+    by rendezvous hashing, taking the share of the servers named in ours,
+    or by work stealing, taking the chunks of claim_size objects that we
+    claim from a counter in Redis.'''
+
+    def __init__(self, url, partition=None, servers=None, ours=None,
+                    claim_name=None, claim_size=None):
+        self.url = url
+        self.partition = partition	# Partitioning scheme, or None
+        self.servers = servers	# Servers sharing the scope list, or None
+        self.ours = ours	# Our names in servers
+        self.claim_name = claim_name	# Scope list name shared by servers
+        self.claim_key = None	# Redis key of the chunk counter
+        self.claim_size = claim_size	# Objects per chunk
+        self.claimed = -1	# Our most recently claimed chunk
+        self.position = 0	# Index of the next object in the list
+        self.handler = _ScopeListHandler()
+        self.queue = deque()	# Objects
+        self.fetched = 0	# Objects read so far
+        self.skipped = 0	# Objects belonging to other servers
+        self.started = False
+        self.finished = False
+        self.error = None	# Description of the failure, if any
+
+    def owns(self, url, redis=None):
+        '''Return True if the object URL, the next one in the list, is in
+        our share of the scope list.  redis is needed for work stealing.'''
+        position = self.position
+        self.position += 1
+        if self.partition is None:
+            return True
+        elif self.partition == 'consistent-hash':
+            owner = max(self.servers, key=lambda s: murmur(s + '\0' + url))
+            return owner in self.ours
+        else:
+            # Claim chunks until we reach this one or pass it
+            chunk = position // self.claim_size
+            while self.claimed < chunk:
+                self.claimed = redis.incr(self.claim_key) - 1
+                if self.claimed == 0:
+                    redis.expire(self.claim_key, CLAIM_EXPIRATION)
+            return self.claimed == chunk
+
+    def get_count(self):
+        '''Return our current understanding of the number of objects in
+        our share of the scope list.'''
+        if self.partition is None:
+            return self.handler.count
+        elif self.finished:
+            return self.handler.count - self.skipped
+        elif self.partition == 'consistent-hash':
+            # Assume an even division until we've seen all of the objects
+            share = self.handler.count * len(self.ours) // len(self.servers)
+            return max(share, self.fetched)
+        else:
+            # Assume an even division of the objects not yet claimed
+            remaining = self.handler.count - self.fetched - self.skipped
+            return self.fetched + max(remaining, 0) // len(self.servers)
+
+
 class ScopeListLoader(object):
     '''Iterator over the objects in the scope lists referenced by the scope
-    cookies.'''
+    cookies.
+
+    When iteration begins, producer threads start fetching and parsing the
+    scope lists concurrently, at most scope_fetches at a time.  Each scope
+    list has its own queue of at most scope_queue_depth objects, so that a
+    slow data store does not delay objects from the others.  Worker threads
+    take objects from the queues in round-robin order without waiting for
+    each other's network reads or parsing.
+
+    If a cookie specifies a partitioning scheme, its scope lists are
+    shared by all of the servers named in the cookie.  With consistent-hash
+    partitioning we only search the objects whose URLs hash to one of our
+    server names.  With work stealing, the servers claim chunks of each
+    scope list from a counter in the Redis cache server, so that faster
+    servers search more of the objects; each of these scope lists reads
+    ahead by at most one chunk, so that we don't claim more objects than we
+    are ready to search.'''
 
     def __init__(self, config, server_id, cookies):
         self.server_id = server_id
         self.cookies = cookies
         self._config = config
+        self._max_queue = max(config.scope_queue_depth, 1)
         self._lock = threading.Lock()
-        self._handler = _ScopeListHandler()
-        self._generator = self._generator_func()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._sources = []
+        for cookie in cookies:
+            if cookie.partition is None:
+                servers = ours = None
+            elif cookie.partition in ('consistent-hash', 'work-stealing'):
+                servers = sorted(set(cookie.servers))
+                ours = set(servers) & set(config.serverids)
+            else:
+                raise ScopeError('Unsupported partitioning scheme: %s' %
+                                    cookie.partition)
+            if (cookie.partition == 'work-stealing' and
+                                    config.cache_server is None):
+                raise ScopeError('Work stealing requires a cache server')
+            for url in cookie:
+                self._sources.append(_ScopeSource(urljoin(BASE_URL, url),
+                                    cookie.partition, servers, ours,
+                                    '%s:%s' % (cookie.serial, url),
+                                    max(config.scope_claim_size, 1)))
+        # Sources which may still produce objects, in round-robin order
+        self._active = deque(self._sources)
+        self._pending = deque(self._sources)	# Sources not yet started
+        self._started = False
 
     def __iter__(self):
         return self
 
+    def set_search_id(self, search_id):
+        '''Set the search ID shared by all of the servers, which identifies
+        the search to other servers when stealing work.  Must be called
+        before iteration begins.'''
+        for source in self._sources:
+            source.claim_key = 'scope-claim:%s:%s' % (search_id,
+                                    source.claim_name)
+
     def next(self):
         '''Return the next Object.'''
         with self._lock:
-            return self._generator.next()
+            if not self._started:
+                self._started = True
+                self._start_threads()
+            while True:
+                for _i in xrange(len(self._active)):
+                    source = self._active[0]
+                    if source.queue:
+                        # Take from the next source in turn
+                        self._active.rotate(-1)
+                        self._not_full.notify_all()
+                        return source.queue.popleft()
+                    elif source.finished:
+                        self._active.popleft()
+                    else:
+                        self._active.rotate(-1)
+                if len(self._active) == 0:
+                    raise StopIteration()
+                self._not_empty.wait()
 
-    def _generator_func(self):
-        # Build URL opener
+    def _start_threads(self):
+        count = min(max(self._config.scope_fetches, 1), len(self._sources))
+        if count == 0:
+            _log.info('End of scope list')
+        for i in xrange(count):
+            thread = threading.Thread(target=self._producer_thread,
+                                    name='ScopeList-%d' % i)
+            thread.setDaemon(True)
+            thread.start()
+
+    def _put(self, source, obj):
+        '''Wait until there is room in the source's queue, then add obj.'''
+        if source.partition == 'work-stealing':
+            max_queue = min(self._max_queue, source.claim_size)
+        else:
+            max_queue = self._max_queue
+        with self._lock:
+            while len(source.queue) >= max_queue:
+                self._not_full.wait()
+            source.queue.append(obj)
+            source.fetched += 1
+            self._not_empty.notify()
+
+    # We want to catch all exceptions
+    # pylint: disable=broad-except
+    def _producer_thread(self):
+        '''Thread function.  Fetch scope lists until there are none left.'''
+        try:
+            opener = self._build_opener()
+            redis = None
+            while True:
+                with self._lock:
+                    if not self._pending:
+                        break
+                    source = self._pending.popleft()
+                    source.started = True
+                if source.partition == 'work-stealing' and redis is None:
+                    host, port = self._config.cache_server
+                    redis = Redis(host=host, port=port,
+                                    db=self._config.cache_database,
+                                    password=self._config.cache_password)
+                try:
+                    for obj in self._fetch(source, opener, redis):
+                        self._put(source, obj)
+                finally:
+                    with self._lock:
+                        source.finished = True
+                        self._not_empty.notify_all()
+                        done = not [s for s in self._sources
+                                    if not s.finished]
+                if source.error is not None:
+                    _log.warning('Scope list %s failed after %d objects: %s',
+                                    source.url, source.fetched, source.error)
+                elif source.servers is not None:
+                    _log.info('Scope list %s: %d objects, %d skipped for '
+                                    'other servers', source.url,
+                                    source.fetched, source.skipped)
+                else:
+                    _log.info('Scope list %s: %d objects', source.url,
+                                    source.fetched)
+                if done:
+                    _log.info('End of scope list')
+        except Exception:
+            _log.exception('Scope list thread exception')
+            os.kill(os.getpid(), signal.SIGUSR1)
+    # pylint: enable=broad-except
+
+    def _build_opener(self):
         handlers = []
         if self._config.http_proxy is not None:
             handlers.append(urllib2.ProxyHandler({
@@ -79,47 +281,47 @@ class ScopeListLoader(object):
             }))
         opener = urllib2.build_opener(*handlers)
         opener.addheaders = [('User-Agent', self._config.user_agent)]
-        # Build XML parser
+        return opener
+
+    def _fetch(self, source, opener, redis=None):
+        '''Generator over the objects in our share of the source's scope
+        list.  redis is needed for work stealing.'''
         parser = make_parser()
-        parser.setContentHandler(self._handler)
-        # Walk scope URLs
-        for cookie in self.cookies:
-            for scope_url in cookie:
-                scope_url = urljoin(BASE_URL, scope_url)
-                try:
-                    # We use urllib2 here because different parts of a single
-                    # HTTP response will be handled from different threads.
-                    # pycurl does not support this.
-                    fh = opener.open(scope_url)
-                    # Read the scope list in 4 KB chunks
-                    while True:
-                        buf = fh.read(4096)
-                        if len(buf) == 0:
-                            break
-                        parser.feed(buf)
-                        while len(self._handler.pending_objects) > 0:
-                            url = self._handler.pending_objects.pop(0)
-                            yield Object(self.server_id,
-                                            urljoin(scope_url, url))
-                except urllib2.URLError, e:
-                    _log.warning('Fetching %s: %s', scope_url, e)
-                except SAXParseException, e:
-                    _log.warning('Parsing %s: %s', scope_url, e)
-                finally:
-                    try:
-                        parser.close()
-                    except SAXParseException:
-                        # Received malformed XML, such as XML with missing
-                        # closing tags.  This is likely caused by a
-                        # prematurely-terminated connection.
-                        _log.warning('Parsing %s: incomplete scope list',
-                                        scope_url)
-                    parser.reset()
-        # Log successful completion
-        _log.info('End of scope list')
+        parser.setContentHandler(source.handler)
+        try:
+            fh = opener.open(source.url)
+            while True:
+                buf = fh.read(READ_SIZE)
+                if len(buf) == 0:
+                    break
+                parser.feed(buf)
+                pending = source.handler.pending_objects
+                while len(pending) > 0:
+                    url = urljoin(source.url, pending.popleft())
+                    if source.owns(url, redis):
+                        yield Object(self.server_id, url)
+                    else:
+                        with self._lock:
+                            source.skipped += 1
+        except urllib2.URLError, e:
+            _log.warning('Fetching %s: %s', source.url, e)
+            source.error = str(e)
+        except SAXParseException, e:
+            _log.warning('Parsing %s: %s', source.url, e)
+            source.error = str(e)
+        finally:
+            try:
+                parser.close()
+            except SAXParseException:
+                # Received malformed XML, such as XML with missing
+                # closing tags.  This is likely caused by a
+                # prematurely-terminated connection.
+                _log.warning('Parsing %s: incomplete scope list', source.url)
+                if source.error is None:
+                    source.error = 'incomplete scope list'
 
     def get_count(self):
         '''Return our current understanding of the number of objects in
         scope.'''
         with self._lock:
-            return self._handler.count
+            return sum([s.get_count() for s in self._sources])
@@ -12,33 +12,54 @@
 
 '''Search state; control and blast channel handling.'''
 
-from functools import wraps
+from __future__ import with_statement
+from collections import deque
+from functools import partial, wraps
 import logging
+import os
+import signal
+import threading
+import weakref
 
 from opendiamond import protocol
 from opendiamond.blobcache import ExecutableBlobCache
 from opendiamond.protocol import (DiamondRPCFailure, DiamondRPCFCacheMiss,
         DiamondRPCCookieExpired, DiamondRPCSchemeNotSupported)
-from opendiamond.rpc import RPCHandlers, RPCError, RPCProcedureUnavailable
+from opendiamond.rpc import (RPCHandlers, RPCError, RPCProcedureUnavailable,
+        ConnectionFailure)
 from opendiamond.scope import ScopeCookie, ScopeError, ScopeCookieExpired
+from opendiamond.server.cache import MemoryCache
 from opendiamond.server.filter import (FilterStack, Filter,
         FilterDependencyError, FilterUnsupportedSource)
-from opendiamond.server.object_ import EmptyObject, Object, ObjectLoader
+from opendiamond.server.object_ import (EmptyObject, Object, ObjectLoader,
+        HttpMultiLoader)
+from opendiamond.server.prefetch import ObjectPrefetcher
 from opendiamond.server.scopelist import ScopeListLoader
 from opendiamond.server.sessionvars import SessionVariables
-from opendiamond.server.statistics import SearchStatistics
+from opendiamond.server.statistics import SearchStatistics, Timer
 
 _log = logging.getLogger(__name__)
 
 class SearchState(object):
     '''Search state that is also needed by filter code.'''
-    def __init__(self, config):
+    def __init__(self, config, pool=None):
         self.config = config
+        self.pool = pool	# FilterPool, or None
         self.blob_cache = ExecutableBlobCache(config.cachedir)
         self.session_vars = SessionVariables()
         self.stats = SearchStatistics()
         self.scope = None
         self.blast = None
+        # In-process result and attribute cache, if configured
+        if config.cache_lru_bytes > 0:
+            self.cache = MemoryCache(config.cache_lru_bytes)
+        else:
+            self.cache = None
+        # Shared HTTP context, if configured
+        if config.http_host_connections > 0:
+            self.http = HttpMultiLoader(config)
+        else:
+            self.http = None
 
 
 class Search(RPCHandlers):
@@ -47,12 +68,15 @@ class Search(RPCHandlers):
 
     log_rpcs = True
 
-    def __init__(self, config, blast_conn):
+    def __init__(self, config, blast_conn, pool=None):
         RPCHandlers.__init__(self)
         self._server_id = config.serverids[0]  # Canonical server ID
         self._blast_conn = blast_conn
-        self._state = SearchState(config)
+        self._state = SearchState(config, pool)
         self._filters = FilterStack()
+        # Weak references, so finished workers can be collected and fire
+        # their cleanup callback
+        self._workers = []
         self._running = False
 
     def shutdown(self):
@@ -62,6 +86,13 @@ class Search(RPCHandlers):
             self._state.stats.log()
             for filter in self._filters:
                 filter.stats.log()
+        # Return idle filter processes to the supervisor
+        if self._state.pool is not None:
+            for ref in self._workers:
+                worker = ref()
+                if worker is not None:
+                    worker.release()
+            self._state.pool.return_to_supervisor()
 
     # This is not a static method: it's only called when initializing the
     # class, and the staticmethod() decorator does not create a callable.
@@ -149,6 +180,8 @@ class Search(RPCHandlers):
                 log_header(cookie.serial)
                 log_item('Servers', '%s', ', '.join(cookie.servers))
                 log_item('Expires', '%s', cookie.expires)
+                if cookie.partition is not None:
+                    log_item('Partition', '%s', cookie.partition)
                 cookie.verify(self._state.config.serverids,
                                 self._state.config.certdata)
             scope = ScopeListLoader(self._state.config, self._server_id,
@@ -165,14 +198,20 @@ class Search(RPCHandlers):
         self._state.scope = scope
         return protocol.XDR_blob_list(missing)
 
-    @RPCHandlers.handler(26, protocol.XDR_blob_data)
+    @RPCHandlers.handler(26, stream=True)
     @running(False)
-    def send_blobs(self, params):
-        '''Add blobs to the blob cache.'''
-        _log.info('Received %d blobs, %d bytes', len(params.blobs),
-                    sum([len(b) for b in params.blobs]))
-        for blob in params.blobs:
-            self._state.blob_cache.add(blob)
+    def send_blobs(self, body):
+        '''Add blobs to the blob cache.  body is an XDR_blob_data, which is
+        parsed as it arrives so that each blob is written to the cache
+        without being held in memory.'''
+        count = body.read_uint()
+        total = 0
+        for _i in xrange(count):
+            length = body.read_uint()
+            self._state.blob_cache.add_stream(body.read_chunks(length))
+            body.skip(-length & 3)
+            total += length
+        _log.info('Received %d blobs, %d bytes', count, total)
 
     @RPCHandlers.handler(28, protocol.XDR_start)
     @running(False)
@@ -188,10 +227,24 @@ class Search(RPCHandlers):
         else:
             # Encode everything
             push_attrs = None
-        self._state.blast = BlastChannel(self._blast_conn, push_attrs)
+        self._state.blast = BlastChannel(self._state.config,
+                            self._state.stats, self._blast_conn, push_attrs)
+        self._state.scope.set_search_id(params.search_id)
+        if self._state.config.prefetch_depth > 0:
+            # Load objects ahead of the worker threads, skipping objects
+            # that the result cache shows will be dropped
+            if self._state.config.cache_server is not None:
+                bind = partial(self._filters.bind, self._state)
+            else:
+                bind = None
+            self._state.scope = ObjectPrefetcher(self._state.config,
+                            self._state.blob_cache, self._state.scope,
+                            self._state.http, bind)
         self._running = True
         _log.info('Starting search %s', params.search_id)
-        self._filters.start_threads(self._state, self._state.config.threads)
+        self._workers = [weakref.ref(worker) for worker in
+                                    self._filters.start_threads(self._state,
+                                    self._state.config.threads)]
 
     @RPCHandlers.handler(30, protocol.XDR_reexecute,
                              protocol.XDR_attribute_list)
@@ -205,10 +258,12 @@ class Search(RPCHandlers):
         _log.info('Reexecuting on object %s', params.object_id)
         runner = self._filters.bind(self._state)
         obj = Object(self._server_id, params.object_id)
-        loader = ObjectLoader(self._state.config, self._state.blob_cache)
+        loader = ObjectLoader(self._state.config, self._state.blob_cache,
+                            self._state.http)
         if not loader.source_available(obj):
             raise DiamondRPCFCacheMiss()
         drop = not runner.evaluate(obj)
+        runner.release()
         if params.attrs is not None:
             output_attrs = set(params.attrs)
         else:
@@ -223,7 +278,7 @@ class Search(RPCHandlers):
         '''Return current search statistics.'''
         filter_stats = [f.stats for f in self._filters]
         return self._state.stats.xdr(self._state.scope.get_count(),
-                            filter_stats)
+                            filter_stats, self._state.blast.get_queued())
 
     @RPCHandlers.handler(18, reply_class=protocol.XDR_session_vars)
     @running(True)
@@ -244,41 +299,121 @@ class Search(RPCHandlers):
         self._state.session_vars.client_set(values)
 
 
-class _BlastChannelSender(RPCHandlers):
-    '''Single-use RPC handler for sending an XDR_object on the blast
-    channel.'''
+class BlastChannel(RPCHandlers):
+    '''A wrapper for a blast channel connection.
+
+    Worker threads add accepted objects to a queue, which is bounded by
+    blast_queue_depth objects and blast_queue_bytes bytes of attribute
+    data, and only block while it is full.  A sender thread owns the
+    connection, receiving each blast channel request and answering it from
+    the queue, so filters continue executing while the client catches up.
+    get_objects requests can return several queued objects at once.'''
 
-    def __init__(self, obj):
+    def __init__(self, config, stats, conn, push_attrs):
         RPCHandlers.__init__(self)
-        self._obj = obj
-        self._sent = False
+        self._stats = stats
+        self._conn = conn
+        self._push_attrs = push_attrs
+        self._max_objects = max(config.blast_queue_depth, 1)
+        self._max_bytes = config.blast_queue_bytes
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        # (Object, size, size of attributes to be sent), or (None, 0, 0)
+        # at the end of the search
+        self._pending = deque()
+        self._bytes = 0		# Total size of pending objects
+        self._finished = False	# End of search sent
+        thread = threading.Thread(target=self._sender_thread,
+                                    name='BlastSender')
+        thread.setDaemon(True)
+        thread.start()
 
     @RPCHandlers.handler(2, reply_class=protocol.XDR_object)
     def get_object(self):
         '''Return an accepted object.'''
-        assert not self._sent
-        self._sent = True
-        return self._obj
-
-    def send(self, conn):
-        '''Send the object on the blast connection.'''
-        while not self._sent:
-            conn.dispatch(self)
-
-
-class BlastChannel(object):
-    '''A wrapper for a blast channel connection.'''
-
-    def __init__(self, conn, push_attrs):
-        self._conn = conn
-        self._push_attrs = push_attrs
+        return self._take(1, 0)[0]
+
+    @RPCHandlers.handler(3, protocol.XDR_blast_request,
+                            protocol.XDR_object_list)
+    def get_objects(self, params):
+        '''Return up to the requested number of accepted objects, omitting
+        any that would exceed the requested number of bytes.  At least one
+        object is always returned.'''
+        return protocol.XDR_object_list(objects=self._take(
+                                params.max_objects, params.max_bytes))
+
+    def _take(self, max_objects, max_bytes):
+        '''Wait for accepted objects, then remove objects from the head of
+        the queue and return them as XDR_objects.'''
+        with self._lock:
+            while not self._pending:
+                self._not_empty.wait()
+            objs = []
+            total = 0
+            while self._pending and len(objs) < max(max_objects, 1):
+                obj, size, reply_size = self._pending[0]
+                if objs and total + reply_size > max_bytes:
+                    break
+                self._pending.popleft()
+                self._bytes -= size
+                objs.append(obj)
+                total += reply_size
+                if obj is None:
+                    self._finished = True
+            self._not_full.notify_all()
+        # Encode without holding the lock, so workers are not kept waiting
+        xdrs = []
+        for obj in objs:
+            if obj is not None:
+                xdrs.append(obj.xdr(self._push_attrs))
+            else:
+                xdrs.append(EmptyObject().xdr())
+        return xdrs
+
+    # We want to catch all exceptions
+    # pylint: disable=broad-except
+    def _sender_thread(self):
+        '''Thread function.  Answer blast channel requests until the end of
+        the search has been sent.'''
+        try:
+            while not self._finished:
+                self._conn.dispatch(self)
+        except ConnectionFailure:
+            # Client closed blast connection.  Rather than just calling
+            # sys.exit(), signal the main thread to shut us down.
+            os.kill(os.getpid(), signal.SIGUSR1)
+        except Exception:
+            _log.exception('Blast channel thread exception')
+            os.kill(os.getpid(), signal.SIGUSR1)
+    # pylint: enable=broad-except
 
     def send(self, obj):
-        '''Send the specified Object on the blast channel.'''
-        xdr = obj.xdr(self._push_attrs)
-        _BlastChannelSender(xdr).send(self._conn)
+        '''Queue the specified Object for sending on the blast channel,
+        waiting while the queue is full.'''
+        size = obj.get_size()
+        reply_size = obj.xdr_size(self._push_attrs)
+        timer = None
+        with self._lock:
+            while self._pending and (len(self._pending) >= self._max_objects
+                                or self._bytes + size > self._max_bytes):
+                if timer is None:
+                    timer = Timer()
+                self._not_full.wait()
+            self._pending.append((obj, size, reply_size))
+            self._bytes += size
+            self._not_empty.notify()
+        if timer is not None:
+            self._stats.update('blast_queue_waits',
+                                blast_queue_wait_us=timer.elapsed)
 
     def close(self):
         '''Tell the client that no more objects will be returned.'''
-        xdr = EmptyObject().xdr()
-        _BlastChannelSender(xdr).send(self._conn)
+        with self._lock:
+            self._pending.append((None, 0, 0))
+            self._not_empty.notify()
+
+    def get_queued(self):
+        '''Return the number of objects and bytes waiting to be sent.'''
+        with self._lock:
+            return len(self._pending), self._bytes
@@ -58,10 +58,16 @@ class SearchStatistics(_Statistics):
             ('objs_dropped', 'Objects dropped'),
             ('objs_passed', 'Objects passed'),
             ('objs_unloadable', 'Objects failing to load'),
+            ('cache_lru_hits', 'In-process cache hits'),
+            ('cache_lru_misses', 'In-process cache misses'),
+            ('blast_queue_waits', 'Objects waiting for blast queue space'),
+            ('blast_queue_wait_us', 'Time waiting for blast queue space (us)'),
             ('execution_us', 'Total object examination time (us)'))
 
-    def xdr(self, objs_total, filter_stats):
-        '''Return an XDR statistics structure for these statistics.'''
+    def xdr(self, objs_total, filter_stats, blast_queued=(0, 0)):
+        '''Return an XDR statistics structure for these statistics.
+        blast_queued is the number of objects and bytes currently waiting
+        to be sent on the blast channel.'''
         with self._lock:
             try:
                 avg_obj_us = self.execution_us / self.objs_processed
@@ -71,6 +77,8 @@ class SearchStatistics(_Statistics):
             stats = []
             stats.append(XDR_stat('objs_total', objs_total))
             stats.append(XDR_stat('avg_obj_time_us', avg_obj_us))
+            stats.append(XDR_stat('blast_queue_objs', blast_queued[0]))
+            stats.append(XDR_stat('blast_queue_bytes', blast_queued[1]))
             for name, _desc in self.attrs:
                 if name != 'execution_us':
                     stats.append(XDR_stat(name, getattr(self, name)))
@@ -97,6 +105,18 @@ class FilterStatistics(_Statistics):
         self.name = name
         self.label = 'Filter statistics for %s' % name
 
+    def get_cost(self):
+        '''Return a tuple of the mean execution time in us per object
+        examined by the filter and the fraction of objects considered that
+        were dropped, or None if the filter has not examined any objects.
+        Objects resolved by the result cache cost no execution time, so
+        they are excluded from the mean.'''
+        with self._lock:
+            if self.objs_computed == 0:
+                return None
+            return (float(self.execution_us) / self.objs_computed,
+                    float(self.objs_dropped) / self.objs_processed)
+
     def xdr(self):
         '''Return an XDR statistics structure for these statistics.'''
         with self._lock:
@@ -10,16 +10,37 @@
 #  RECIPIENT'S ACCEPTANCE OF THIS AGREEMENT
 #
 
+from __future__ import with_statement
 import base64
 import binascii
 from datetime import datetime, timedelta
 from dateutil.tz import tzutc
+from hashlib import sha256
 from M2Crypto import EVP
+import os
+import shutil
+import socket
+from tempfile import mkdtemp
+import threading
+import time
 import unittest
 import uuid
 import textwrap
-
-from opendiamond.scope import ScopeCookie, ScopeError
+from xml.dom import minidom
+import xdrlib
+import zlib
+
+from opendiamond.blobcache import BlobCache
+from opendiamond.dataretriever import diamond_store
+from opendiamond.rpc import (RPCConnection, RPCHandlers, RPCHeader,
+        RPCEncodingError, RPC_PENDING, RECV_BUFFER_SIZE)
+from opendiamond.scope import ScopeCookie, ScopeError, generate_cookie
+from opendiamond.server import prefetch
+from opendiamond.server.cache import MemoryCache
+from opendiamond.server.filter import _FilterResult
+from opendiamond.server.object_ import ObjectLoadError
+from opendiamond.server.scopelist import _ScopeSource
+from opendiamond.xdr import XDR, XDRStruct, XDREncodingError, IOV_THRESHOLD
 
 # unittest uses Java-style naming conventions
 # pylint: disable=invalid-name
@@ -187,6 +208,24 @@ class TestCookieEmptyScopeList(_TestScope):
     verify_exc = None
 
 
+class TestGenerateCookieBadPartition(_TestScope):
+    '''Try to generate a cookie with an unknown partition scheme.'''
+    generate_exc = ValueError
+
+    def generate_cookie(self):
+        return generate_cookie(self.scopeurls, self.servers,
+                                partition='bogus')
+
+
+class TestGenerateCookieShardsWithoutProxies(_TestScope):
+    '''Try to generate a sharded cookie without proxies.'''
+    generate_exc = ValueError
+
+    def generate_cookie(self):
+        return generate_cookie(self.scopeurls, self.servers,
+                                partition='range')
+
+
 class _TestHandGeneratedCookie(_TestScope):
     boundary_start = '-----BEGIN OPENDIAMOND SCOPECOOKIE-----\n'
     boundary_end = '-----END OPENDIAMOND SCOPECOOKIE-----\n'
@@ -279,5 +318,606 @@ class TestCookieBadSignature(_TestHandGeneratedCookie):
     verify_exc = ScopeError
 
 
+
+class _PrefetchConfig(object):
+    prefetch_depth = 3
+    prefetch_bytes = 1 << 20
+    threads = 4
+
+
+class _PrefetchObject(object):
+    def __init__(self, id, fail=False):
+        self.id = id
+        self.fail = fail
+        self.loaded = False
+
+    def get_size(self):
+        return 100
+
+
+class _PrefetchLoader(object):
+    '''Stands in for ObjectLoader.'''
+
+    def __init__(self, _config, _blob_cache, _http):
+        pass
+
+    def load(self, obj):
+        obj.loaded = True
+        if obj.fail:
+            raise ObjectLoadError('Failed')
+
+
+class _PrefetchScope(object):
+    '''Stands in for ScopeListLoader.'''
+
+    def __init__(self, objs):
+        self.objs = objs
+        self._iter = iter(objs)
+        self._lock = threading.Lock()
+
+    def next(self):
+        with self._lock:
+            return self._iter.next()
+
+    def get_count(self):
+        return len(self.objs)
+
+
+class _PrefetchRunner(object):
+    '''Stands in for FilterStackRunner, dropping even-numbered objects.'''
+
+    def result_cache_drops(self, obj):
+        return obj.id % 2 == 0
+
+
+class TestObjectPrefetcher(unittest.TestCase):
+    '''Load objects ahead of the worker threads.'''
+
+    def setUp(self):
+        self._loader = prefetch.ObjectLoader
+        prefetch.ObjectLoader = _PrefetchLoader
+
+    def tearDown(self):
+        prefetch.ObjectLoader = self._loader
+
+    def _prefetch(self, scope, bind=None):
+        return prefetch.ObjectPrefetcher(_PrefetchConfig(), None, scope,
+                                bind=bind)
+
+    def test_all_objects(self):
+        scope = _PrefetchScope([_PrefetchObject(i) for i in range(20)])
+        prefetcher = self._prefetch(scope)
+        self.assertEqual(prefetcher.get_count(), 20)
+        objs = list(prefetcher)
+        self.assertEqual(sorted(o.id for o in objs), range(20))
+        self.assertTrue(all(o.loaded for o in objs))
+
+    def test_depth(self):
+        scope = _PrefetchScope([_PrefetchObject(i) for i in range(20)])
+        prefetcher = self._prefetch(scope)
+        def loaded():
+            return len([o for o in scope.objs if o.loaded])
+        deadline = time.time() + 5
+        while loaded() < _PrefetchConfig.prefetch_depth:
+            self.assertTrue(time.time() < deadline)
+            time.sleep(0.01)
+        time.sleep(0.1)
+        self.assertEqual(loaded(), _PrefetchConfig.prefetch_depth)
+        self.assertEqual(len(list(prefetcher)), 20)
+
+    def test_load_error(self):
+        scope = _PrefetchScope([_PrefetchObject(0, fail=True)])
+        self.assertEqual([o.id for o in self._prefetch(scope)], [0])
+
+    def test_result_cache_drops(self):
+        scope = _PrefetchScope([_PrefetchObject(i) for i in range(20)])
+        objs = list(self._prefetch(scope, _PrefetchRunner))
+        self.assertEqual(sorted(o.id for o in objs), range(20))
+        for obj in objs:
+            self.assertEqual(obj.loaded, obj.id % 2 == 1)
+
+
+
+class TestFilterResultEncoding(unittest.TestCase):
+    '''Encode and decode result cache entries.'''
+
+    digest = '0123456789abcdef' * 2
+
+    def _result(self, **kwargs):
+        args = {
+            'input_attrs': {'': self.digest, 'missing': None},
+            'output_attrs': {'out': self.digest},
+            'omit_attrs': ['out'],
+            'score': 0.25,
+        }
+        args.update(kwargs)
+        return _FilterResult(**args)
+
+    def assertResultEqual(self, a, b):
+        self.assertEqual(a.input_attrs, b.input_attrs)
+        self.assertEqual(a.output_attrs, b.output_attrs)
+        self.assertEqual(a.omit_attrs, b.omit_attrs)
+        self.assertEqual(a.score, b.score)
+
+    def test_binary(self):
+        result = self._result()
+        data = result.encode('binary')
+        self.assertTrue(data.startswith(_FilterResult.BINARY_MAGIC))
+        self.assertResultEqual(_FilterResult.decode(data), result)
+
+    def test_json(self):
+        result = self._result()
+        data = result.encode('json')
+        self.assertTrue(data.startswith('{'))
+        self.assertResultEqual(_FilterResult.decode(data), result)
+
+    def test_empty(self):
+        result = _FilterResult()
+        decoded = _FilterResult.decode(result.encode('binary'))
+        self.assertResultEqual(decoded, result)
+
+    def test_too_many_names(self):
+        attrs = dict(('attr%d' % i, self.digest) for i in xrange(70000))
+        result = self._result(input_attrs=attrs)
+        data = result.encode('binary')
+        self.assertTrue(data.startswith('{'))
+        self.assertResultEqual(_FilterResult.decode(data), result)
+
+    def test_long_name(self):
+        result = self._result(output_attrs={'x' * 70000: self.digest})
+        data = result.encode('binary')
+        self.assertTrue(data.startswith('{'))
+        self.assertResultEqual(_FilterResult.decode(data), result)
+
+    def test_truncated(self):
+        data = self._result().encode('binary')
+        for length in (1, 10, len(data) - 1):
+            self.assertEqual(_FilterResult.decode(data[:length]), None)
+
+    def test_unknown_version(self):
+        data = self._result().encode('binary')
+        data = data[0] + chr(_FilterResult.BINARY_VERSION + 1) + data[2:]
+        self.assertEqual(_FilterResult.decode(data), None)
+
+
+
+class TestMemoryCache(unittest.TestCase):
+    '''Evict least recently used entries from the in-process cache.'''
+
+    def test_get_set(self):
+        cache = MemoryCache(100)
+        cache.set_multi({'a': '1', 'b': '2'})
+        self.assertEqual(cache.get_multi(['a', 'b', 'c']), ['1', '2', None])
+
+    def test_evict_oldest(self):
+        # Each entry is 10 bytes of key and value
+        cache = MemoryCache(30)
+        cache.set_multi({'k1': 'v' * 8})
+        cache.set_multi({'k2': 'v' * 8})
+        cache.set_multi({'k3': 'v' * 8})
+        cache.set_multi({'k4': 'v' * 8})
+        self.assertEqual(cache.get_multi(['k1']), [None])
+        self.assertEqual(cache.get_multi(['k2', 'k3', 'k4']), ['v' * 8] * 3)
+
+    def test_get_refreshes(self):
+        cache = MemoryCache(30)
+        cache.set_multi({'k1': 'v' * 8})
+        cache.set_multi({'k2': 'v' * 8})
+        cache.set_multi({'k3': 'v' * 8})
+        cache.get_multi(['k1'])
+        cache.set_multi({'k4': 'v' * 8})
+        self.assertEqual(cache.get_multi(['k1', 'k2']), ['v' * 8, None])
+
+    def test_replace(self):
+        cache = MemoryCache(30)
+        cache.set_multi({'k1': 'v' * 8, 'k2': 'v' * 8})
+        # Replacing an entry must not count its old value against the limit
+        cache.set_multi({'k1': 'w' * 8})
+        cache.set_multi({'k1': 'x' * 8})
+        self.assertEqual(cache.get_multi(['k1', 'k2']), ['x' * 8, 'v' * 8])
+
+    def test_oversized(self):
+        cache = MemoryCache(30)
+        cache.set_multi({'k1': 'v' * 8})
+        cache.set_multi({'big': 'v' * 100})
+        self.assertEqual(cache.get_multi(['k1', 'big']), ['v' * 8, None])
+
+
+
+class _DiamondStoreConfig(object):
+    def __init__(self, indexdir):
+        self.indexdir = indexdir
+        self.dataroot = indexdir
+        self.dataorder = None
+
+
+class _DiamondStoreTest(unittest.TestCase):
+    '''Base class for tests of scope lists served from an index file.'''
+
+    count = 25
+
+    def setUp(self):
+        self.dir = mkdtemp(prefix='diamond-test-')
+        self.index = os.path.join(self.dir, 'GIDIDXTEST')
+        self.paths = ['dir/obj%02d' % i for i in range(self.count)]
+        self._write_index(self.paths)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _write_index(self, paths):
+        with open(self.index, 'w') as fh:
+            fh.write(''.join(path + '\n' for path in paths))
+
+    def _parse(self, *args, **kwargs):
+        '''Return the object paths, header count, and count adjustment of
+        the scope list.'''
+        data = ''.join(diamond_store.GIDIDXParser(self.index, *args,
+                                **kwargs))
+        doc = minidom.parseString(data)
+        paths = [e.getAttribute('src').split('/', 1)[1]
+                                for e in doc.getElementsByTagName('object')]
+        count = doc.documentElement.getAttribute('count')
+        if count:
+            count = int(count)
+        else:
+            count = None
+        adjust = [int(e.getAttribute('adjust'))
+                                for e in doc.getElementsByTagName('count')]
+        if adjust:
+            adjust = adjust[0]
+        else:
+            adjust = None
+        return paths, count, adjust
+
+
+class TestDiamondStoreOffsets(_DiamondStoreTest):
+    '''Cache the offsets of index entries in a sidecar file.'''
+
+    def _offsets_count(self):
+        offsets = diamond_store.open_offsets(self.index)
+        if offsets is None:
+            return None
+        offsets[0].close()
+        return offsets[1]
+
+    def test_build_on_full_list(self):
+        self.assertEqual(self._offsets_count(), None)
+        # Without a sidecar, the count comes at the end
+        self.assertEqual(self._parse(), (self.paths, None, self.count))
+        self.assertEqual(self._offsets_count(), self.count)
+        # With one, it comes first
+        self.assertEqual(self._parse(), (self.paths, self.count, None))
+
+    def test_entry_offsets(self):
+        self._parse()
+        offsets = diamond_store.open_offsets(self.index)
+        try:
+            with open(self.index) as fh:
+                for i, path in enumerate(self.paths):
+                    fh.seek(diamond_store.entry_offset(offsets, i))
+                    self.assertEqual(fh.readline().strip(), path)
+        finally:
+            offsets[0].close()
+
+    def test_partial_list(self):
+        # The sidecar is only installed if the whole index is read
+        gen = diamond_store.GIDIDXParser(self.index)
+        for _i in range(5):
+            gen.next()
+        gen.close()
+        self.assertEqual(self._offsets_count(), None)
+        self.assertEqual([f for f in os.listdir(self.dir)
+                                if f.startswith('GIDIDXTEST.offsets')], [])
+
+    def test_stale(self):
+        self._parse()
+        self._write_index(self.paths + ['dir/new'])
+        self.assertEqual(self._offsets_count(), None)
+        paths = self.paths + ['dir/new']
+        self.assertEqual(self._parse(), (paths, None, self.count + 1))
+        self.assertEqual(self._offsets_count(), self.count + 1)
+
+    def test_prepare(self):
+        other = os.path.join(self.dir, 'GIDIDXOTHER')
+        with open(other, 'w') as fh:
+            fh.write('a\nb\n')
+        diamond_store.init(_DiamondStoreConfig(self.dir))
+        diamond_store.prepare()
+        self.assertEqual(self._offsets_count(), self.count)
+        offsets = diamond_store.open_offsets(other)
+        offsets[0].close()
+        self.assertEqual(offsets[1], 2)
+        self.assertEqual(self._parse(), (self.paths, self.count, None))
+
+
+
+class TestDiamondStorePartition(_DiamondStoreTest):
+    '''Serve ranges and shards of a scope list.'''
+
+    def test_range(self):
+        self.assertEqual(self._parse(5, 10), (self.paths[5:15], 10, None))
+        self.assertEqual(self._parse(20), (self.paths[20:], 5, None))
+        self.assertEqual(self._parse(30, 10), ([], 0, None))
+
+    def test_range_shards(self):
+        paths = []
+        for part in range(3):
+            shard, count, adjust = self._parse(shard=(part, 3, 'range'))
+            self.assertEqual(count, len(shard))
+            self.assertEqual(adjust, None)
+            paths.extend(shard)
+        self.assertEqual(paths, self.paths)
+
+    def test_hash_shards(self):
+        paths = []
+        for part in range(3):
+            shard, count, adjust = self._parse(shard=(part, 3, 'hash'))
+            self.assertEqual(count, None)
+            self.assertEqual(adjust, len(shard))
+            for path in shard:
+                self.assertEqual((zlib.crc32(path) & 0xffffffff) % 3, part)
+            paths.extend(shard)
+        self.assertEqual(sorted(paths), self.paths)
+
+    def _request(self, query):
+        diamond_store.init(_DiamondStoreConfig(self.dir))
+        status = []
+        def start_response(code, _headers):
+            status.append(code)
+        environ = {'PATH_INFO': '/test', 'SCRIPT_NAME': '',
+                                'QUERY_STRING': query}
+        data = ''.join(diamond_store.scope_app(environ, start_response))
+        return status[0], data
+
+    def test_request(self):
+        status, data = self._request('shard=2of3&partition=hash')
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(data, ''.join(diamond_store.GIDIDXParser(
+                                self.index, shard=(1, 3, 'hash'))))
+
+    def test_bad_request(self):
+        for query in ('shard=0of3', 'shard=4of3', 'shard=1of3&start=2',
+                                'shard=1of3&partition=bogus', 'start=-1',
+                                'limit=x'):
+            status, _data = self._request(query)
+            self.assertEqual(status, '400 Bad Request', query)
+
+
+
+class TestRendezvousHashing(unittest.TestCase):
+    '''Divide a shared scope list among servers by rendezvous hashing.'''
+
+    servers = ['s1', 's2', 's3', 's4']
+    urls = ['obj/%d' % i for i in range(400)]
+
+    def _share(self, ours, servers=None):
+        if servers is None:
+            servers = self.servers
+        source = _ScopeSource('scope', 'consistent-hash', servers, ours)
+        return set(url for url in self.urls if source.owns(url))
+
+    def test_partition(self):
+        shares = [self._share([server]) for server in self.servers]
+        self.assertEqual(sum(len(share) for share in shares), len(self.urls))
+        self.assertEqual(set.union(*shares), set(self.urls))
+        for share in shares:
+            # Roughly even division
+            self.assertTrue(len(share) > len(self.urls) / 8)
+
+    def test_multiple_names(self):
+        self.assertEqual(self._share(['s1', 's3']),
+                                self._share(['s1']) | self._share(['s3']))
+
+    def test_remove_server(self):
+        # Only the removed server's objects move
+        remaining = self.servers[:-1]
+        removed = self._share([self.servers[-1]])
+        for server in remaining:
+            before = self._share([server])
+            after = self._share([server], remaining)
+            self.assertTrue(before <= after)
+            self.assertTrue(after - before <= removed)
+
+
+
+class _XDRTestItem(XDRStruct):
+    members = (
+        'name', XDR.string(),
+        'value', XDR.opaque(),
+    )
+
+
+class _XDRTestStruct(XDRStruct):
+    members = (
+        'int', XDR.int(),
+        'uint', XDR.uint(),
+        'hyper', XDR.hyper(),
+        'double', XDR.double(),
+        'string', XDR.string(),
+        'fopaque', XDR.fopaque(5),
+        'items', XDR.array(XDR.struct(_XDRTestItem)),
+        'optional', XDR.optional(XDR.uint()),
+        None, XDR.constant(XDR.uint(), 7),
+        'item', XDR.struct(_XDRTestItem),
+    )
+
+
+class TestXDRCodecs(unittest.TestCase):
+    '''Compare the compiled XDR codecs with xdrlib.'''
+
+    def _struct(self, **kwargs):
+        args = {
+            'int': -5,
+            'uint': 0xfffffffe,
+            'hyper': -(1 << 40),
+            'double': 2.5,
+            'string': 'abc',
+            'fopaque': '12345',
+            'items': [_XDRTestItem('a' * n, 'b' * (n * 3))
+                                for n in range(5)],
+            'optional': None,
+            'item': _XDRTestItem('', 'value'),
+        }
+        args.update(kwargs)
+        return _XDRTestStruct(**args)
+
+    def _xdrlib_encode(self, obj):
+        xdr = xdrlib.Packer()
+        obj.encode_xdr(xdr)
+        return xdr.get_buffer()
+
+    def assertStructEqual(self, a, b):
+        self.assertEqual(self._xdrlib_encode(a), self._xdrlib_encode(b))
+
+    def test_encode(self):
+        for obj in (self._struct(), self._struct(optional=3, items=[]),
+                                self._struct(hyper=(1 << 64) - 1)):
+            self.assertEqual(obj.encode(), self._xdrlib_encode(obj))
+
+    def test_decode(self):
+        obj = self._struct(optional=0)
+        data = self._xdrlib_encode(obj)
+        decoded = _XDRTestStruct.decode(data)
+        self.assertStructEqual(decoded, obj)
+        self.assertEqual(decoded.optional, 0)
+        self.assertEqual([i.name for i in decoded.items],
+                                [i.name for i in obj.items])
+        reference = _XDRTestStruct.decode_xdr(xdrlib.Unpacker(data))
+        self.assertStructEqual(decoded, reference)
+
+    def test_decode_buffer(self):
+        obj = self._struct()
+        data = obj.encode()
+        self.assertStructEqual(_XDRTestStruct.decode(buffer(data)), obj)
+
+    def test_encode_iov(self):
+        big = 'x' * IOV_THRESHOLD
+        obj = self._struct(item=_XDRTestItem('big', big))
+        iov = obj.encode_iov()
+        self.assertEqual(''.join(iov), obj.encode())
+        self.assertTrue(big in iov)
+
+    def test_trailing_data(self):
+        data = self._struct().encode()
+        self.assertRaises(XDREncodingError, _XDRTestStruct.decode,
+                                data + '\0\0\0\0')
+
+    def test_truncated(self):
+        data = self._struct().encode()
+        for length in (0, 3, 20, len(data) - 1):
+            self.assertRaises(XDREncodingError, _XDRTestStruct.decode,
+                                data[:length])
+
+    def test_bad_fopaque(self):
+        self.assertRaises(XDREncodingError,
+                                self._struct(fopaque='1234').encode)
+
+
+
+class _RPCTestHandlers(RPCHandlers):
+    def __init__(self):
+        RPCHandlers.__init__(self)
+        self.chunks = []
+
+    @RPCHandlers.handler(1, stream=True)
+    def upload(self, body):
+        length = body.read_uint()
+        for chunk in body.read_chunks(length):
+            self.chunks.append(str(chunk))
+
+    @RPCHandlers.handler(2, stream=True)
+    def partial(self, body):
+        body.read(4)
+
+    @RPCHandlers.handler(3, stream=True)
+    def overread(self, body):
+        body.read(body.remaining + 1)
+
+    @RPCHandlers.handler(4, _XDRTestItem, _XDRTestItem)
+    def echo(self, item):
+        return item
+
+
+class TestRPCStreaming(unittest.TestCase):
+    '''Pass request bodies to stream handlers without buffering them.'''
+
+    def setUp(self):
+        self.handlers = _RPCTestHandlers()
+        self.item = _XDRTestItem('name', 'value')
+
+    def _rpc(self, requests):
+        '''Send the (status, cmd, body) requests, dispatch them, and
+        return a list of (status, body) replies.'''
+        client, server = socket.socketpair()
+        data = ''.join(RPCHeader(seq, status, cmd, len(body)).encode() + body
+                                for seq, (status, cmd, body)
+                                in enumerate(requests))
+        # The requests may not fit in the socket buffer
+        sender = threading.Thread(target=client.sendall, args=(data,))
+        sender.start()
+        conn = RPCConnection(server)
+        for status, _cmd, _body in requests:
+            if status == RPC_PENDING:
+                conn.dispatch(self.handlers)
+        sender.join()
+        replies = []
+        fh = client.makefile('rb')
+        for status, _cmd, _body in requests:
+            if status == RPC_PENDING:
+                hdr = RPCHeader.decode(fh.read(RPCHeader.ENCODED_LENGTH))
+                replies.append((hdr.status, fh.read(hdr.datalen)))
+        fh.close()
+        client.close()
+        server.close()
+        return replies
+
+    def _echo(self):
+        return (RPC_PENDING, 4, self.item.encode())
+
+    def test_upload(self):
+        data = os.urandom(3 * RECV_BUFFER_SIZE + 5)
+        # An XDR opaque: length, data, and padding
+        body = _XDRTestItem('', data).encode()[4:]
+        replies = self._rpc([(RPC_PENDING, 1, body), self._echo()])
+        self.assertEqual(replies, [(0, ''), (0, self.item.encode())])
+        self.assertEqual(''.join(self.handlers.chunks), data)
+        for chunk in self.handlers.chunks:
+            self.assertTrue(len(chunk) <= RECV_BUFFER_SIZE)
+
+    def test_discard_rest(self):
+        replies = self._rpc([(RPC_PENDING, 2, 'x' * 100000), self._echo()])
+        self.assertEqual(replies, [(0, ''), (0, self.item.encode())])
+
+    def test_overread(self):
+        replies = self._rpc([(RPC_PENDING, 3, 'x' * 100), self._echo()])
+        self.assertEqual(replies, [(RPCEncodingError.code, ''),
+                                (0, self.item.encode())])
+
+    def test_ignore_replies(self):
+        replies = self._rpc([(0, 4, 'x' * 100), self._echo()])
+        self.assertEqual(replies, [(0, self.item.encode())])
+
+
+class TestBlobCacheStream(unittest.TestCase):
+    '''Add blobs to the blob cache incrementally.'''
+
+    def setUp(self):
+        self.dir = mkdtemp(prefix='diamond-test-')
+        self.cache = BlobCache(self.dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_add_stream(self):
+        data = os.urandom(100000)
+        chunks = [buffer(data, i, 30000) for i in range(0, len(data), 30000)]
+        sig = self.cache.add_stream(chunks)
+        self.assertEqual(sig, sha256(data).hexdigest())
+        self.assertTrue(sig in self.cache)
+        self.assertEqual(self.cache[sig], data)
+        self.assertEqual(self.cache.add(data), sig)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -10,15 +10,75 @@
 #  RECIPIENT'S ACCEPTANCE OF THIS AGREEMENT
 #
 
-'''XDR encoding helpers.'''
-
+'''XDR encoding helpers.
+
+XDRStruct.encode() and XDRStruct.decode() do not walk the struct members
+at runtime.  Instead, the first time a struct class is encoded or decoded,
+its type handlers generate the source code of an encoder and a decoder
+specialized for that class, which are compiled and cached on the class.
+The encoder appends the pieces of the encoding to a list, and the decoder
+reads fields directly from the input buffer with precompiled struct
+formats.  encode_xdr() and decode_xdr() remain available for use with
+xdrlib streams.
+'''
+
+import itertools
 import struct
 from xdrlib import Packer, Unpacker, Error as XDRError
 
+# Opaque values at least this large are referenced, rather than copied, by
+# XDRStruct.encode_iov()
+IOV_THRESHOLD = 4096
+
 class XDREncodingError(Exception):
     pass
 
 
+class _CodeGenerator(object):
+    '''Source code and namespace for compiled encoders and decoders.
+
+    Encoders append strings to the list "out".  Decoders read from the
+    string or buffer object "buf" starting at offset "pos", and advance
+    "pos".'''
+
+    def __init__(self):
+        self.lines = []
+        self.namespace = {
+            'EOFError': EOFError,
+            'XDREncodingError': XDREncodingError,
+            '_int': struct.Struct('>i'),
+            '_uint': struct.Struct('>I'),
+            '_hyper': struct.Struct('>q'),
+            '_uhyper': struct.Struct('>Q'),
+            '_double': struct.Struct('>d'),
+            '_pad': ('', '\0\0\0', '\0\0', '\0'),
+            '_true': struct.pack('>I', 1),
+            '_false': struct.pack('>I', 0),
+            '_get_codec': _get_codec,
+            '_new': object.__new__,
+        }
+        self._counter = itertools.count()
+
+    def var(self, prefix='v'):
+        '''Return a new local variable name.'''
+        return '%s%d' % (prefix, self._counter.next())
+
+    def const(self, value):
+        '''Return the name of a new global bound to value.'''
+        name = self.var('c')
+        self.namespace[name] = value
+        return name
+
+    def emit(self, indent, line):
+        self.lines.append('    ' * indent + line)
+
+    def compile(self, name):
+        '''Compile the code and return its namespace.'''
+        code = compile('\n'.join(self.lines) + '\n', '<%s>' % name, 'exec')
+        exec code in self.namespace
+        return self.namespace
+
+
 class _XDRTypeHandler(object):
     def pack(self, xdr, val):
         '''Serialize the object into an XDR stream.'''
@@ -28,8 +88,54 @@ class _XDRTypeHandler(object):
         '''Deserialize the object from an XDR stream and return it.'''
         raise NotImplementedError()
 
+    def emit_pack(self, gen, expr, indent):
+        '''Generate code to encode the value of the expression.'''
+        raise NotImplementedError()
+
+    def emit_unpack(self, gen, target, indent):
+        '''Generate code to decode a value into the target variable.'''
+        raise NotImplementedError()
+
+
+def _emit_pack_bytes(gen, expr, indent, length=None):
+    '''Generate code to encode a string or, if length is specified, a
+    fixed-length opaque value.'''
+    v = gen.var()
+    n = gen.var('n')
+    gen.emit(indent, '%s = %s' % (v, expr))
+    gen.emit(indent, 'if type(%s) is unicode: %s = str(%s)' % (v, v, v))
+    gen.emit(indent, '%s = len(%s)' % (n, v))
+    if length is None:
+        gen.emit(indent, 'out.append(_uint.pack(%s))' % n)
+    else:
+        gen.emit(indent, 'if %s != %d: raise XDREncodingError()' %
+                (n, length))
+    gen.emit(indent, 'out.append(%s)' % v)
+    gen.emit(indent, 'if %s & 3: out.append(_pad[%s & 3])' % (n, n))
+
+
+def _emit_unpack_bytes(gen, target, indent, length=None):
+    '''Generate code to decode a string or, if length is specified, a
+    fixed-length opaque value.'''
+    if length is None:
+        n = gen.var('n')
+        gen.emit(indent, '%s, = _uint.unpack_from(buf, pos)' % n)
+        gen.emit(indent, 'pos += 4')
+    else:
+        n = str(length)
+    gen.emit(indent, '%s = buf[pos:pos + %s]' % (target, n))
+    gen.emit(indent, 'if len(%s) != %s: raise EOFError()' % (target, n))
+    gen.emit(indent, 'pos += %s + (-%s & 3)' % (n, n))
+
 
 class _XDRPrimitiveHandler(_XDRTypeHandler):
+    # name -> (struct, encoded size)
+    _formats = {
+        'uint': ('_uint', 4),
+        'hyper': ('_hyper', 8),
+        'double': ('_double', 8),
+    }
+
     def __init__(self, name):
         _XDRTypeHandler.__init__(self)
         self._name = name
@@ -40,6 +146,25 @@ class _XDRPrimitiveHandler(_XDRTypeHandler):
     def unpack(self, xdr):
         return getattr(xdr, 'unpack_' + self._name)()
 
+    def emit_pack(self, gen, expr, indent):
+        if self._name in ('string', 'opaque'):
+            _emit_pack_bytes(gen, expr, indent)
+        elif self._name == 'hyper':
+            # Like xdrlib, accept both signed and unsigned values
+            gen.emit(indent, 'out.append(_uhyper.pack(%s & 0xffffffffffffffff))'
+                    % expr)
+        else:
+            gen.emit(indent, 'out.append(%s.pack(%s))' %
+                    (self._formats[self._name][0], expr))
+
+    def emit_unpack(self, gen, target, indent):
+        if self._name in ('string', 'opaque'):
+            _emit_unpack_bytes(gen, target, indent)
+        else:
+            fmt, size = self._formats[self._name]
+            gen.emit(indent, '%s, = %s.unpack_from(buf, pos)' % (target, fmt))
+            gen.emit(indent, 'pos += %d' % size)
+
 
 class _XDRFOpaqueHandler(_XDRTypeHandler):
     def __init__(self, length):
@@ -57,6 +182,12 @@ class _XDRFOpaqueHandler(_XDRTypeHandler):
     def unpack(self, xdr):
         return self._check(xdr.unpack_fopaque(self._length))
 
+    def emit_pack(self, gen, expr, indent):
+        _emit_pack_bytes(gen, expr, indent, self._length)
+
+    def emit_unpack(self, gen, target, indent):
+        _emit_unpack_bytes(gen, target, indent, self._length)
+
 
 class _XDRIntHandler(_XDRTypeHandler):
     def pack(self, xdr, val):
@@ -67,6 +198,13 @@ class _XDRIntHandler(_XDRTypeHandler):
     def unpack(self, xdr):
         return xdr.unpack_int()
 
+    def emit_pack(self, gen, expr, indent):
+        gen.emit(indent, 'out.append(_int.pack(%s))' % expr)
+
+    def emit_unpack(self, gen, target, indent):
+        gen.emit(indent, '%s, = _int.unpack_from(buf, pos)' % target)
+        gen.emit(indent, 'pos += 4')
+
 
 class _XDRArrayHandler(_XDRTypeHandler):
     def __init__(self, item_handler):
@@ -82,6 +220,24 @@ class _XDRArrayHandler(_XDRTypeHandler):
     def unpack(self, xdr):
         return xdr.unpack_array(lambda: self._item_handler.unpack(xdr))
 
+    def emit_pack(self, gen, expr, indent):
+        vals = gen.var()
+        val = gen.var()
+        gen.emit(indent, '%s = %s' % (vals, expr))
+        gen.emit(indent, 'out.append(_uint.pack(len(%s)))' % vals)
+        gen.emit(indent, 'for %s in %s:' % (val, vals))
+        self._item_handler.emit_pack(gen, val, indent + 1)
+
+    def emit_unpack(self, gen, target, indent):
+        n = gen.var('n')
+        val = gen.var()
+        gen.emit(indent, '%s, = _uint.unpack_from(buf, pos)' % n)
+        gen.emit(indent, 'pos += 4')
+        gen.emit(indent, '%s = []' % target)
+        gen.emit(indent, 'for _ in xrange(%s):' % n)
+        self._item_handler.emit_unpack(gen, val, indent + 1)
+        gen.emit(indent + 1, '%s.append(%s)' % (target, val))
+
 
 class _XDROptionalHandler(_XDRTypeHandler):
     def __init__(self, item_handler):
@@ -101,6 +257,24 @@ class _XDROptionalHandler(_XDRTypeHandler):
         else:
             return None
 
+    def emit_pack(self, gen, expr, indent):
+        val = gen.var()
+        gen.emit(indent, '%s = %s' % (val, expr))
+        gen.emit(indent, 'if %s is not None:' % val)
+        gen.emit(indent + 1, 'out.append(_true)')
+        self._item_handler.emit_pack(gen, val, indent + 1)
+        gen.emit(indent, 'else:')
+        gen.emit(indent + 1, 'out.append(_false)')
+
+    def emit_unpack(self, gen, target, indent):
+        flag = gen.var()
+        gen.emit(indent, '%s, = _uint.unpack_from(buf, pos)' % flag)
+        gen.emit(indent, 'pos += 4')
+        gen.emit(indent, 'if %s:' % flag)
+        self._item_handler.emit_unpack(gen, target, indent + 1)
+        gen.emit(indent, 'else:')
+        gen.emit(indent + 1, '%s = None' % target)
+
 
 class _XDRConstantHandler(_XDRTypeHandler):
     def __init__(self, item_handler, value):
@@ -115,6 +289,13 @@ class _XDRConstantHandler(_XDRTypeHandler):
         self._item_handler.unpack(xdr)
         return self._value
 
+    def emit_pack(self, gen, _expr, indent):
+        self._item_handler.emit_pack(gen, gen.const(self._value), indent)
+
+    def emit_unpack(self, gen, target, indent):
+        self._item_handler.emit_unpack(gen, gen.var(), indent)
+        gen.emit(indent, '%s = %s' % (target, gen.const(self._value)))
+
 
 class _XDRStructHandler(_XDRTypeHandler):
     def __init__(self, struct_class):
@@ -129,6 +310,19 @@ class _XDRStructHandler(_XDRTypeHandler):
     def unpack(self, xdr):
         return self._struct_class.decode_xdr(xdr)
 
+    def emit_pack(self, gen, expr, indent):
+        val = gen.var()
+        cls = gen.const(self._struct_class)
+        gen.emit(indent, '%s = %s' % (val, expr))
+        gen.emit(indent, 'if type(%s) is not %s: raise XDREncodingError()' %
+                (val, cls))
+        gen.emit(indent, '_get_codec(%s)[0](%s, out)' % (cls, val))
+
+    def emit_unpack(self, gen, target, indent):
+        cls = gen.const(self._struct_class)
+        gen.emit(indent, '%s, pos = _get_codec(%s)[1](buf, pos)' %
+                (target, cls))
+
 
 class XDR(object):
     '''Class containing static factory functions for XDR type handlers.'''
@@ -193,6 +387,42 @@ class _convert_exceptions(object):
 # pylint: enable=invalid-name
 
 
+def _compile_codec(cls):
+    '''Return (encode, decode) functions for the XDRStruct subclass.
+    encode(obj, out) appends the encoding of obj to the list out.
+    decode(buf, pos) decodes an object from buf at offset pos and returns
+    the object and the offset following it.'''
+    gen = _CodeGenerator()
+    members = cls._members()
+    gen.emit(0, 'def encode(obj, out):')
+    for attr, handler in members:
+        if attr is not None:
+            handler.emit_pack(gen, 'obj.' + attr, 1)
+        else:
+            handler.emit_pack(gen, 'None', 1)
+    gen.emit(1, 'pass')
+    gen.emit(0, 'def decode(buf, pos):')
+    gen.emit(1, 'obj = _new(%s)' % gen.const(cls))
+    for attr, handler in members:
+        val = gen.var()
+        handler.emit_unpack(gen, val, 1)
+        if attr is not None:
+            gen.emit(1, 'obj.%s = %s' % (attr, val))
+    gen.emit(1, 'return obj, pos')
+    namespace = gen.compile('XDR codec for %s' % cls.__name__)
+    return namespace['encode'], namespace['decode']
+
+
+def _get_codec(cls):
+    '''Return the compiled (encode, decode) functions for the XDRStruct
+    subclass, compiling them on first use.'''
+    try:
+        return cls.__dict__['_codec']
+    except KeyError:
+        cls._codec = _compile_codec(cls)
+        return cls._codec
+
+
 class XDRStruct(object):
     '''Base class for an XDR struct.'''
 
@@ -212,22 +442,45 @@ class XDRStruct(object):
     @classmethod
     def _members(cls):
         '''cls.members, converted into a list of 2-tuples (attr, handler).'''
-        return zip(cls.members[::2], cls.members[1::2])
+        try:
+            return cls.__dict__['_member_list']
+        except KeyError:
+            cls._member_list = zip(cls.members[::2], cls.members[1::2])
+            return cls._member_list
 
     def encode(self):
         '''Return the serialized bytes for the object.'''
         with _convert_exceptions():
-            xdr = Packer()
-            self.encode_xdr(xdr)
-            return xdr.get_buffer()
+            out = []
+            _get_codec(self.__class__)[0](self, out)
+            return ''.join(out)
+
+    def encode_iov(self):
+        '''Return the serialized bytes for the object as a list of strings,
+        without copying large opaque values.'''
+        with _convert_exceptions():
+            out = []
+            _get_codec(self.__class__)[0](self, out)
+        chunks = []
+        start = 0
+        for i, buf in enumerate(out):
+            if len(buf) >= IOV_THRESHOLD:
+                if start < i:
+                    chunks.append(''.join(out[start:i]))
+                chunks.append(buf)
+                start = i + 1
+        if start < len(out):
+            chunks.append(''.join(out[start:]))
+        return chunks
 
     @classmethod
     def decode(cls, data):
-        '''Deserialize the data and return an object.'''
+        '''Deserialize the data and return an object.  data is a string or
+        a buffer object.'''
         with _convert_exceptions():
-            xdr = Unpacker(data)
-            ret = cls.decode_xdr(xdr)
-            xdr.done()
+            ret, pos = _get_codec(cls)[1](data, 0)
+            if pos != len(data):
+                raise XDRError('unextracted data remains')
             return ret
 
     def encode_xdr(self, xdr):